@@ -3,160 +3,275 @@ import time
 import pprint
 import os
 
-import joblib
+import numpy as np
 import pandas as pd
-from sklearn.preprocessing import MinMaxScaler
 from datetime import timedelta
 
+from columnar import read_table
+from instrumentation import Instrumentation
+from metrics import MINUTE_NS, result_json, monthly_breakdown, ledger_monthly_breakdown
+from prediction_cache import PredictionCache
+from run_store import default_store
 from strategy import Strategy
-from utils import extend_dataset_with_window_length
+from trade import TradeLedger
+from exit_kernel import KernelEngine
+from vectorized_engine import VectorizedEngine
+from utils import scaled_window_matrix
+
+
+def run_engine(strategy, engine, times, prices, signal_idx):
+    strategy.instrumentation.count("ticks", len(times))
+    if engine == "vectorized":
+        VectorizedEngine(strategy, times, prices, signal_idx).run()
+        return
+    if engine == "kernel":
+        KernelEngine(strategy, times, prices, signal_idx).run()
+        return
+    # plain python datetimes, ints and floats are the cheapest to hand to notify one minute at a time
+    timestamps = times.astype("datetime64[ns]").astype("datetime64[us]").tolist()
+    for timestamp, timestamp_idx, price in zip(timestamps, signal_idx.tolist(), prices.tolist()):
+        strategy.notify(timestamp, timestamp_idx, price)
+
+
+def compute_result_json(strategy, params: dict, duration, period=None):
+    return result_json(strategy.trade_df, strategy.capital, params, duration, period)
+
+
+def print_results(config: dict, results_json: dict):
+    pprint.pprint(results_json)
+
+    print("& {} \\newline {} \\newline {} & {} \\newline {} \\newline {} &	{} & {} &	{} & {} & {} & {} & {} \\\\"
+          .format(config["model"],
+                  config["timeframe"],
+                  config["window_length"],
+                  config["params"].get("tp","-"),
+                  config["params"].get("sl", "-"),
+                  config["params"].get("ttl", "-"),
+                  results_json["end_capital"],
+                  round(results_json["win_%"]*100,2),
+                  round(results_json["mean_loss"] * 100,2),
+                  round(results_json["mean_profit"] * 100,2),
+                  round(results_json["tp_hit_%"],2),
+                  round(results_json["sl_hit_%"],2),
+                  round(results_json["ttl_hit_%"],2)))
+
+
+def save_run(config: dict, results_json: dict, trades, instrumentation: dict = None, trade_df: pd.DataFrame = None):
+    """
+    Saves the results and the trades (LEDGER_DTYPE rows) of a run. With the "batch" artifacts store the run is
+    appended to the RunStore of the process, with "files" it gets its own runs/<run_name>_cfg.pickle (json) and
+    runs/<run_name>_trades.csv. Both keep the monthly breakdown. The results are only printed with artifacts verbose.
+    """
+    artifacts = config.get("artifacts", {})
+    if artifacts.get("verbose", False):
+        print_results(config, results_json)
+
+    if artifacts.get("store", "batch") == "batch":
+        default_store(config).add(config, results_json, trades, instrumentation,
+                                  ledger_monthly_breakdown(np.asarray(trades), config["params"]["initial_capital"]))
+        return
+
+    if trade_df is None:
+        params = config["params"]
+        trade_df = TradeLedger.from_rows(trades).to_frame(params.get("sl", None), params.get("tp", None),
+                                                          params.get("ttl", None), config["run_name"])
+    config_and_results = {
+        "config": config,
+        "results": results_json,
+        "monthly": monthly_breakdown(trade_df, config["params"]["initial_capital"]),
+    }
+    if instrumentation is not None:
+        config_and_results["instrumentation"] = instrumentation
+
+    # several sweep workers can get here at the same time
+    os.makedirs("runs", exist_ok=True)
+
+    with open("runs/{}_cfg.pickle".format(config["run_name"]), "w") as fout:
+        fout.write(json.dumps(config_and_results, indent=4))
+    trade_df_file = "runs/{}_trades.csv".format(config["run_name"])
+    trade_df.to_csv(trade_df_file)
+
+
+def run_backtest(strategy: Strategy, config: dict, times, prices, signal_idx, save=True):
+    """
+    Runs the strategy on the aligned minute arrays, saves the run (unless save is False) and returns
+    (results_json, duration). The stages are timed and profiled by strategy.instrumentation when it is enabled.
+    """
+    instrumentation = strategy.instrumentation
+    start_time = time.time()
+    instrumentation.start_profile()
+    with instrumentation.stage("engine"):
+        run_engine(strategy, config.get("engine", "loop"), times, prices, signal_idx)
+    strategy.end()
+    if instrumentation.profile == "cprofile":
+        os.makedirs("runs", exist_ok=True)
+        instrumentation.stop_profile("runs/{}_profile.prof".format(config["run_name"]))
+    else:
+        instrumentation.stop_profile()
+    duration = time.time() - start_time
+    period = (times[0], times[-1]) if len(times) else None
+    with instrumentation.stage("results"):
+        results_json = compute_result_json(strategy, config["params"], duration, period)
+    if save:
+        save_run(config, results_json, strategy.ledger.view(), instrumentation.report(), strategy.trade_df)
+    if instrumentation.enabled and instrumentation.to_elk and strategy.logger.to_elk:
+        strategy.logger.log(instrumentation.log_context(config["run_name"], pd.Timestamp.now().isoformat()))
+        strategy.logger.flush()
+    return results_json, duration
+
+
+def window_matrix(data: pd.DataFrame, window_length, scaler, model):
+    """ Scaled windows of the feature rows (3D for the LSTM) and the output class of each window. """
+    data = data.to_numpy()
+    X = scaled_window_matrix(data[:, :-1], window_length, scaler)
+    Y = data[window_length-1:, -1]
+    if model == "LSTM":
+        X = X.reshape((X.shape[0], window_length, X.shape[1] // window_length))
+    return X, Y
+
+
+def signal_positions(minute_times, bar_times, timeframe):
+    """
+    For every minute, the index of the bar whose prediction is acted upon at that minute, -1 if none. A bar is
+    acted upon timeframe - 1 minutes after the minute of its open time; bars with no such minute are skipped.
+    minute_times and bar_times are sorted int64 ns.
+    """
+    n = len(minute_times)
+    pos = np.searchsorted(minute_times, bar_times)
+    found = pos < n
+    found[found] = minute_times[pos[found]] == bar_times[found]
+    target = pos + max(timeframe - 1, 0)
+    found &= target < n
+    signal_idx = np.full(n, -1, dtype=np.int64)
+    signal_idx[target[found]] = np.flatnonzero(found)
+    return signal_idx
+
+
+def align_minutes(closing_minute_df: pd.DataFrame, bar_times: pd.DatetimeIndex, timeframe):
+    """
+    Minute timestamps (int64 ns), minute close prices and, for every minute, the index of the model
+    prediction that is acted upon at that minute (-1 between timeframes), from the first bar to one minute
+    after the last one. bar_times are the open times of the predicted candles. Computed once per dataset,
+    window and timeframe and shared by all the runs using them.
+    """
+    minute_times = closing_minute_df.index.values.astype("datetime64[ns]").view(np.int64)
+    bar_times = np.asarray(bar_times.values.astype("datetime64[ns]")).view(np.int64)
+    lo = np.searchsorted(minute_times, bar_times[0], side="left")
+    hi = np.searchsorted(minute_times, bar_times[-1] + MINUTE_NS, side="right")
+    times = np.ascontiguousarray(minute_times[lo:hi])
+    prices = np.ascontiguousarray(closing_minute_df["close"].to_numpy(dtype=np.float64)[lo:hi])
+    return times, prices, signal_positions(times, bar_times, timeframe)
 
 
 class Backtester:
     def __init__(self, config: dict):
         self.log_to_stdout = config["log_to_stdout"]
-        self.scaler: MinMaxScaler = self.load_scaler(config["scaler"])
-        self.close_price = None
-        self.data: pd.DataFrame = self.load_data(config["dataset"])
-        self.closing_minute_df = self.load_closing_minute_data()
+        # stages done once for all the runs of this Backtester
+        self.setup = Instrumentation.from_config(config)
+        with self.setup.stage("load"):
+            self.close_price = None
+            self.data: pd.DataFrame = self.load_data(config["dataset"])
+            # only the minutes covered by the signals of the dataset are needed
+            self.closing_minute_df = self.load_closing_minute_data(self.data.index[config["window_length"]-1],
+                                                                   self.data.index[-1]+timedelta(minutes=1))
         self.config = config
-        self.X, self.Y = self.preprocess()
+        self.__scaler = None
+        self.cache = PredictionCache(**config.get("cache", {"enabled": False}))
+        with self.setup.stage("cache_load"):
+            self.cache_key = self.cache.key(config) if self.cache.enabled else None
+            self.predictions = self.cache.load(self.cache_key, "predictions")
+        if self.predictions is None:
+            if self.cache.store_X:
+                with self.setup.stage("preprocess"):
+                    self.X, self.Y = self.preprocess()
+            else:
+                # the predictions are computed chunk by chunk from the feature rows, X is never built
+                self.X = None
+                self.Y = self.data.to_numpy()[self.config["window_length"]-1:, -1]
+        else:
+            # cache hit, the windowing and scaling are only needed if someone asks for X
+            self.X = self.cache.load(self.cache_key, "X")
+            self.Y = self.data.to_numpy()[self.config["window_length"]-1:, -1]
+            if self.log_to_stdout:
+                print("Loaded {} cached predictions".format(len(self.predictions)))
+        self.minute_arrays = None
         self.strategy = None
         self.start_time = None
         self.duration = None
         self.results_json = None
 
     def init_strategy(self, config):
-        if self.strategy:
-            predictions = self.strategy.predictions
-            self.strategy = Strategy(config, predictions)
-        else:
-            self.strategy = Strategy(config)
-            self.strategy.init_predictions(self.X)
+        self.config = config
+        instrumentation = Instrumentation.from_config(config)
+        instrumentation.shared_stages = self.setup.stages
+        self.strategy = Strategy(config, self.predictions, instrumentation)
+        if self.predictions is None:
+            if self.X is not None:
+                self.strategy.init_predictions(self.X)
+            else:
+                stats = self.strategy.init_predictions_from_features(self.data.to_numpy()[:, :-1],
+                                                                     self.config["window_length"], self.scaler)
+                if self.log_to_stdout:
+                    print("Predicted {rows} rows in {seconds}s, {rows_per_s} rows/s (batch size {batch_size}, "
+                          "{chunk_rows} rows per chunk)".format(**stats))
+            self.predictions = self.strategy.predictions
+            if "prediction" in instrumentation.stages:
+                # the next runs reuse the predictions of this one
+                self.setup.stages["prediction"] = instrumentation.stages.pop("prediction")
+            self.cache.save(self.cache_key, "predictions", self.predictions)
+            if self.cache.store_X:
+                self.cache.save(self.cache_key, "X", self.X)
+
+    def get_minute_arrays(self):
+        """
+        Minute timestamps (int64 ns), minute close prices and, for every minute, the index of the model
+        prediction that is acted upon at that minute (-1 between timeframes). Computed once per Backtester.
+        """
+        if self.minute_arrays is None:
+            with self.setup.stage("alignment"):
+                self.minute_arrays = align_minutes(self.closing_minute_df,
+                                                   self.data.index[self.config["window_length"]-1:],
+                                                   self.config["timeframe"])
+        return self.minute_arrays
 
     def start(self):
         self.start_time = time.time()
-        # should you use Y ?
-        df_data = {
-            "timestamp_data": list(range(len(self.X))),
-            "open_time": self.data.index[self.config["window_length"]-1:],
-            "closing_prices": self.close_price.iloc[self.config["window_length"]-1:],
-        }
-
-        timestamp_data = pd.DataFrame(df_data)
-        timestamp_data.set_index("open_time", inplace=True)
-
-        # timestamp_data.index = pd.to_datetime(timestamp_data.index)
-        self.closing_minute_df = self.closing_minute_df[timestamp_data.index[0]:timestamp_data.index[-1]+timedelta(minutes=1)]
-        backtest_df = self.closing_minute_df.join(timestamp_data)
-
-        if self.config["timeframe"] > 1:
-            backtest_df["closing_prices"] = backtest_df["closing_prices"].shift(self.config["timeframe"]-1)
-            backtest_df["timestamp_data"] = backtest_df["timestamp_data"].shift(self.config["timeframe"]-1)
-        # print(backtest_df.head(50))
-        for row in zip(backtest_df.index, backtest_df["timestamp_data"], backtest_df["close"]):
-            self.strategy.notify(row[0], row[1], row[2])
-
-        self.strategy.end()
-        self.duration = (time.time() - self.start_time)
-        self.results_json = self.get_result_json()
-        config_and_results = {
-            "config": self.config,
-            "results": self.results_json
-        }
-
-        pprint.pprint(self.results_json)
-
-        print("& {} \\newline {} \\newline {} & {} \\newline {} \\newline {} &	{} & {} &	{} & {} & {} & {} & {} \\\\"
-              .format(self.config["model"],
-                      self.config["timeframe"],
-                      self.config["window_length"],
-                      self.config["params"].get("tp","-"),
-                      self.config["params"].get("sl", "-"),
-                      self.config["params"].get("ttl", "-"),
-                      self.results_json["end_capital"],
-                      round(self.results_json["win_%"]*100,2),
-                      round(self.results_json["mean_loss"] * 100,2),
-                      round(self.results_json["mean_profit"] * 100,2),
-                      round(self.results_json["tp_hit_%"],2),
-                      round(self.results_json["sl_hit_%"],2),
-                      round(self.results_json["ttl_hit_%"],2)))
-
-        if not os.path.exists("runs"):
-            os.mkdir("runs")
-
-        with open("runs/{}_cfg.pickle".format(self.config["run_name"]), "w") as fout:
-            fout.write(json.dumps(config_and_results, indent=4))
-        trade_df_file = "runs/{}_trades.csv".format(self.config["run_name"])
-        self.strategy.trade_df.to_csv(trade_df_file)
+        times, prices, signal_idx = self.get_minute_arrays()
+        self.results_json, self.duration = run_backtest(self.strategy, self.config, times, prices, signal_idx)
 
         if self.log_to_stdout:
             print("Backtesting DONE! Saved to file")
 
+    @property
+    def scaler(self):
+        """ Loaded on first use, runs with cached predictions never unpickle it (nor import sklearn). """
+        if self.__scaler is None:
+            with self.setup.stage("load"):
+                self.__scaler = self.load_scaler(self.config["scaler"])
+        return self.__scaler
+
     def load_scaler(self, scaler_path):
+        import joblib
         return joblib.load(scaler_path)
 
     def load_data(self, dataset_path):
-        df = pd.read_csv(dataset_path)
-        df.set_index("open_time", inplace=True)
+        df = read_table(dataset_path)
         self.close_price = df["close"]
-        df.drop(columns=["close"], inplace=True)
+        df = df.drop(columns=["close"])
         if self.log_to_stdout:
             print("Loaded {} with shape {}".format(dataset_path, df.shape))
-        df.index = pd.to_datetime(df.index)
         return df
 
     def preprocess(self):
-        data = self.data.to_numpy()
-        X = data[:, :-1]
-        Y = data[:, -1]
-        X, Y = extend_dataset_with_window_length(X, Y, self.config["window_length"])
+        X, Y = window_matrix(self.data, self.config["window_length"], self.scaler, self.config["model"])
         if self.log_to_stdout:
             print("X.shape: {}, Y.shape: {}".format(X.shape, Y.shape))
-        X = self.scaler.transform(X)
-        if self.config["model"] == "LSTM":
-            X = X.reshape((X.shape[0], self.config["window_length"], X.shape[1] // self.config["window_length"]))
-
         return X, Y
 
     def get_result_json(self):
-        df = self.strategy.trade_df
-        result = {
-            "end_capital": round(self.strategy.capital, 2),
-            "number_of_trades": len(df),
-            "winning_trades": len(df[df["trade_verdict"] == "WIN"]),
-            "losing_trades": len(df[df["trade_verdict"] == "LOSS"]),
-            "win_%": round(
-                len(df[df["trade_verdict"] == "WIN"]) / len(df), 4),
-            "profit_loss_mean_ratio": round(abs(
-                df[df["trade_verdict"] == "WIN"]["profit_percentage"].mean() / df[df["trade_verdict"] == "LOSS"][
-                    "profit_percentage"].mean()), 4),
-            "mean_loss": round(df[df["trade_verdict"] == "LOSS"]["profit_percentage"].mean(), 4),
-            "mean_profit": round(df[df["trade_verdict"] == "WIN"]["profit_percentage"].mean(), 4),
-            "model_end_trade_%": round(len(df[df["end_reason"] == "ml_model"]) / len(df) * 100, 4),
-            "tp_hit_%": round(len(df[df["end_reason"] == "tp_hit"]) / len(df) * 100, 4),
-            "sl_hit_%": round(len(df[df["end_reason"] == "sl_hit"]) / len(df) * 100, 4),
-            "ttl_hit_%": round(len(df[df["end_reason"] == "ttl_hit"]) / len(df) * 100, 4),
-            "avg_trade_len": int(df["trade_duration"].mean()),
-            "total_fees_usd": round(df["total_fee"].sum(), 4),
-            "total_win_usd": round(df[df["trade_verdict"] == "WIN"]["profit"].sum(), 4),
-            "total_loss_and_fees_usd": round(df[df["trade_verdict"] == "LOSS"]["profit"].sum(), 4),
-            "run_time": self.duration,
-            "max_drawdown": df["max_drawdown"].max(),
-            "max_drawdown_winning_trade": df[df["trade_verdict"] == "WIN"]["max_drawdown"].max(),
-            "highest_possible_win": df["highest_possible_win"].max(),
-            "highest_possible_win_losing_trade": df[df["trade_verdict"] == "LOSS"]["highest_possible_win"].max()
-        }
-
-        if self.config["params"].get("sl", None) is not None and self.config["params"].get("tp", None) is not None:
-            result["R_R"] = round(self.config["params"]["tp"] / self.config["params"]["sl"], 4)
-        else:
-            result["R_R"] = None
-
-        return result
+        times = self.get_minute_arrays()[0]
+        period = (times[0], times[-1]) if len(times) else None
+        return compute_result_json(self.strategy, self.config["params"], self.duration, period)
 
-    def load_closing_minute_data(self):
-        min_df = pd.read_csv("minute_close_prices.csv")
-        min_df.set_index("open_time", inplace=True)
-        min_df.index = pd.to_datetime(min_df.index)
-        return min_df
+    def load_closing_minute_data(self, start=None, end=None):
+        return read_table("minute_close_prices.csv", start, end)
@@ -0,0 +1,262 @@
+import argparse
+from copy import deepcopy
+import json
+import os
+import pickle
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import LogisticRegression
+from sklearn.preprocessing import MinMaxScaler
+
+from backtest import align_minutes, run_engine, compute_result_json
+from columnar import read_table
+from config import config_dict
+from indicators import resample_minutes, build_dataset
+from inference import ChunkedPredictor
+from strategy import Strategy
+from utils import extend_dataset_with_window_length, scaled_window_matrix
+
+MINUTES_PER_MONTH = 30 * 24 * 60
+RESULTS_DIR = "benchmarks"
+STARTUP_TARGET_S = 1.0  # seconds for a fresh interpreter to import the STARTUP_MODULES
+STARTUP_MODULES = ["cli", "backtest", "main_tuner"]
+HEAVY_MODULES = ["tensorflow", "pika", "sklearn", "scipy", "joblib", "numba"]  # loaded only by the runs that need them
+STARTUP_CODE = """import json, sys, time
+start_time = time.perf_counter()
+import {modules}
+seconds = time.perf_counter() - start_time
+print(json.dumps([seconds, sorted({{name.split(".")[0] for name in sys.modules}} & set({heavy}))]))
+"""
+
+
+def synthetic_minutes(months, seed=0, start="2020-01-01"):
+    """ Random walk minute candles, with the volatility of BTC minute closes. """
+    rng = np.random.default_rng(seed)
+    n = months * MINUTES_PER_MONTH
+    close = 10000 * np.exp(np.cumsum(rng.normal(0, 0.0008, n)))
+    open_price = np.concatenate([[close[0]], close[:-1]])
+    spread = close * np.abs(rng.normal(0, 0.0004, n))
+    return pd.DataFrame({
+        "open": open_price,
+        "high": np.maximum(open_price, close) + spread,
+        "low": np.minimum(open_price, close) - spread,
+        "close": close,
+    }, index=pd.date_range(start, periods=n, freq="1min", name="open_time"))
+
+
+def write_inputs(out_dir, months, timeframe, window_length, seed=0):
+    """
+    The files a backtest reads, made from synthetic data: minute close prices, the feature dataset, a scaler
+    fitted on the windowed features and a logistic regression, so nothing needs tensorflow or the network.
+    """
+    minutes = synthetic_minutes(months, seed)
+    minute_csv = os.path.join(out_dir, "minute_close_prices.csv")
+    minutes[["close"]].to_csv(minute_csv)
+    dataset, _ = build_dataset(resample_minutes(minutes, timeframe))
+    dataset_csv = os.path.join(out_dir, "dataset.csv")
+    dataset.to_csv(dataset_csv)
+
+    X, Y = extend_dataset_with_window_length(dataset.to_numpy()[:, 1:-1], dataset.to_numpy()[:, -1], window_length)
+    scaler = MinMaxScaler().fit(X)
+    sample = slice(0, min(len(X), 20000))
+    model = LogisticRegression(max_iter=200).fit(scaler.transform(X[sample]), Y[sample])
+    model_file = os.path.join(out_dir, "model.pickle")
+    with open(model_file, "wb") as fout:
+        pickle.dump(model, fout)
+    return minute_csv, dataset_csv, scaler, model_file
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure_startup(modules=STARTUP_MODULES, repeat=5, target=STARTUP_TARGET_S):
+    """
+    Import time of the modules in fresh interpreters (the fastest of repeat, with the whole process time) and
+    the HEAVY_MODULES they loaded. ok when under target and none was loaded.
+    """
+    code = STARTUP_CODE.format(modules=", ".join(modules), heavy=HEAVY_MODULES)
+    import_times = []
+    process_times = []
+    heavy = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+        process_times.append(time.perf_counter() - start_time)
+        seconds, heavy = json.loads(output.decode().strip().splitlines()[-1])
+        import_times.append(seconds)
+    return {
+        "modules": modules,
+        "import_seconds": round(min(import_times), 4),
+        "process_seconds": round(min(process_times), 4),
+        "heavy_modules": heavy,
+        "target_seconds": target,
+        "ok": min(import_times) <= target and not heavy,
+    }
+
+
+class Benchmark:
+    """
+    Times each stage repeat times (the first result is passed on to the next stages) and, with trace_memory,
+    runs it once more under tracemalloc for its peak allocated memory.
+    """
+    def __init__(self, repeat=1, trace_memory=True):
+        self.repeat = repeat
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+    def stage(self, name, fn, rows=None):
+        times = []
+        result = None
+        for i in range(self.repeat):
+            start_time = time.perf_counter()
+            value = fn()
+            times.append(time.perf_counter() - start_time)
+            if i == 0:
+                result = value
+        stats = {"seconds": round(float(np.mean(times)), 6), "seconds_min": round(min(times), 6)}
+        if self.trace_memory:
+            tracemalloc.start()
+            fn()
+            stats["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 3)
+            tracemalloc.stop()
+        if rows is not None:
+            stats["rows"] = int(rows)
+            stats["rows_per_s"] = round(rows / stats["seconds"], 1) if stats["seconds"] else None
+        self.stages[name] = stats
+        print("{:<20} {:>10.4f}s {}".format(name, stats["seconds"],
+                                           "{} MB".format(stats["peak_mb"]) if self.trace_memory else ""))
+        return result
+
+
+def run_benchmark(months, timeframe, window_length, repeat=1, trace_memory=True, seed=0):
+    cfg = deepcopy(config_dict)
+    cfg.update({"model": "logistic_regression", "timeframe": timeframe, "window_length": window_length,
+                "log_to_elk": False, "log_to_stdout": False, "run_name": "bench"})
+    cfg["params"].update({"tp": 0.01, "sl": 0.01, "ttl": 420})
+    bench = Benchmark(repeat, trace_memory)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start_time = time.perf_counter()
+        minute_csv, dataset_csv, scaler, cfg["model_file"] = write_inputs(tmp_dir, months, timeframe, window_length,
+                                                                         seed)
+        setup_seconds = time.perf_counter() - start_time
+
+        def load():
+            dataset = read_table(dataset_csv)
+            minutes = read_table(minute_csv, dataset.index[0], dataset.index[-1] + pd.Timedelta(minutes=1))
+            return dataset, minutes
+        dataset, minutes = bench.stage("csv_load", load, rows=months * MINUTES_PER_MONTH)
+        features = dataset.to_numpy()[:, 1:-1]
+        labels = dataset.to_numpy()[:, -1]
+        n_windows = len(features) - window_length + 1
+
+        X, _ = bench.stage("windowing", lambda: extend_dataset_with_window_length(features, labels, window_length),
+                           rows=n_windows)
+        bench.stage("scaler_transform", lambda: scaler.transform(X), rows=n_windows)
+        X = bench.stage("scaled_windows", lambda: scaled_window_matrix(features, window_length, scaler), rows=n_windows)
+
+        strategy = Strategy(cfg)
+        model, model_type = strategy.model, strategy.model_type
+        predictions = bench.stage("prediction", lambda: ChunkedPredictor(model, model_type).predict_windows(X),
+                                  rows=n_windows)
+        del X
+        bench.stage("chunked_prediction",
+                    lambda: ChunkedPredictor(model, model_type).predict(features, window_length, scaler),
+                    rows=n_windows)
+
+        times, prices, signal_idx = bench.stage(
+            "alignment", lambda: align_minutes(minutes, dataset.index[window_length-1:], timeframe), rows=len(minutes))
+
+        def backtest(engine):
+            strategy = Strategy(cfg, predictions)
+            run_engine(strategy, engine, times, prices, signal_idx)
+            strategy.end()
+            return strategy
+        strategy = bench.stage("notify_loop", lambda: backtest("loop"), rows=len(times))
+        bench.stage("vectorized_engine", lambda: backtest("vectorized"), rows=len(times))
+        bench.stage("kernel_engine", lambda: backtest("kernel"), rows=len(times))
+
+        period = (times[0], times[-1])
+        bench.stage("result_json", lambda: compute_result_json(strategy, cfg["params"], 0, period),
+                    rows=len(strategy.trade_df))
+        trades_csv = os.path.join(tmp_dir, "trades.csv")
+        bench.stage("trade_csv_write", lambda: strategy.trade_df.to_csv(trades_csv), rows=len(strategy.trade_df))
+
+    return {
+        "commit": git_commit(),
+        "time": pd.Timestamp.now().isoformat(),
+        "machine": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "params": {"months": months, "timeframe": timeframe, "window_length": window_length, "repeat": repeat,
+                   "seed": seed, "minutes": months * MINUTES_PER_MONTH, "windows": n_windows,
+                   "trades": len(strategy.trade_df)},
+        "setup_seconds": round(setup_seconds, 3),
+        "stages": bench.stages,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def compare(old_results: dict, new_results: dict):
+    """ new / old seconds of the stages in both results, > 1 is slower. """
+    return {name: round(stats["seconds"] / old_results["stages"][name]["seconds"], 3)
+            for name, stats in new_results["stages"].items()
+            if name in old_results["stages"] and old_results["stages"][name]["seconds"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times the backtest stages on synthetic minute data")
+    parser.add_argument("--months", type=int, default=1, help="minute data length, 1 to 60")
+    parser.add_argument("--timeframe", type=int, default=config_dict["timeframe"])
+    parser.add_argument("--window-length", type=int, default=config_dict["window_length"])
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc run of every stage")
+    parser.add_argument("--output", default=None, help="results json, default benchmarks/bench_<commit>_<months>m.json")
+    parser.add_argument("--compare", default=None, help="a previous results json to compare the stage times with")
+    parser.add_argument("--startup-only", action="store_true", help="only check the startup time")
+    parser.add_argument("--startup-target", type=float, default=STARTUP_TARGET_S, help="seconds")
+    args = parser.parse_args()
+
+    startup = measure_startup(target=args.startup_target)
+    print("startup: import {}s, process {}s, heavy modules {}, target {}s".format(
+        startup["import_seconds"], startup["process_seconds"], startup["heavy_modules"], startup["target_seconds"]))
+    if args.startup_only:
+        if not startup["ok"]:
+            raise SystemExit("startup target missed")
+        return
+
+    results = run_benchmark(args.months, args.timeframe, args.window_length, args.repeat, not args.no_memory)
+    results["startup"] = startup
+    output = args.output or os.path.join(RESULTS_DIR, "bench_{}_{}m.json".format(results["commit"] or "local",
+                                                                                 args.months))
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as fout:
+        fout.write(json.dumps(results, indent=4))
+    print("Saved to {}. Max RSS {} MB".format(output, results["max_rss_mb"]))
+
+    if args.compare:
+        with open(args.compare) as fin:
+            print("new/old time: {}".format(compare(json.load(fin), results)))
+    if not startup["ok"]:
+        raise SystemExit("startup target missed")
+
+
+if __name__ == "__main__":
+    main()
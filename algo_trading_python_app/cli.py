@@ -0,0 +1,125 @@
+import argparse
+import json
+import os
+import sys
+
+from config import config_dict
+
+# the modules of every command are imported in its handler, "python cli.py --help" only loads argparse and config
+
+
+def parse_value(text):
+    """ JSON values (numbers, true/false, null, lists...), anything else is kept as a string. """
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def apply_overrides(config: dict, overrides: list):
+    """ Sets the "key.path=value" overrides in config, e.g. params.tp=0.03, params.ttl=null or model=NN. """
+    for override in overrides:
+        if "=" not in override:
+            raise Exception("override {} is not key.path=value".format(override))
+        path, text = override.split("=", 1)
+        keys = path.split(".")
+        section = config
+        for key in keys[:-1]:
+            if not isinstance(section.get(key, None), dict):
+                raise Exception("unknown config section {} in {}".format(key, path))
+            section = section[key]
+        section[keys[-1]] = parse_value(text)
+    return config
+
+
+def backtest_command(args):
+    from backtest import Backtester, print_results
+    from prediction_cache import PredictionCache
+
+    if args.clear_cache:
+        PredictionCache(**config_dict["cache"]).clear()
+    if args.no_cache:
+        config_dict["cache"]["enabled"] = False
+
+    tester = Backtester(config_dict)
+    tester.init_strategy(config_dict)
+    tester.start()
+    print_results(config_dict, tester.results_json)
+    print("elapsed: ", tester.duration)
+
+
+def tune_command(args):
+    import main_tuner
+
+    if args.search is not None:
+        main_tuner.SEARCH = args.search
+    if args.workers is not None:
+        main_tuner.WORKERS = args.workers
+    if args.top_k is not None:
+        main_tuner.TOP_K = args.top_k
+    main_tuner.main()
+
+
+def cache_command(args):
+    from prediction_cache import PredictionCache
+
+    prediction_cache = PredictionCache(**config_dict["cache"])
+    if args.action == "clear":
+        prediction_cache.clear()
+        print("Cleared {}".format(config_dict["cache"]["cache_dir"]))
+        return
+    entries = prediction_cache.entries()
+    total_size = 0
+    for path in entries:
+        total_size += os.path.getsize(path)
+        print("{} {:.1f} MB".format(path, os.path.getsize(path) / 1024 / 1024))
+    print("{} entries, {:.1f} MB in {}".format(len(entries), total_size / 1024 / 1024,
+                                             config_dict["cache"]["cache_dir"]))
+
+
+def bench_command(args):
+    import bench
+
+    sys.argv = ["bench.py"] + args.extra
+    bench.main()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Backtests, tuning, prediction cache and benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_command(name, handler, help_text):
+        command = subparsers.add_parser(name, help=help_text)
+        command.add_argument("--set", dest="overrides", action="append", default=[], metavar="KEY.PATH=VALUE",
+                             help="override a config.py value, JSON parsed, e.g. --set params.tp=0.03 (repeatable)")
+        command.set_defaults(handler=handler)
+        return command
+
+    command = add_command("backtest", backtest_command, "backtest config.py")
+    command.add_argument("--no-cache", action="store_true", help="recompute the predictions, don't read or write the cache")
+    command.add_argument("--clear-cache", action="store_true", help="delete the cached predictions before running")
+
+    command = add_command("tune", tune_command, "tp/sl/ttl tuning (main_tuner.py)")
+    command.add_argument("--search", choices=["replay", "path_stats", "halving", "bayesian"], default=None)
+    command.add_argument("--workers", type=int, default=None)
+    command.add_argument("--top-k", type=int, default=None, help="best searched combinations backtested")
+
+    command = add_command("cache", cache_command, "prediction cache entries")
+    command.add_argument("action", choices=["info", "clear"], nargs="?", default="info")
+
+    add_command("bench", bench_command, "stage and startup benchmarks, the other arguments go to bench.py")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args, extra = parser.parse_known_args(argv)
+    args.extra = extra
+    if args.extra and args.command != "bench":
+        parser.error("unrecognized arguments: {}".format(" ".join(args.extra)))
+    apply_overrides(config_dict, args.overrides)
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
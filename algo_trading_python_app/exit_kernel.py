@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+
+from trade import END_REASONS
+from vectorized_engine import VectorizedEngine, signal_masks
+
+BACKEND = "auto"  # "auto" compiles the kernel with numba when it is installed, "numba" requires it, "python" never
+ML_MODEL, TP_HIT, SL_HIT, TTL_HIT, TRAILING_STOP_HIT, BREAK_EVEN_HIT = [
+    END_REASONS.index(reason) for reason in ["ml_model", "tp_hit", "sl_hit", "ttl_hit", "trailing_stop_hit",
+                                             "break_even_hit"]]
+
+
+def scan_positions(times, prices, buy, sell, tp, sl, ttl_ns, trailing_stop, break_even,
+                   entries, exits, reasons, lowest, highest):
+    """
+    The position state machine of Strategy.notify in one loop over the minutes: buy on a buy signal when out of
+    a position, sell on a sell signal, otherwise check TP, SL, trailing stop, break-even and TTL in this order.
+    tp, sl, trailing_stop, break_even and ttl_ns are 0 when off. The closed trades are written to the out
+    arrays (entry and exit minute, END_REASONS index, lowest and highest price), returns their count.
+    Runs as it is on lists, or compiled by numba on arrays.
+    """
+    count = 0
+    in_position = False
+    entry = 0
+    entry_time = 0
+    entry_price = 0.0
+    tp_level = 0.0
+    sl_level = 0.0
+    break_even_level = 0.0
+    low = 0.0
+    high = 0.0
+    for i in range(len(prices)):
+        price = prices[i]
+        if in_position:
+            if price < low:
+                low = price
+            if price > high:
+                high = price
+            reason = -1
+            if sell[i]:
+                reason = ML_MODEL
+            elif tp and tp_level <= price:
+                reason = TP_HIT
+            elif sl and price < sl_level:
+                reason = SL_HIT
+            elif trailing_stop and price < high - high * trailing_stop:
+                reason = TRAILING_STOP_HIT
+            # armed once the price went break_even above the entry, not on the minute it does (price > entry)
+            elif break_even and high >= break_even_level and price <= entry_price:
+                reason = BREAK_EVEN_HIT
+            elif ttl_ns and times[i] - entry_time >= ttl_ns:
+                reason = TTL_HIT
+            if reason >= 0:
+                entries[count] = entry
+                exits[count] = i
+                reasons[count] = reason
+                lowest[count] = low
+                highest[count] = high
+                count += 1
+                in_position = False
+        elif buy[i]:
+            in_position = True
+            entry = i
+            entry_time = times[i]
+            entry_price = price
+            tp_level = entry_price + entry_price * tp
+            sl_level = entry_price - entry_price * sl
+            break_even_level = entry_price + entry_price * break_even
+            low = price
+            high = price
+    return count
+
+
+_kernels = {}
+
+
+def get_kernel(backend=BACKEND):
+    """ (kernel, compiled). numba is imported on the first call only, runs of the other engines never load it. """
+    if backend not in _kernels:
+        if backend not in ["auto", "numba", "python"]:
+            raise Exception("unknown kernel backend {}".format(backend))
+        _kernels[backend] = (scan_positions, False)
+        if backend != "python":
+            try:
+                import numba
+                _kernels[backend] = (numba.njit(cache=True, nogil=True)(scan_positions), True)
+            except ImportError:
+                if backend == "numba":
+                    raise Exception("the numba kernel backend needs numba installed")
+    return _kernels[backend]
+
+
+def run_kernel(times, prices, buy, sell, tp=None, sl=None, ttl=None, trailing_stop=None, break_even=None,
+               backend=BACKEND):
+    """ Entry minutes, exit minutes, end reasons, lowest and highest prices of the closed trades. """
+    kernel, compiled = get_kernel(backend)
+    capacity = int(np.count_nonzero(buy))
+    entries = np.empty(capacity, dtype=np.int64)
+    exits = np.empty(capacity, dtype=np.int64)
+    reasons = np.empty(capacity, dtype=np.int8)
+    lowest = np.empty(capacity, dtype=np.float64)
+    highest = np.empty(capacity, dtype=np.float64)
+    inputs = [np.asarray(times, dtype=np.int64), np.asarray(prices, dtype=np.float64), np.asarray(buy, dtype=bool),
+              np.asarray(sell, dtype=bool)]
+    if not compiled:
+        # python ints, floats and bools are much faster to index one at a time than numpy scalars
+        inputs = [values.tolist() for values in inputs]
+    count = kernel(*inputs, float(tp or 0), float(sl or 0), pd.Timedelta(minutes=ttl).value if ttl else 0,
+                   float(trailing_stop or 0), float(break_even or 0), entries, exits, reasons, lowest, highest)
+    return entries[:count], exits[:count], reasons[:count], lowest[:count], highest[:count]
+
+
+class KernelEngine(VectorizedEngine):
+    """
+    Same trades as calling Strategy.notify for every minute, with the minutes scanned by scan_positions.
+    Strategy.buy/sell are only called once per trade.
+    """
+    def __init__(self, strategy, times, prices, signal_idx, backend=BACKEND):
+        self.strategy = strategy
+        self.times = np.asarray(times, dtype=np.int64)
+        self.prices = np.asarray(prices, dtype=np.float64)
+        self.signal_idx = np.asarray(signal_idx, dtype=np.int64)
+        self.buy, self.sell, self.minute_prediction = signal_masks(strategy.predictions, self.signal_idx,
+                                                                   strategy.classes)
+        self.backend = backend
+
+    def run(self):
+        if self.strategy.logger.to_elk:
+            self.log_predictions()
+
+        strategy = self.strategy
+        trades = run_kernel(self.times, self.prices, self.buy, self.sell, strategy.tp, strategy.sl, strategy.ttl,
+                            strategy.trailing_stop, strategy.break_even, self.backend)
+        for entry, exit_idx, reason, low, high in zip(*[values.tolist() for values in trades]):
+            self.move_to(entry)
+            strategy.buy()
+            strategy.trade.update_lowest_price(low)
+            strategy.trade.update_lowest_price(high)
+            self.move_to(exit_idx)
+            strategy.sell(tp_hit=reason == TP_HIT, sl_hit=reason == SL_HIT, ttl_hit=reason == TTL_HIT,
+                          trailing_stop_hit=reason == TRAILING_STOP_HIT, break_even_hit=reason == BREAK_EVEN_HIT)
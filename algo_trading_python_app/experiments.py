@@ -0,0 +1,189 @@
+from copy import deepcopy
+from datetime import timedelta
+import itertools
+import os
+import time
+
+import joblib
+import pandas as pd
+
+from backtest import align_minutes
+from columnar import read_table
+from inference import predict_shared
+from config import MODEL_FILE, config_dict
+from prediction_cache import PredictionCache
+from strategy import Strategy
+from sweep import SweepExecutor, ResultsCsvWriter
+
+# model setups to compare, each with the files it was trained on
+SETUPS = [
+    {"model": "NN", "timeframe": 60, "window_length": 30, "dataset": "test_df_60minutes_1_candles_2_class.csv",
+     "scaler": "nn_scaler_60minutes_30window.save", "model_file": "nn_2__60minutes_30window.h5"},
+    # {"model": "LSTM", "timeframe": 60, "window_length": 30, "dataset": "test_df_60minutes_1_candles_2_class.csv",
+    #  "scaler": "nn_scaler_60minutes_30window.save", "model_file": "lstm_4__60minutes_30window.h5"},
+    # {"model": "logistic_regression", "timeframe": 60, "window_length": 30,
+    #  "dataset": "test_df_60minutes_1_candles_2_class.csv", "scaler": "nn_scaler_60minutes_30window.save",
+    #  "model_file": "logistic_regression_attempt_2_balanced.pickle"},
+]
+# strategy params tried with every setup
+TUNE_TP = [None, 0.01, 0.05]
+TUNE_SL = [None, 0.01, 0.05]
+TUNE_TTL = [None, 420]
+
+RUN_NAME_PREFIX = "experiment_{}"
+WORKERS = os.cpu_count() or 1
+CHUNKSIZE = 1
+MINUTE_FILE = "minute_close_prices.csv"
+
+
+def experiment_config(setup: dict, params: dict, run_name):
+    cfg = deepcopy(config_dict)
+    cfg.update(deepcopy(setup))
+    cfg["params"].update(params)
+    cfg["log_to_elk"] = False
+    cfg["run_name"] = run_name
+    return cfg
+
+
+def stage_keys(cfg: dict):
+    """
+    The inputs each expensive stage depends on. Configurations with the same key share the result of the stage:
+    the scaled windows depend on the dataset, the scaler and the window; the predictions also on the model and
+    its class threshold; the minute alignment on the dataset, the window and the timeframe.
+    """
+    return {
+        "dataset": cfg["dataset"],
+        "windows": (cfg["dataset"], cfg["scaler"], cfg["window_length"]),
+        "predictions": (cfg["dataset"], cfg["scaler"], cfg["window_length"], cfg["model"],
+                        cfg.get("model_file", MODEL_FILE[cfg["model"]]), cfg["classes"],
+                        cfg.get("inference", {}).get("threshold", 0.5)),
+        "alignment": (cfg["dataset"], cfg["window_length"], cfg["timeframe"]),
+    }
+
+
+class ExperimentPlan:
+    """ Expands the setups and the strategy params into jobs and groups them by the stages they share. """
+    def __init__(self, setups: list, param_grid: dict):
+        self.jobs = []
+        self.configs = []
+        self.keys = []
+        self.param_names = list(param_grid)
+        for setup in setups:
+            for values in itertools.product(*[param_grid[name] for name in self.param_names]):
+                params = dict(zip(self.param_names, values))
+                run_name = RUN_NAME_PREFIX.format(len(self.jobs))
+                cfg = experiment_config(setup, params, run_name)
+                job = {"model": cfg["model"], "timeframe": cfg["timeframe"], "window_length": cfg["window_length"]}
+                job.update(params)
+                job["run_name"] = run_name
+                self.jobs.append(job)
+                self.configs.append(cfg)
+                self.keys.append(stage_keys(cfg))
+
+    def unique(self, stage):
+        """ The first config of every distinct key of the stage, in job order. """
+        configs = {}
+        for cfg, keys in zip(self.configs, self.keys):
+            configs.setdefault(keys[stage], cfg)
+        return configs
+
+    def summary(self):
+        return "{} jobs, {} datasets, {} window sets, {} prediction sets, {} minute alignments".format(
+            len(self.jobs), *[len(self.unique(stage)) for stage in ["dataset", "windows", "predictions", "alignment"]])
+
+
+class ExperimentRunner:
+    """
+    Runs an ExperimentPlan. The minute close prices are read once for all the datasets, each dataset, window set,
+    prediction set and minute alignment is computed once for all the jobs sharing it, then every backtest runs in
+    the SweepExecutor process pool and the results go to a single table. The scaled windows are built chunk by
+    chunk from the feature rows and every chunk is predicted by all the models of the window set, the windowed X
+    of a setup is never built.
+    """
+    def __init__(self, plan: ExperimentPlan, workers=WORKERS, chunksize=CHUNKSIZE):
+        self.plan = plan
+        self.workers = workers
+        self.chunksize = chunksize
+        self.datasets = {}
+        self.minutes = None
+        self.predictions = {}
+        self.alignments = {}
+        self.stage_times = {}
+
+    def __timed(self, stage, start_time):
+        self.stage_times[stage] = self.stage_times.get(stage, 0) + time.time() - start_time
+
+    def load_datasets(self):
+        start_time = time.time()
+        for dataset in self.plan.unique("dataset"):
+            self.datasets[dataset] = read_table(dataset)
+        start = min(df.index[0] for df in self.datasets.values())
+        end = max(df.index[-1] for df in self.datasets.values()) + timedelta(minutes=1)
+        self.minutes = read_table(MINUTE_FILE, start, end)
+        self.__timed("load", start_time)
+
+    def compute_predictions(self):
+        scalers = {}
+        missing = {}
+        for key, cfg in self.plan.unique("predictions").items():
+            cache = PredictionCache(**cfg.get("cache", {"enabled": False}))
+            cache_key = cache.key(cfg) if cache.enabled else None
+            predictions = cache.load(cache_key, "predictions")
+            if predictions is None:
+                missing.setdefault(stage_keys(cfg)["windows"], []).append((key, cfg, cache, cache_key))
+            else:
+                self.predictions[key] = predictions
+
+        for (dataset, scaler, window_length), setups in missing.items():
+            start_time = time.time()
+            if scaler not in scalers:
+                scalers[scaler] = joblib.load(scaler)
+            features = self.datasets[dataset].drop(columns=["close"]).to_numpy()[:, :-1]
+            predictors = [Strategy(cfg).predictor() for _, cfg, _, _ in setups]
+            outs = predict_shared(predictors, features, window_length, scalers[scaler])
+            for (key, _, cache, cache_key), predictions in zip(setups, outs):
+                cache.save(cache_key, "predictions", predictions)
+                self.predictions[key] = predictions
+            self.__timed("predictions", start_time)
+        self.predictions = {key: self.predictions[key] for key in self.plan.unique("predictions")}
+
+    def align(self):
+        start_time = time.time()
+        for key, cfg in self.plan.unique("alignment").items():
+            bar_times = self.datasets[cfg["dataset"]].index[cfg["window_length"]-1:]
+            self.alignments[key] = align_minutes(self.minutes, bar_times, cfg["timeframe"])
+        self.__timed("alignment", start_time)
+
+    def run(self, output_file):
+        print(self.plan.summary())
+        self.load_datasets()
+        self.compute_predictions()
+        self.align()
+        executor = SweepExecutor(workers=self.workers, chunksize=self.chunksize)
+        prediction_ids = {key: str(i) for i, key in enumerate(self.predictions)}
+        alignment_ids = {key: str(i) for i, key in enumerate(self.alignments)}
+        job_arrays = []
+        for keys in self.plan.keys:
+            job_arrays.append(executor.share(self.predictions[keys["predictions"]],
+                                             *self.alignments[keys["alignment"]],
+                                             predictions_key=prediction_ids[keys["predictions"]],
+                                             alignment_key=alignment_ids[keys["alignment"]]))
+        writer = ResultsCsvWriter(output_file, column_dtypes={
+            name: pd.Series([job[name] for job in self.plan.jobs]).dtype for name in self.plan.param_names})
+        start_time = time.time()
+        executor.run(self.plan.jobs, self.plan.configs, writer, job_arrays)
+        self.__timed("backtests", start_time)
+        print("stage times: {}".format({stage: round(t, 2) for stage, t in self.stage_times.items()}))
+        return pd.DataFrame(self.plan.jobs)
+
+
+def main():
+    t = time.time()
+    plan = ExperimentPlan(SETUPS, {"tp": TUNE_TP, "sl": TUNE_SL, "ttl": TUNE_TTL})
+    output_file = "experiments_{}_setups_{}_scenarios.csv".format(len(SETUPS), len(plan.jobs))
+    ExperimentRunner(plan).run(output_file)
+    print("time: {}".format(time.time() - t))
+
+
+if __name__ == "__main__":
+    main()
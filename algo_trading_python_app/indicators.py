@@ -0,0 +1,342 @@
+"""
+The features of data_preparation.ipynb (pandas_ta 0.2.45b definitions) computed one candle at a time, so new
+candles can be appended without recomputing the history.
+"""
+import math
+import sys
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+NAN = float("nan")
+
+FEATURE_COLUMNS = ["sma5_diff", "sma8_diff", "sma13_diff", "sma21_diff", "ema5_diff", "ema8_diff", "ema13_diff",
+                   "ema21_diff", "MACD_12_26_9", "MACDh_12_26_9", "MACDs_12_26_9", "RSI_14", "ROC_1",
+                   "STOCHk_14_3_3", "STOCHd_14_3_3", "CCI_14_0.015", "ATRr_14", "WILLR_14", "AROOND_14", "AROONU_14",
+                   "AROONOSC_14", "dema10_diff", "BBB_5_2.0", "BBU_5_2.0_diff", "BBL_5_2.0_diff", "BBM_5_2.0_diff",
+                   "RVI_14"]
+WARMUP_CANDLES = 33  # rows dropped by the notebook, the first one with every feature is the 34th
+
+
+def isnan(value):
+    return value != value
+
+
+def div(a, b):
+    """ a / b with numpy semantics (inf or nan) instead of ZeroDivisionError. """
+    if b == 0:
+        if a == 0 or isnan(a):
+            return NAN
+        return math.copysign(math.inf, a)
+    return a / b
+
+
+def non_zero_range(high, low):
+    diff = high - low
+    return diff if diff != 0 else sys.float_info.epsilon
+
+
+class Window:
+    """ The last length values, ignoring the values before the first valid one. """
+    def __init__(self, length):
+        self.length = length
+        self.values = deque(maxlen=length)
+
+    def update(self, value):
+        if len(self.values) or not isnan(value):
+            self.values.append(value)
+
+    def full(self):
+        return len(self.values) == self.length
+
+    def mean(self):
+        return sum(self.values) / self.length if self.full() else NAN
+
+    def std(self, ddof=1):
+        if not self.full():
+            return NAN
+        mean = sum(self.values) / self.length
+        return math.sqrt(sum((value - mean) ** 2 for value in self.values) / (self.length - ddof))
+
+    def min(self):
+        return min(self.values) if self.full() else NAN
+
+    def max(self):
+        return max(self.values) if self.full() else NAN
+
+
+class SMA:
+    def __init__(self, length):
+        self.window = Window(length)
+
+    def update(self, value):
+        self.window.update(value)
+        return self.window.mean()
+
+
+class EMA:
+    """
+    pandas_ta ema: the mean of the first length inputs is the first value, then ewm(span=length, adjust=False).
+    from_first_valid starts counting the inputs at the first valid one (ema of series.loc[first_valid_index():]).
+    """
+    def __init__(self, length, from_first_valid=False):
+        self.length = length
+        self.alpha = 2 / (length + 1)
+        self.from_first_valid = from_first_valid
+        self.seen = 0
+        self.seed_sum = 0.0
+        self.seed_count = 0
+        self.value = NAN
+
+    def update(self, value):
+        if self.seen < self.length:
+            if self.from_first_valid and not self.seen and isnan(value):
+                return NAN
+            self.seen += 1
+            if not isnan(value):
+                self.seed_sum += value
+                self.seed_count += 1
+            if self.seen == self.length and self.seed_count:
+                self.value = self.seed_sum / self.seed_count
+            return self.value
+        if isnan(self.value):
+            self.value = value
+        elif not isnan(value):
+            self.value = (1 - self.alpha) * self.value + self.alpha * value
+        return self.value
+
+
+class RMA:
+    """ pandas_ta rma: ewm(alpha=1/length, min_periods=length).mean(), with pandas' adjusted weights. """
+    def __init__(self, length):
+        self.length = length
+        self.old_weight_factor = 1 - 1 / length
+        self.old_weight = 1.0
+        self.observations = 0
+        self.value = NAN
+
+    def update(self, value):
+        observed = not isnan(value)
+        if not isnan(self.value):
+            self.old_weight *= self.old_weight_factor
+            if observed:
+                if self.value != value:
+                    self.value = (self.old_weight * self.value + value) / (self.old_weight + 1)
+                self.old_weight += 1
+        elif observed:
+            self.value = value
+        if observed:
+            self.observations += 1
+        return self.value if self.observations >= self.length else NAN
+
+
+class FeatureEngine:
+    """
+    Streaming state of every indicator of the dataset. update() takes the next OHLC candle of the timeframe and
+    returns its feature row, in FEATURE_COLUMNS order (NaN while an indicator is warming up).
+    """
+    def __init__(self):
+        self.prev_close = NAN
+        self.sma = [SMA(length) for length in (5, 8, 13, 21)]
+        self.ema = [EMA(length) for length in (5, 8, 13, 21)]
+        self.macd_fast = EMA(12)
+        self.macd_slow = EMA(26)
+        self.macd_signal = EMA(9, from_first_valid=True)
+        self.rsi_positive = RMA(14)
+        self.rsi_negative = RMA(14)
+        self.stoch_low = Window(14)
+        self.stoch_high = Window(14)
+        self.stoch_k = SMA(3)
+        self.stoch_d = SMA(3)
+        self.cci_typical = Window(14)
+        self.cci = NAN
+        self.atr = RMA(14)
+        self.willr_low = Window(14)
+        self.willr_high = Window(14)
+        self.aroon_high = deque(maxlen=15)
+        self.aroon_low = deque(maxlen=15)
+        self.dema_ema1 = EMA(10)
+        self.dema_ema2 = EMA(10)
+        self.bbands = Window(5)
+        self.rvi_std = Window(14)
+        self.rvi_positive = EMA(14)
+        self.rvi_negative = EMA(14)
+        # build_dataset state: warmup rows still to drop, the last row (its output_class needs the next close)
+        # and the last returned row, carried by ffill
+        self.warmup_left = WARMUP_CANDLES
+        self.pending = None
+        self.filled = None
+
+    def update(self, high, low, close):
+        prev_close = self.prev_close
+        self.prev_close = close
+        row = []
+
+        for sma in self.sma:
+            row.append((close - sma.update(close)) / close)
+        for ema in self.ema:
+            row.append((close - ema.update(close)) / close)
+
+        macd = self.macd_fast.update(close) - self.macd_slow.update(close)
+        signal = self.macd_signal.update(macd)
+        row.extend([macd, macd - signal, signal])
+
+        diff = close - prev_close
+        positive = self.rsi_positive.update(max(diff, 0.0) if not isnan(diff) else NAN)
+        negative = self.rsi_negative.update(min(diff, 0.0) if not isnan(diff) else NAN)
+        row.append(div(100 * positive, positive + abs(negative)))
+
+        row.append(div(100 * diff, prev_close))
+
+        self.stoch_low.update(low)
+        self.stoch_high.update(high)
+        lowest_low = self.stoch_low.min()
+        stoch = div(100 * (close - lowest_low), non_zero_range(self.stoch_high.max(), lowest_low))
+        stoch_k = self.stoch_k.update(stoch)
+        row.extend([stoch_k, self.stoch_d.update(stoch_k)])
+
+        typical_price = (high + low + close) / 3
+        self.cci_typical.update(typical_price)
+        if self.cci_typical.full():
+            mean = self.cci_typical.mean()
+            mad = sum(abs(value - mean) for value in self.cci_typical.values) / self.cci_typical.length
+            cci = div(typical_price - mean, 0.015 * mad)
+            if math.isfinite(cci):  # the notebook uses fill_method="ffill" with inf as na
+                self.cci = cci
+        row.append(self.cci)
+
+        true_range = NAN
+        if not isnan(prev_close):
+            true_range = max(abs(non_zero_range(high, low)), abs(high - prev_close), abs(prev_close - low))
+        row.append(self.atr.update(true_range))
+
+        self.willr_low.update(low)
+        self.willr_high.update(high)
+        lowest_low = self.willr_low.min()
+        row.append(100 * (div(close - lowest_low, self.willr_high.max() - lowest_low) - 1))
+
+        self.aroon_high.append(high)
+        self.aroon_low.append(low)
+        if len(self.aroon_high) >= 14:
+            # candles since the most recent highest high / lowest low
+            highs = list(self.aroon_high)
+            lows = list(self.aroon_low)
+            since_high = len(highs) - 1 - max(range(len(highs)), key=lambda i: (highs[i], i))
+            since_low = len(lows) - 1 - min(range(len(lows)), key=lambda i: (lows[i], -i))
+            aroon_up = 100 * (1 - since_high / 14)
+            aroon_down = 100 * (1 - since_low / 14)
+            row.extend([aroon_down, aroon_up, aroon_up - aroon_down])
+        else:
+            row.extend([NAN, NAN, NAN])
+
+        ema1 = self.dema_ema1.update(close)
+        ema2 = self.dema_ema2.update(ema1)
+        row.append((close - (2 * ema1 - ema2)) / close)
+
+        self.bbands.update(close)
+        middle = self.bbands.mean()
+        deviation = 2 * self.bbands.std()
+        upper = middle + deviation
+        lower = middle - deviation
+        row.extend([div(100 * (upper - lower), middle), (close - upper) / close, (close - lower) / close,
+                    (close - middle) / close])
+
+        self.rvi_std.update(close)
+        std = self.rvi_std.std()
+        up = 1.0 if not isnan(diff) and diff > 0 else 0.0
+        down = 1.0 if not isnan(diff) and diff < 0 else 0.0
+        positive = self.rvi_positive.update(up * std)
+        negative = self.rvi_negative.update(down * std)
+        row.append(div(100 * positive, positive + negative))
+        return row
+
+    def update_many(self, high, low, close):
+        return np.array([self.update(h, l, c) for h, l, c in zip(high, low, close)],
+                        dtype=np.float64).reshape(-1, len(FEATURE_COLUMNS))
+
+
+def fill_minute_gaps(minute_df: pd.DataFrame):
+    """ Missing minutes are added and linearly interpolated, like the notebook does. """
+    full_index = pd.date_range(minute_df.index[0], minute_df.index[-1], freq="1min")
+    return minute_df.reindex(full_index).interpolate()
+
+
+def resample_minutes(minute_df: pd.DataFrame, minutes):
+    """
+    OHLC candles of `minutes` minutes from gap-free minute candles, grouped by position from the first minute
+    (same as the notebook's merge_minutes). An incomplete last candle is dropped.
+    """
+    n = len(minute_df) // minutes * minutes
+    groups = lambda column: minute_df[column].to_numpy()[:n].reshape(-1, minutes)
+    return pd.DataFrame({
+        "open": groups("open")[:, 0],
+        "low": groups("low").min(axis=1),
+        "high": groups("high").max(axis=1),
+        "close": groups("close")[:, -1],
+    }, index=pd.Index(minute_df.index[:n:minutes], name="open_time"))
+
+
+class CandleAggregator:
+    """ Streaming resample_minutes: returns the (open_time, open, high, low, close) candle when it is complete. """
+    def __init__(self, minutes):
+        self.minutes = minutes
+        self.count = 0
+        self.candle = None
+
+    def update(self, open_time, open_price, high, low, close):
+        if self.count == 0:
+            self.candle = [open_time, open_price, high, low, close]
+        else:
+            self.candle[2] = max(self.candle[2], high)
+            self.candle[3] = min(self.candle[3], low)
+            self.candle[4] = close
+        self.count += 1
+        if self.count == self.minutes:
+            self.count = 0
+            return tuple(self.candle)
+        return None
+
+
+def output_classes(close, binary=True, threshold=0.15):
+    """ Class of each candle from the ROC_1 of the next candle: 0 buy, 1 sell (binary) or 0 buy, 1 hold, 2 sell. """
+    close = np.asarray(close, dtype=np.float64)
+    next_roc = np.full(len(close), np.nan)
+    next_roc[:-1] = 100 * (close[1:] - close[:-1]) / close[:-1]
+    if binary:
+        classes = np.where(next_roc < 0, 1.0, 0.0)
+    else:
+        classes = np.where(next_roc < -threshold, 2.0, np.where(next_roc > threshold, 0.0, 1.0))
+    classes[np.isnan(next_roc)] = np.nan
+    return classes
+
+
+def build_dataset(candles: pd.DataFrame, binary=True, engine: FeatureEngine = None):
+    """
+    The dataset csv layout (close, features, output_class) from OHLC candles. Pass the engine of a previous
+    call to append new candles without recomputing the old ones: the rows of the chained calls are the same as
+    the rows of one call on all the candles. The last candle waits for the next call, its class needs the next close.
+    """
+    engine = engine or FeatureEngine()
+    features = engine.update_many(candles["high"].to_numpy(), candles["low"].to_numpy(), candles["close"].to_numpy())
+    df = pd.DataFrame(features, columns=FEATURE_COLUMNS, index=candles.index)
+    df.insert(0, "close", candles["close"].to_numpy())
+    df = df.replace([np.inf, -np.inf], np.nan)
+    if engine.pending is not None:
+        df = pd.concat([engine.pending, df])
+    if not len(df):
+        return df.assign(output_class=np.zeros(0)), engine
+    df["output_class"] = output_classes(df["close"], binary)
+    engine.pending = df.iloc[-1:, :-1]
+    df = df.iloc[:-1]
+    warmup = min(engine.warmup_left, len(df))
+    engine.warmup_left -= warmup
+    df = df.iloc[warmup:]
+    if engine.filled is not None:
+        df = pd.concat([engine.filled, df]).ffill().iloc[1:]
+    else:
+        df = df.ffill()
+    if len(df):
+        engine.filled = df.iloc[-1:]
+    df.index.name = "open_time"
+    return df, engine
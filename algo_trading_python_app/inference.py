@@ -0,0 +1,135 @@
+import time
+
+import numpy as np
+
+from utils import scaled_window_matrix
+
+KERAS_MODELS = ["NN", "LSTM"]
+BATCH_SIZES = [256, 1024, 4096, 16384]  # keras batch sizes tried by batch_size="auto"
+TUNING_ROWS = 16384  # rows of the first chunk used to time the batch sizes
+
+
+def to_classes(probabilities, threshold=0.5, labels=None):
+    """
+    Class of each row, shape (n, 1) int32 like the removed keras predict_classes. One output column (sigmoid)
+    is class 1 above threshold, two columns use the threshold on the second one, more columns take the argmax.
+    labels maps the column index to the class (classes_ of sklearn models).
+    """
+    probabilities = np.asarray(probabilities)
+    if probabilities.ndim == 1:
+        probabilities = probabilities.reshape(-1, 1)
+    if probabilities.shape[1] == 1:
+        idx = probabilities[:, 0] > threshold
+    elif probabilities.shape[1] == 2:
+        idx = probabilities[:, 1] > threshold
+    else:
+        idx = probabilities.argmax(axis=1)
+    if labels is not None:
+        return np.asarray(labels)[idx.astype(np.intp)].astype(np.int32).reshape(-1, 1)
+    return idx.astype(np.int32).reshape(-1, 1)
+
+
+def predict_classes(model, model_type, X, threshold=0.5, batch_size=None):
+    if model_type in KERAS_MODELS:
+        return to_classes(model.predict(X, batch_size=batch_size, verbose=0), threshold)
+    return to_classes(model.predict_proba(X), threshold, model.classes_)
+
+
+class ChunkedPredictor:
+    """
+    Predicts the classes chunk by chunk into one preallocated array, so only a chunk of the windowed matrix and
+    of the model intermediates is in memory at once. predict() also windows and scales the feature rows chunk
+    by chunk, the full windowed matrix is never built.
+    batch_size="auto" times BATCH_SIZES on the first chunk and keeps the smallest one reaching
+    target_rows_per_s, or the fastest one without a target. Ignored by sklearn models, they predict a chunk at once.
+    """
+    def __init__(self, model, model_type, threshold=0.5, chunk_mb=256, batch_size="auto", target_rows_per_s=None):
+        self.model = model
+        self.model_type = model_type
+        self.threshold = threshold
+        self.chunk_bytes = chunk_mb * 1024 * 1024
+        self.batch_size = batch_size
+        self.target_rows_per_s = target_rows_per_s
+        self.rows = 0
+        self.seconds = 0.0
+        self.chunk_rows = None
+
+    def __predict(self, X):
+        return predict_classes(self.model, self.model_type, X, self.threshold, self.batch_size)
+
+    def tune_batch_size(self, X):
+        if self.model_type not in KERAS_MODELS:
+            self.batch_size = None
+            return
+        sample = X[:TUNING_ROWS]
+        self.__predict(sample[:BATCH_SIZES[0]])  # the first call builds the graph
+        rates = []
+        for batch_size in BATCH_SIZES:
+            if batch_size > len(sample) and rates:
+                break
+            start_time = time.perf_counter()
+            predict_classes(self.model, self.model_type, sample, self.threshold, batch_size)
+            rates.append((len(sample) / max(time.perf_counter() - start_time, 1e-9), batch_size))
+        fast_enough = [batch_size for rate, batch_size in rates
+                       if self.target_rows_per_s is not None and rate >= self.target_rows_per_s]
+        self.batch_size = fast_enough[0] if fast_enough else max(rates)[1]
+
+    def __chunks(self, n, row_bytes):
+        self.chunk_rows = max(1, int(self.chunk_bytes // row_bytes))
+        for start in range(0, n, self.chunk_rows):
+            yield start, min(start + self.chunk_rows, n)
+
+    def __predict_chunk(self, out, start, end, X):
+        if self.batch_size == "auto":
+            self.tune_batch_size(X)
+        start_time = time.perf_counter()
+        out[start:end] = self.__predict(X)
+        self.seconds += time.perf_counter() - start_time
+        self.rows += end - start
+
+    def predict_windows(self, X):
+        """ Classes of an already windowed and scaled X. """
+        out = np.empty((len(X), 1), dtype=np.int32)
+        row_bytes = max(X[0].nbytes, 1) if len(X) else 1
+        for start, end in self.__chunks(len(X), row_bytes):
+            self.__predict_chunk(out, start, end, X[start:end])
+        return out
+
+    def predict_scaled(self, out, start, end, X, window_length):
+        """ Classes of the rows start to end of predict(), from their scaled windows X (2D for every model). """
+        if self.model_type == "LSTM":
+            X = X.reshape((X.shape[0], window_length, X.shape[1] // window_length))
+        self.__predict_chunk(out, start, end, X)
+
+    def predict(self, features, window_length, scaler):
+        """ Classes of every window of the raw feature rows, same as predict_windows(scaled_window_matrix(...)). """
+        return predict_shared([self], features, window_length, scaler)[0]
+
+    def stats(self):
+        return {
+            "rows": self.rows,
+            "seconds": round(self.seconds, 4),
+            "rows_per_s": round(self.rows / self.seconds, 1) if self.seconds else None,
+            "batch_size": self.batch_size,
+            "chunk_rows": self.chunk_rows,
+        }
+
+
+def predict_shared(predictors: list, features, window_length, scaler):
+    """
+    ChunkedPredictor.predict of every predictor on the same feature rows, window and scaler. Each chunk of scaled
+    windows is built once and predicted by all the predictors, the chunk fits the smallest chunk_mb of them.
+    """
+    features = np.asarray(features, dtype=np.float64)
+    n = max(len(features) - window_length + 1, 0)
+    outs = [np.empty((n, 1), dtype=np.int32) for _ in predictors]
+    row_bytes = window_length * features.shape[1] * features.itemsize
+    chunk_rows = max(1, int(min(predictor.chunk_bytes for predictor in predictors) // row_bytes))
+    for predictor in predictors:
+        predictor.chunk_rows = chunk_rows
+    for start in range(0, n, chunk_rows):
+        end = min(start + chunk_rows, n)
+        X = scaled_window_matrix(features[start:end + window_length - 1], window_length, scaler)
+        for predictor, out in zip(predictors, outs):
+            predictor.predict_scaled(out, start, end, X, window_length)
+    return outs
@@ -0,0 +1,172 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        stages = self.instrumentation.stages
+        stages[self.name] = stages.get(self.name, 0.0) + time.perf_counter() - self.start_time
+        return False
+
+
+class SamplingProfiler:
+    """ Samples the stack of a thread every interval seconds from a background thread and counts the functions. """
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.samples = 0
+        self.top_frames = Counter()
+        self.in_stack = Counter()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def __sample_loop(self):
+        while not self.__stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            self.top_frames[self.__name(frame)] += 1
+            seen = set()
+            while frame is not None:
+                name = self.__name(frame)
+                if name not in seen:
+                    self.in_stack[name] += 1
+                    seen.add(name)
+                frame = frame.f_back
+
+    @staticmethod
+    def __name(frame):
+        return "{}:{}({})".format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_firstlineno,
+                                  frame.f_code.co_name)
+
+    def start(self):
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__sample_loop, name="sampling-profiler", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        self.__thread.join()
+
+    def report(self, top=25):
+        return [{
+            "function": name,
+            "self_%": round(100 * self.top_frames[name] / self.samples, 2),
+            "total_%": round(100 * count / self.samples, 2),
+        } for name, count in self.in_stack.most_common(top)] if self.samples else []
+
+
+class Instrumentation:
+    """
+    Opt-in stage timers, event counters and profiling of one backtest run. When disabled, stage() returns a
+    shared no-op context manager and count() returns right away, so the hooks can stay in the code.
+    profile is None, "cprofile" (deterministic, slows the run down) or "sampling" (stack samples every
+    sampling_interval seconds, small overhead).
+    """
+    def __init__(self, enabled=False, profile=None, profile_top=25, sampling_interval=0.005, to_elk=False):
+        self.enabled = enabled
+        self.profile = profile if enabled else None
+        self.profile_top = profile_top
+        self.sampling_interval = sampling_interval
+        self.to_elk = to_elk
+        self.stages = {}
+        self.counters = Counter()
+        self.shared_stages = {}
+        self.__profiler = None
+        self.profile_report = None
+
+    @classmethod
+    def from_config(cls, config: dict):
+        return cls(**config.get("instrumentation", {}))
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        return _Stage(self, name)
+
+    def count(self, event, n=1):
+        if self.enabled:
+            self.counters[event] += n
+
+    def start_profile(self):
+        if self.profile == "cprofile":
+            self.__profiler = cProfile.Profile()
+            self.__profiler.enable()
+        elif self.profile == "sampling":
+            self.__profiler = SamplingProfiler(self.sampling_interval)
+            self.__profiler.start()
+        elif self.profile is not None:
+            raise Exception("unknown profile {}".format(self.profile))
+
+    def stop_profile(self, dump_file=None):
+        """ Stops the profiler and keeps its top functions. dump_file also saves the cProfile stats for snakeviz. """
+        if self.__profiler is None:
+            return
+        if self.profile == "cprofile":
+            self.__profiler.disable()
+            if dump_file:
+                self.__profiler.dump_stats(dump_file)
+            stats = pstats.Stats(self.__profiler, stream=io.StringIO())
+            rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:self.profile_top]
+            self.profile_report = [{
+                "function": "{}:{}({})".format(os.path.basename(file_name), line, function),
+                "calls": calls,
+                "tottime": round(tottime, 6),
+                "cumtime": round(cumtime, 6),
+            } for (file_name, line, function), (_, calls, tottime, cumtime, _) in rows]
+        else:
+            self.__profiler.stop()
+            self.profile_report = self.__profiler.report(self.profile_top)
+        self.__profiler = None
+
+    def report(self):
+        if not self.enabled:
+            return None
+        report = {
+            "stages": {name: round(seconds, 6) for name, seconds in self.stages.items()},
+            "counters": dict(self.counters),
+        }
+        if self.shared_stages:
+            # stages computed once and reused by every run (e.g. the data loading of a sweep)
+            report["shared_stages"] = {name: round(seconds, 6) for name, seconds in self.shared_stages.items()}
+        if self.profile_report is not None:
+            report["profile"] = {"type": self.profile, "top": self.profile_report}
+        return report
+
+    def log_context(self, run_name, timestamp):
+        """ Flat message for the ELK logger, one field per stage and counter so kibana can chart them. """
+        context = {"@time": timestamp, "log_type": "run_stats", "run_name": run_name}
+        for name, seconds in self.stages.items():
+            context["stage_{}_s".format(name)] = round(seconds, 6)
+        for name, seconds in self.shared_stages.items():
+            context["shared_stage_{}_s".format(name)] = round(seconds, 6)
+        for name, count in self.counters.items():
+            context["count_{}".format(name)] = count
+        return context
@@ -0,0 +1,185 @@
+import argparse
+import time
+from collections import namedtuple, deque
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from columnar import read_table
+from config import config_dict
+from metrics import RunningResults
+from strategy import Strategy
+from utils import scaled_window_matrix
+
+# features is the feature row of the timeframe candle that just closed, None for the minutes in between.
+# close is None for a candle that only carries features (its minute is missing from the minute data).
+Candle = namedtuple("Candle", ["open_time", "close", "features"])
+
+
+class CandleSource:
+    """ Yields lists of minute candles, in time order. A live exchange feed implements batches(). """
+    def batches(self):
+        raise NotImplementedError()
+
+
+class ReplaySource(CandleSource):
+    """
+    Replays the minute close prices and the feature dataset from files. Feature rows are delivered on the last
+    minute of their timeframe candle, the same minute Backtester acts on them.
+    """
+    def __init__(self, minute_csv, dataset_csv, timeframe, batch_size=1):
+        dataset = read_table(dataset_csv)
+        self.bar_times = dataset.index.values.astype("datetime64[ns]").view(np.int64)
+        self.features = dataset.drop(columns=["close"]).to_numpy()[:, :-1]
+        minutes = read_table(minute_csv, dataset.index[0], dataset.index[-1] + pd.Timedelta(minutes=1))
+        self.minute_times = minutes.index.values.astype("datetime64[ns]").view(np.int64)
+        self.closes = minutes["close"].to_numpy(dtype=np.float64)
+        self.timeframe = timeframe
+        self.batch_size = batch_size
+
+    def candles(self):
+        pos = np.searchsorted(self.minute_times, self.bar_times)
+        matched = (pos < len(self.minute_times)) & \
+            (self.minute_times[np.minimum(pos, len(self.minute_times) - 1)] == self.bar_times)
+        deliver = pos + self.timeframe - 1
+        bar = 0
+        for minute in range(len(self.minute_times)):
+            timestamp = pd.Timestamp(self.minute_times[minute])
+            while bar < len(deliver) and deliver[bar] <= minute:
+                if deliver[bar] == minute and matched[bar]:
+                    yield Candle(timestamp, float(self.closes[minute]), self.features[bar])
+                    bar += 1
+                    break
+                yield Candle(timestamp, None, self.features[bar])
+                bar += 1
+            else:
+                yield Candle(timestamp, float(self.closes[minute]), None)
+
+    def batches(self):
+        batch = []
+        for candle in self.candles():
+            batch.append(candle)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+class FeatureWindow:
+    """ Keeps only the last window_length - 1 feature rows, enough to build the windows of the next rows. """
+    def __init__(self, window_length, scaler):
+        self.window_length = window_length
+        self.scaler = scaler
+        self.rows = None
+
+    def extend(self, new_rows):
+        """ Scaled windows ending at each of new_rows that has a full window, and how many rows had none. """
+        new_rows = np.asarray(new_rows, dtype=np.float64)
+        history = new_rows if self.rows is None else np.concatenate([self.rows, new_rows])
+        self.rows = history[-(self.window_length - 1):] if self.window_length > 1 else history[:0]
+        if len(history) < self.window_length:
+            return None, len(new_rows)
+        windows = scaled_window_matrix(history, self.window_length, self.scaler)
+        return windows, len(new_rows) - len(windows)
+
+
+class LatencyStats:
+    """ Candle to decision latency, last max_samples kept for the percentiles. """
+    def __init__(self, max_samples=10000):
+        self.samples = deque(maxlen=max_samples)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds, candles):
+        self.samples.append(seconds)
+        self.count += candles
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def report(self):
+        samples = np.array(self.samples) * 1000
+        return {
+            "candles": self.count,
+            "batches_per_s": round(len(samples) / self.total, 2) if self.total else None,
+            "latency_ms_p50": round(float(np.percentile(samples, 50)), 4) if len(samples) else None,
+            "latency_ms_p99": round(float(np.percentile(samples, 99)), 4) if len(samples) else None,
+            "latency_ms_max": round(self.max * 1000, 4),
+        }
+
+
+class LiveRunner:
+    """
+    Drives Strategy on candles as they arrive. Only the windows of the new timeframe candles are scaled and
+    predicted (one model call per batch). Memory does not grow with the run length: the feature history is
+    bounded and only the last max_trades closed trades are kept, the statistics of all the trades are kept
+    by a RunningResults.
+    """
+    def __init__(self, config: dict, source: CandleSource, max_trades=1000):
+        self.config = config
+        self.source = source
+        self.window = FeatureWindow(config["window_length"], joblib.load(config["scaler"]))
+        self.strategy = Strategy(config)
+        self.max_trades = max_trades
+        self.results = RunningResults(config["params"]["initial_capital"])
+        self.counted = 0  # trades of the ledger already added to results
+        self.latency = LatencyStats()
+
+    def process(self, candles):
+        received = time.perf_counter()
+        bar_rows = [candle.features for candle in candles if candle.features is not None]
+        first_window = None
+        if bar_rows:
+            X, first_window = self.window.extend(bar_rows)
+            if X is not None:
+                if self.config["model"] == "LSTM":
+                    X = X.reshape((X.shape[0], self.config["window_length"], X.shape[1] // self.config["window_length"]))
+                self.strategy.init_predictions(X)
+
+        bar = 0
+        for candle in candles:
+            timestamp_idx = np.nan
+            if candle.features is not None:
+                if first_window is not None and bar >= first_window:
+                    timestamp_idx = bar - first_window
+                bar += 1
+            if candle.close is not None:
+                self.strategy.notify(candle.open_time, timestamp_idx, candle.close)
+
+        ledger = self.strategy.ledger
+        self.results.add(ledger.view()[self.counted:])
+        if len(ledger) > 2 * self.max_trades:
+            ledger.truncate(self.max_trades)
+        self.counted = len(ledger)
+        self.latency.add(time.perf_counter() - received, len(candles))
+
+    def run(self, max_candles=None):
+        for candles in self.source.batches():
+            self.process(candles)
+            if max_candles is not None and self.latency.count >= max_candles:
+                break
+        self.strategy.end()
+        return self.latency.report()
+
+    def result_json(self, duration=None):
+        """ Results of every trade of the run, including the ones dropped from the ledger. """
+        return self.results.result_json(self.strategy.capital, self.config["params"], duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Paper trading on candles replayed from the minute and dataset files")
+    parser.add_argument("--batch-size", type=int, default=1, help="candles handed to the strategy at once")
+    parser.add_argument("--max-candles", type=int, default=None)
+    args = parser.parse_args()
+
+    source = ReplaySource("minute_close_prices.csv", config_dict["dataset"], config_dict["timeframe"], args.batch_size)
+    runner = LiveRunner(config_dict, source)
+    latency = runner.run(args.max_candles)
+    print(runner.result_json())
+    print(latency)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,48 @@
 import json
-import pika
+import os
+import threading
+import time
 import traceback
+from queue import Queue, Empty, Full
 from typing import Union
 
 
 class Logger:
+    """
+    Logs are put on a bounded in-memory queue and published to rabbitmq in batches by a background thread,
+    so the caller never waits for the broker. When the queue is full the message is dropped, or the caller
+    blocks if block_when_full is set. channel_factory replaces the pika connection (e.g. with a fake channel).
+    """
 
-    def __init__(self, index, url, queue, to_elk=True):
+    def __init__(self, index, url, queue, to_elk=True, batch_size=100, flush_interval=1.0,
+                 max_queue_size=10000, block_when_full=False, channel_factory=None):
         self.logger_name: str = index
         self.url = url
         self.queue = queue
-        self.__connection: Union[pika.adapters.blocking_connection.BlockingConnection, None] = None
-        self.__channel: Union[pika.adapters.blocking_connection.BlockingChannel, None] = None
+        self.__connection: Union["pika.adapters.blocking_connection.BlockingConnection", None] = None
+        self.__channel: Union["pika.adapters.blocking_connection.BlockingChannel", None] = None
         self.to_elk = to_elk
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block_when_full = block_when_full
+        self.channel_factory = channel_factory
+        self.__pending = Queue(maxsize=max_queue_size)
+        self.__sender: Union[threading.Thread, None] = None
+        self.__stop = threading.Event()
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
 
     def __get_connection(self):
+        # imported here so runs that don't log to elk never load pika
+        import pika
         return pika.BlockingConnection(pika.connection.URLParameters(self.url))
 
     def __connect(self):
+        if self.channel_factory:
+            self.__channel = self.channel_factory()
+            return
+
         # noinspection PyBroadException
         try:
             self.__connection = self.__get_connection()
@@ -40,21 +65,95 @@ class Logger:
                 self.__connection.close()
             except:
                 pass
+            self.__connection = None
+            self.__channel = None
+
+    def __publish(self, batch):
+        published = 0
+        # noinspection PyBroadException
+        try:
+            if not self.__channel:
+                self.__connect()
+            for context in batch:
+                self.__channel.basic_publish("", self.queue, json.dumps(context))
+                published += 1
+        except:
+            print(traceback.format_exc())
+            self.__connection = None
             self.__channel = None
+        self.sent += published
+        self.failed += len(batch) - published
+
+    def __send_loop(self):
+        while not self.__stop.is_set() or not self.__pending.empty():
+            batch = []
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.__pending.get(timeout=max(deadline - time.time(), 0.001)))
+                except Empty:
+                    break
+            if batch:
+                try:
+                    self.__publish(batch)
+                finally:
+                    # flush() waits on these, they must be marked done even if the publish raised
+                    for _ in batch:
+                        self.__pending.task_done()
+
+    def __start_sender(self):
+        self.__stop.clear()
+        self.__sender = threading.Thread(target=self.__send_loop, name="logger-sender", daemon=True)
+        self.__sender.start()
 
     def log(self, context, stdout=False):
         if stdout:
             print(json.dumps(context), flush=True)
 
         if self.to_elk:
-            if not self.__connection:
-                self.__connect()
+            if not self.__sender or not self.__sender.is_alive():
+                self.__start_sender()
 
+            context = dict(context)
             context["index"] = self.logger_name
-
-            # noinspection PyBroadException
             try:
-                self.__channel.basic_publish("", self.queue, json.dumps(context))
-            except:
-                print(traceback.format_exc())
-                self.__connection = None
+                self.__pending.put(context, block=self.block_when_full)
+            except Full:
+                self.dropped += 1
+
+    def flush(self):
+        """ Waits until every queued message was published (or failed). """
+        if self.__sender and self.__sender.is_alive():
+            self.__pending.join()
+
+    def close(self):
+        self.flush()
+        if self.__sender:
+            self.__stop.set()
+            self.__sender.join()
+            self.__sender = None
+        try:
+            self.__connection.close()
+        except:
+            pass
+        self.__connection = None
+        self.__channel = None
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "queued": self.__pending.qsize(),
+        }
+
+
+_loggers = {}
+
+
+def get_logger(index, url, queue, to_elk=True, **options):
+    """ One Logger (and rabbitmq connection) per process for the same destination, shared by all strategies. """
+    key = (os.getpid(), index, url, queue, to_elk, tuple(sorted(options.items())))
+    if key not in _loggers:
+        _loggers[key] = Logger(index, url, queue, to_elk, **options)
+    return _loggers[key]
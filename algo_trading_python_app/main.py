@@ -1,12 +1,11 @@
-from backtest import Backtester
-from config import config_dict
+import sys
+
+from cli import main as cli_main
 
 
 def main():
-    tester = Backtester(config_dict)
-    tester.init_strategy(config_dict)
-    tester.start()
-    print("elapsed: ", tester.duration)
+    """ Same as python cli.py backtest [--set key.path=value] [--no-cache] [--clear-cache]. """
+    cli_main(["backtest"] + sys.argv[1:])
 
 
 if __name__ == "__main__":
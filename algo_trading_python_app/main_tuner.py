@@ -1,27 +1,45 @@
 from copy import deepcopy
+import os
 import pandas as pd
 import time
 
 from backtest import Backtester
 from config import config_dict
+from param_search import PathStats, grid_search, successive_halving, bayesian_search
+from sweep import SweepExecutor, ResultsCsvWriter, PROGRESS_STEPS
 
 TUNE_TP = [None, 0.005, 0.01, 0.03, 0.05, 0.1]
 TUNE_SL = [None, 0.005, 0.01, 0.03, 0.05, 0.1]
 TUNE_TTL = [None, 180, 300, 420]
+# "replay" backtests every TUNE_* job. "path_stats" (every SEARCH_* combination), "halving" (successive halving
+# of the SEARCH_* combinations) and "bayesian" score the combinations from the trade path statistics instead,
+# then only the TOP_K best are backtested for the full results
+SEARCH = "replay"
+SEARCH_TP = [None] + [round(0.0025 * i, 4) for i in range(1, 41)]
+SEARCH_SL = [None] + [round(0.0025 * i, 4) for i in range(1, 41)]
+SEARCH_TTL = [None] + list(range(60, 1441, 60))
+TOP_K = 10
 
 
 LOG_TO_ELK = False
 RUN_NAME_PREFIX = "tunning_strategy_{}"
+WORKERS = os.cpu_count() or 1  # 1 runs the jobs one after another in this process
+CHUNKSIZE = 1  # jobs handed to a worker at once
 tester = None
 
 
-def run_job(job: dict):
+def job_config(job: dict):
     cfg = deepcopy(config_dict)
     cfg["params"]["tp"] = job["tp"]
     cfg["params"]["sl"] = job["sl"]
     cfg["params"]["ttl"] = job["ttl"]
     cfg["log_to_elk"] = LOG_TO_ELK
     cfg["run_name"] = job["run_name"]
+    return cfg
+
+
+def run_job(job: dict):
+    cfg = job_config(job)
 
     global tester
     if not tester:
@@ -31,31 +49,97 @@ def run_job(job: dict):
     job.update(tester.results_json)
 
 
-def main():
-    t = time.time()
-    results = []
-    idx_run = 0
-    total_jobs = len(TUNE_TP) * len(TUNE_SL) * len(TUNE_TTL)
-
-
+def get_jobs():
+    jobs = []
     for tp in TUNE_TP:
         for sl in TUNE_SL:
             for ttl in TUNE_TTL:
-                job = {
+                jobs.append({
                     "tp": tp,
                     "sl": sl,
                     "ttl": ttl,
-                    "run_name": RUN_NAME_PREFIX.format(idx_run)
-                }
-                idx_run += 1
-                print("Running {}/{} ".format(idx_run, total_jobs), job)
-                run_job(job)
-                results.append(job)
-
-    results_df = pd.DataFrame(results)
-    results_df.to_csv("tunning_{}_scenarios_{}_{}_timeframe_{}_window.csv".format(total_jobs, config_dict["model"],
-                                                                                  config_dict["timeframe"],
-                                                                                  config_dict["window_length"]))
+                    "run_name": RUN_NAME_PREFIX.format(len(jobs))
+                })
+    return jobs
+
+
+def run_parallel(jobs: list, output_file):
+    global tester
+    configs = [job_config(job) for job in jobs]
+    # predictions and the minute alignment are computed once, here, and shared with the workers
+    tester = Backtester(configs[0])
+    tester.init_strategy(configs[0])
+    times, prices, signal_idx = tester.get_minute_arrays()
+    writer = ResultsCsvWriter(output_file, column_dtypes={
+        "tp": pd.Series(TUNE_TP).dtype,
+        "sl": pd.Series(TUNE_SL).dtype,
+        "ttl": pd.Series(TUNE_TTL).dtype,
+    })
+    executor = SweepExecutor(workers=WORKERS, chunksize=CHUNKSIZE)
+    executor.share(tester.strategy.predictions, times, prices, signal_idx)
+    executor.run(jobs, configs, writer)
+
+
+def search(output_file):
+    global tester
+    cfg = job_config({"tp": None, "sl": None, "ttl": None, "run_name": RUN_NAME_PREFIX.format("search")})
+    tester = Backtester(cfg)
+    tester.init_strategy(cfg)
+    times, prices, signal_idx = tester.get_minute_arrays()
+    stats = PathStats(times, prices, signal_idx, tester.strategy.predictions, cfg["classes"])
+    start_time = time.time()
+    if SEARCH == "path_stats":
+        scores = grid_search(stats, SEARCH_TP, SEARCH_SL, SEARCH_TTL, cfg["params"])
+    elif SEARCH == "halving":
+        candidates = [(tp, sl, ttl) for tp in SEARCH_TP for sl in SEARCH_SL for ttl in SEARCH_TTL]
+        scores = successive_halving(stats, candidates, cfg["params"])
+        scores = scores[scores["fraction"] == scores["fraction"].max()]
+    elif SEARCH == "bayesian":
+        scores = bayesian_search(stats, cfg["params"])
+    else:
+        raise Exception("unknown search {}".format(SEARCH))
+    print("scored {} combinations in {:.2f}s".format(len(scores), time.time() - start_time))
+    scores.to_csv("search_{}_{}".format(SEARCH, output_file))
+
+    best = scores.sort_values("end_capital", ascending=False, kind="stable").head(TOP_K)
+    jobs = []
+    for tp, sl, ttl in zip(best["tp"], best["sl"], best["ttl"]):
+        # the score columns hold None as NaN
+        jobs.append({
+            "tp": None if pd.isna(tp) else float(tp),
+            "sl": None if pd.isna(sl) else float(sl),
+            "ttl": None if pd.isna(ttl) else int(ttl),
+            "run_name": RUN_NAME_PREFIX.format(len(jobs))
+        })
+    for job in jobs:
+        run_job(job)
+    pd.DataFrame(jobs).to_csv(output_file)
+
+
+def main():
+    t = time.time()
+    if SEARCH != "replay":
+        search("tunning_top_{}_{}_{}_timeframe_{}_window.csv".format(TOP_K, config_dict["model"],
+                                                                    config_dict["timeframe"],
+                                                                    config_dict["window_length"]))
+        print("time: {}".format(time.time() - t))
+        return
+    jobs = get_jobs()
+    total_jobs = len(jobs)
+    output_file = "tunning_{}_scenarios_{}_{}_timeframe_{}_window.csv".format(total_jobs, config_dict["model"],
+                                                                             config_dict["timeframe"],
+                                                                             config_dict["window_length"])
+
+    if WORKERS > 1:
+        run_parallel(jobs, output_file)
+    else:
+        for idx_run, job in enumerate(jobs):
+            if idx_run % max(1, total_jobs // PROGRESS_STEPS) == 0:
+                print("Running {}/{} ".format(idx_run + 1, total_jobs), job)
+            run_job(job)
+
+        results_df = pd.DataFrame(jobs)
+        results_df.to_csv(output_file)
     print("time: {}".format(time.time() - t))
 
 
@@ -0,0 +1,339 @@
+import numpy as np
+import pandas as pd
+
+from trade import END_REASONS, VERDICTS
+
+MINUTE_NS = 60 * 10 ** 9
+# result_json column of the % of the trades ended by every reason
+REASON_COLUMNS = [("ml_model", "model_end_trade_%"), ("tp_hit", "tp_hit_%"), ("sl_hit", "sl_hit_%"),
+                  ("ttl_hit", "ttl_hit_%"), ("trailing_stop_hit", "trailing_stop_hit_%"),
+                  ("break_even_hit", "break_even_hit_%")]
+DAYS_PER_YEAR = 365  # crypto trades every day
+
+
+def codes(column, categories):
+    """ Integer codes of a trade_df column, free when the column already is a categorical with these categories. """
+    if isinstance(column.dtype, pd.CategoricalDtype) and list(column.cat.categories) == categories:
+        return column.cat.codes.to_numpy()
+    return pd.Categorical(column, categories=categories).codes
+
+
+def _mean(values):
+    return values.mean() if len(values) else np.nan
+
+
+def _max(values):
+    return values.max() if len(values) else np.nan
+
+
+def _ratio(count, total, scale=1):
+    return round(float(count) / total * scale, 4) if total else 0.0
+
+
+def equity_curve(trade_df: pd.DataFrame, initial_capital):
+    """ Capital after every closed trade, indexed by the trade end time, starting with the initial capital. """
+    after = trade_df["before_trade_capital"].to_numpy() + trade_df["profit"].to_numpy()
+    times = pd.to_datetime(trade_df["end_time"])
+    if len(trade_df):
+        start = pd.to_datetime(trade_df["start_time"].iloc[0])
+    else:
+        start = pd.Timestamp(0)
+    return pd.Series(np.concatenate([[initial_capital], after]), index=pd.DatetimeIndex([start]).append(
+        pd.DatetimeIndex(times)), name="capital")
+
+
+def portfolio_max_drawdown(trade_df: pd.DataFrame, initial_capital):
+    """
+    Largest drop of the marked-to-market capital from its previous peak. Inside a trade the capital is valued
+    at the lowest price reached, against the highest closed capital before the trade.
+    """
+    if not len(trade_df):
+        return 0.0
+    before = trade_df["before_trade_capital"].to_numpy()
+    after = before + trade_df["profit"].to_numpy()
+    trough = before - trade_df["position_capital"].to_numpy() + \
+        trade_df["size"].to_numpy() * trade_df["lowest_price"].to_numpy() * (1 - trade_df["fee_percentage"].to_numpy())
+    peak = np.maximum.accumulate(np.concatenate([[initial_capital], after[:-1]]))
+    return round(float(max(((peak - np.minimum(trough, after)) / peak).max(), 0.0)), 4)
+
+
+def daily_returns(equity: pd.Series, period=None):
+    """ Daily returns of the equity curve, days without a closed trade have a 0 return. """
+    if period is not None:
+        days = pd.date_range(pd.Timestamp(period[0]).floor("D"), pd.Timestamp(period[1]).floor("D"), freq="D")
+    else:
+        days = pd.date_range(equity.index[0].floor("D"), equity.index[-1].floor("D"), freq="D")
+    daily = equity.groupby(equity.index.floor("D")).last().reindex(days).ffill().fillna(equity.iloc[0])
+    previous = np.concatenate([[equity.iloc[0]], daily.to_numpy()[:-1]])
+    return daily.to_numpy() / previous - 1
+
+
+def sharpe_sortino(returns):
+    if len(returns) < 2:
+        return np.nan, np.nan
+    mean = returns.mean()
+    std = returns.std(ddof=1)
+    downside = np.sqrt((np.minimum(returns, 0) ** 2).mean())
+    sharpe = round(float(mean / std * np.sqrt(DAYS_PER_YEAR)), 4) if std > 0 else np.nan
+    sortino = round(float(mean / downside * np.sqrt(DAYS_PER_YEAR)), 4) if downside > 0 else np.nan
+    return sharpe, sortino
+
+
+def exposure(trade_df: pd.DataFrame, period):
+    """ % of the backtested minutes spent in a position. """
+    if period is None or not len(trade_df):
+        return 0.0
+    in_position = (pd.to_datetime(trade_df["end_time"]) - pd.to_datetime(trade_df["start_time"])).dt.total_seconds().sum()
+    total = (period[1] - period[0] + MINUTE_NS) / 10 ** 9
+    return round(float(in_position / total * 100), 4)
+
+
+def result_json(trade_df: pd.DataFrame, end_capital, params: dict, duration, period=None):
+    """
+    Results of a backtest. The verdict and end reason masks are built once from the integer codes and reused
+    for every statistic. period is the (first, last) backtested minute as epoch ns.
+    """
+    n = len(trade_df)
+    verdict = codes(trade_df["trade_verdict"], VERDICTS)
+    reason_counts = np.bincount(codes(trade_df["end_reason"], END_REASONS), minlength=len(END_REASONS))
+    win = verdict == VERDICTS.index("WIN")
+    loss = verdict == VERDICTS.index("LOSS")
+    profit_percentage = trade_df["profit_percentage"].to_numpy()
+    profit = trade_df["profit"].to_numpy()
+    max_drawdown = trade_df["max_drawdown"].to_numpy()
+    highest_possible_win = trade_df["highest_possible_win"].to_numpy()
+    winning_trades = int(win.sum())
+    losing_trades = int(loss.sum())
+    mean_profit = _mean(profit_percentage[win])
+    mean_loss = _mean(profit_percentage[loss])
+
+    result = {
+        "end_capital": round(end_capital, 2),
+        "number_of_trades": n,
+        "winning_trades": winning_trades,
+        "losing_trades": losing_trades,
+        "win_%": _ratio(winning_trades, n),
+        "profit_loss_mean_ratio": round(abs(mean_profit / mean_loss), 4) if losing_trades else np.nan,
+        "mean_loss": round(mean_loss, 4),
+        "mean_profit": round(mean_profit, 4),
+        "model_end_trade_%": _ratio(reason_counts[END_REASONS.index("ml_model")], n, 100),
+        "tp_hit_%": _ratio(reason_counts[END_REASONS.index("tp_hit")], n, 100),
+        "sl_hit_%": _ratio(reason_counts[END_REASONS.index("sl_hit")], n, 100),
+        "ttl_hit_%": _ratio(reason_counts[END_REASONS.index("ttl_hit")], n, 100),
+        "trailing_stop_hit_%": _ratio(reason_counts[END_REASONS.index("trailing_stop_hit")], n, 100),
+        "break_even_hit_%": _ratio(reason_counts[END_REASONS.index("break_even_hit")], n, 100),
+        "avg_trade_len": int(trade_df["trade_duration"].to_numpy().mean()) if n else 0,
+        "total_fees_usd": round(trade_df["total_fee"].to_numpy().sum(), 4),
+        "total_win_usd": round(profit[win].sum(), 4),
+        "total_loss_and_fees_usd": round(profit[loss].sum(), 4),
+        "run_time": duration,
+        "max_drawdown": _max(max_drawdown),
+        "max_drawdown_winning_trade": _max(max_drawdown[win]),
+        "highest_possible_win": _max(highest_possible_win),
+        "highest_possible_win_losing_trade": _max(highest_possible_win[loss]),
+    }
+
+    if params.get("sl", None) is not None and params.get("tp", None) is not None:
+        result["R_R"] = round(params["tp"] / params["sl"], 4)
+    else:
+        result["R_R"] = None
+
+    initial_capital = params["initial_capital"]
+    equity = equity_curve(trade_df, initial_capital)
+    result["portfolio_max_drawdown"] = portfolio_max_drawdown(trade_df, initial_capital)
+    result["sharpe"], result["sortino"] = sharpe_sortino(daily_returns(equity, period)) if n else (np.nan, np.nan)
+    result["exposure_%"] = exposure(trade_df, period)
+    return result
+
+
+class RunningResults:
+    """
+    result_json of every trade added so far, kept as running sums and maxima of the ledger rows so the trades
+    themselves can be dropped (LiveRunner keeps only the last ones). Only the last capital of every day with a
+    closed trade is kept for the sharpe and sortino ratios.
+    """
+    def __init__(self, initial_capital):
+        self.initial_capital = initial_capital
+        self.count = 0
+        self.wins = 0
+        self.losses = 0
+        self.reason_counts = np.zeros(len(END_REASONS), dtype=np.int64)
+        self.sums = {"profit_win": 0.0, "profit_loss": 0.0, "profit_percentage_win": 0.0,
+                     "profit_percentage_loss": 0.0, "total_fee": 0.0, "trade_duration": 0, "seconds_in_position": 0.0}
+        self.maxima = {"max_drawdown": np.nan, "max_drawdown_winning_trade": np.nan, "highest_possible_win": np.nan,
+                       "highest_possible_win_losing_trade": np.nan}
+        self.peak = initial_capital
+        self.portfolio_max_drawdown = 0.0
+        self.first_start = None
+        self.day_capital = {}
+
+    def __update_max(self, key, values):
+        if len(values):
+            self.maxima[key] = np.fmax(self.maxima[key], values.max())
+
+    def add(self, rows):
+        """ Adds closed trades, LEDGER_DTYPE rows in time order. """
+        if not len(rows):
+            return
+        win = rows["trade_verdict"] == VERDICTS.index("WIN")
+        loss = rows["trade_verdict"] == VERDICTS.index("LOSS")
+        self.count += len(rows)
+        self.wins += int(win.sum())
+        self.losses += int(loss.sum())
+        self.reason_counts += np.bincount(rows["end_reason"], minlength=len(END_REASONS))
+        self.sums["profit_win"] += rows["profit"][win].sum()
+        self.sums["profit_loss"] += rows["profit"][loss].sum()
+        self.sums["profit_percentage_win"] += rows["profit_percentage"][win].sum()
+        self.sums["profit_percentage_loss"] += rows["profit_percentage"][loss].sum()
+        self.sums["total_fee"] += rows["total_fee"].sum()
+        self.sums["trade_duration"] += int(rows["trade_duration"].sum())
+        # trade_df times have a second resolution
+        start = rows["start_time"] // 10 ** 9 * 10 ** 9
+        end = rows["end_time"] // 10 ** 9 * 10 ** 9
+        self.sums["seconds_in_position"] += ((end - start) / 10 ** 9).sum()
+        self.__update_max("max_drawdown", rows["max_drawdown"])
+        self.__update_max("max_drawdown_winning_trade", rows["max_drawdown"][win])
+        self.__update_max("highest_possible_win", rows["highest_possible_win"])
+        self.__update_max("highest_possible_win_losing_trade", rows["highest_possible_win"][loss])
+
+        # same as portfolio_max_drawdown, the peak is carried over from the previous trades
+        before = rows["before_trade_capital"]
+        after = before + rows["profit"]
+        trough = before - rows["position_capital"] + \
+            rows["size"] * rows["lowest_price"] * (1 - rows["fee_percentage"])
+        peak = np.maximum.accumulate(np.concatenate([[self.peak], after[:-1]]))
+        self.peak = max(self.peak, after.max())
+        self.portfolio_max_drawdown = max(self.portfolio_max_drawdown,
+                                          float(((peak - np.minimum(trough, after)) / peak).max()))
+
+        if self.first_start is None:
+            self.first_start = int(start[0])
+        days = end - end % (24 * 60 * MINUTE_NS)
+        for day, capital in zip(days.tolist(), after.tolist()):
+            self.day_capital[day] = capital
+
+    def equity(self):
+        """ The equity curve of equity_curve reduced to the last capital of every day, same daily returns. """
+        times = pd.DatetimeIndex(np.array([self.first_start] + list(self.day_capital), dtype="datetime64[ns]"))
+        return pd.Series([self.initial_capital] + list(self.day_capital.values()), index=times, name="capital")
+
+    def result_json(self, end_capital, params: dict, duration, period=None):
+        """ Same dict as result_json on the trade_df of all the added trades. """
+        n = self.count
+        mean_profit = self.sums["profit_percentage_win"] / self.wins if self.wins else np.nan
+        mean_loss = self.sums["profit_percentage_loss"] / self.losses if self.losses else np.nan
+        result = {
+            "end_capital": round(end_capital, 2),
+            "number_of_trades": n,
+            "winning_trades": self.wins,
+            "losing_trades": self.losses,
+            "win_%": _ratio(self.wins, n),
+            "profit_loss_mean_ratio": round(abs(mean_profit / mean_loss), 4) if self.losses else np.nan,
+            "mean_loss": round(mean_loss, 4),
+            "mean_profit": round(mean_profit, 4),
+        }
+        for reason, column in REASON_COLUMNS:
+            result[column] = _ratio(self.reason_counts[END_REASONS.index(reason)], n, 100)
+        result.update({
+            "avg_trade_len": int(self.sums["trade_duration"] / n) if n else 0,
+            "total_fees_usd": round(self.sums["total_fee"], 4),
+            "total_win_usd": round(self.sums["profit_win"], 4),
+            "total_loss_and_fees_usd": round(self.sums["profit_loss"], 4),
+            "run_time": duration,
+        })
+        result.update(self.maxima)
+
+        if params.get("sl", None) is not None and params.get("tp", None) is not None:
+            result["R_R"] = round(params["tp"] / params["sl"], 4)
+        else:
+            result["R_R"] = None
+
+        result["portfolio_max_drawdown"] = round(self.portfolio_max_drawdown, 4)
+        result["sharpe"], result["sortino"] = sharpe_sortino(daily_returns(self.equity(), period)) if n \
+            else (np.nan, np.nan)
+        if period is None or not n:
+            result["exposure_%"] = 0.0
+        else:
+            result["exposure_%"] = round(float(self.sums["seconds_in_position"] /
+                                               ((period[1] - period[0] + MINUTE_NS) / 10 ** 9) * 100), 4)
+        return result
+
+
+def _monthly(month, win, profit, initial_capital):
+    if not len(month):
+        return []
+    months, month_idx = np.unique(month, return_inverse=True)
+    trades = np.bincount(month_idx, minlength=len(months))
+    wins = np.bincount(month_idx, weights=win, minlength=len(months))
+    profit = np.bincount(month_idx, weights=profit, minlength=len(months))
+    end_capital = initial_capital + np.cumsum(profit)
+    return [{
+        "month": str(months[i]),
+        "number_of_trades": int(trades[i]),
+        "win_%": round(float(wins[i] / trades[i]), 4),
+        "profit_usd": round(float(profit[i]), 4),
+        "end_capital": round(float(end_capital[i]), 2),
+    } for i in range(len(months))]
+
+
+def monthly_breakdown(trade_df: pd.DataFrame, initial_capital):
+    """ Trades, win rate and profit per calendar month of the trade end time. """
+    if not len(trade_df):
+        return []
+    month = pd.to_datetime(trade_df["end_time"]).dt.strftime("%Y-%m").to_numpy()
+    win = codes(trade_df["trade_verdict"], VERDICTS) == VERDICTS.index("WIN")
+    return _monthly(month, win, trade_df["profit"].to_numpy(), initial_capital)
+
+
+def ledger_monthly_breakdown(rows, initial_capital):
+    """ monthly_breakdown of LEDGER_DTYPE rows, without building the trade_df. """
+    month = np.datetime_as_string(rows["end_time"].astype("datetime64[ns]").astype("datetime64[M]"))
+    return _monthly(month, rows["trade_verdict"] == VERDICTS.index("WIN"), rows["profit"], initial_capital)
+
+
+def batch_results(trade_dfs: dict, initial_capital):
+    """
+    The trade statistics of many runs at once (e.g. all the jobs of a sweep): the trades of every run are put
+    in the same arrays and each statistic is one grouped numpy reduction by run.
+    """
+    run_names = list(trade_dfs)
+    lengths = np.array([len(trade_dfs[name]) for name in run_names])
+    run = np.repeat(np.arange(len(run_names)), lengths)
+    columns = {}
+    for column in ["profit", "profit_percentage", "total_fee", "trade_duration", "max_drawdown"]:
+        columns[column] = np.concatenate([trade_dfs[name][column].to_numpy(dtype=np.float64) for name in run_names]) \
+            if len(run_names) else np.empty(0)
+    win = np.concatenate([codes(trade_dfs[name]["trade_verdict"], VERDICTS) == VERDICTS.index("WIN")
+                          for name in run_names]) if len(run_names) else np.empty(0, dtype=bool)
+    reason = np.concatenate([codes(trade_dfs[name]["end_reason"], END_REASONS) for name in run_names]) \
+        if len(run_names) else np.empty(0, dtype=np.int8)
+
+    def grouped_sum(values, mask=None):
+        weights = values if mask is None else np.where(mask, values, 0)
+        return np.bincount(run, weights=weights, minlength=len(run_names))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        wins = grouped_sum(np.ones(len(run)), win)
+        losses = lengths - wins
+        table = pd.DataFrame({
+            "end_capital": np.round(initial_capital + grouped_sum(columns["profit"]), 2),
+            "number_of_trades": lengths,
+            "winning_trades": wins.astype(np.int64),
+            "losing_trades": losses.astype(np.int64),
+            "win_%": np.round(np.where(lengths > 0, wins / lengths, 0.0), 4),
+            "mean_loss": np.round(grouped_sum(columns["profit_percentage"], ~win) / losses, 4),
+            "mean_profit": np.round(grouped_sum(columns["profit_percentage"], win) / wins, 4),
+            "avg_trade_len": np.where(lengths > 0, grouped_sum(columns["trade_duration"]) / lengths, 0).astype(np.int64),
+            "total_fees_usd": np.round(grouped_sum(columns["total_fee"]), 4),
+            "total_win_usd": np.round(grouped_sum(columns["profit"], win), 4),
+            "total_loss_and_fees_usd": np.round(grouped_sum(columns["profit"], ~win), 4),
+        }, index=pd.Index(run_names, name="run_name"))
+        table["profit_loss_mean_ratio"] = np.round(np.abs(table["mean_profit"] / table["mean_loss"]), 4)
+        for reason_name, column in REASON_COLUMNS:
+            hits = grouped_sum(np.ones(len(run)), reason == END_REASONS.index(reason_name))
+            table[column] = np.round(np.where(lengths > 0, hits / lengths * 100, 0.0), 4)
+
+    max_drawdown = np.full(len(run_names), np.nan)
+    np.fmax.at(max_drawdown, run, columns["max_drawdown"])
+    table["max_drawdown"] = max_drawdown
+    return table
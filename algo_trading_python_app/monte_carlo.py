@@ -0,0 +1,186 @@
+import argparse
+from multiprocessing import Pool
+import time
+
+import numpy as np
+import pandas as pd
+
+from config import config_dict
+from metrics import REASON_COLUMNS, codes
+from run_store import load_trades
+from trade import END_REASONS
+
+REPLICAS = 1000
+CHUNK_SIZE = 250  # replicas computed together, and handed to a worker at once
+WORKERS = 1  # 1 computes the chunks in this process
+SEED = 0
+BOOTSTRAP = True  # resample the trades with replacement, in a random order
+FEE_RANGE = (0.0005, 0.001)  # trade_fee of every replica drawn uniformly from it, None keeps the recorded fee
+SLIPPAGE = 0.0005  # buys fill up to SLIPPAGE higher and sells up to SLIPPAGE lower, uniformly, per trade
+MAX_POSITION_CAPITAL = 100  # same as Strategy
+PERCENTILES = [5, 25, 50, 75, 95]
+TRADE_COLUMNS = ["entry_price", "sell_price", "lowest_price", "highest_price", "fee_percentage"]
+
+
+def trade_arrays(trade_df: pd.DataFrame):
+    trades = {column: trade_df[column].to_numpy(dtype=np.float64) for column in TRADE_COLUMNS}
+    trades["end_reason"] = np.asarray(codes(trade_df["end_reason"], END_REASONS), dtype=np.int64)
+    trades["trade_duration"] = trade_df["trade_duration"].to_numpy(dtype=np.float64)
+    return trades
+
+
+def replica_batch(trades: dict, n_replicas, rng, bootstrap=BOOTSTRAP, fee_range=FEE_RANGE, slippage=SLIPPAGE):
+    """
+    (n_replicas, n_trades) entry, exit, low and high prices, fees, end reasons and durations of the replicas.
+    The end reasons and durations are the ones of the resampled trades.
+    """
+    n = len(trades["entry_price"])
+    if bootstrap:
+        idx = rng.integers(0, n, size=(n_replicas, n)) if n else np.zeros((n_replicas, 0), dtype=np.int64)
+    else:
+        idx = np.broadcast_to(np.arange(n), (n_replicas, n))
+    entry = trades["entry_price"][idx]
+    exit_price = trades["sell_price"][idx]
+    if slippage:
+        entry = entry * (1 + rng.uniform(0, slippage, size=entry.shape))
+        exit_price = exit_price * (1 - rng.uniform(0, slippage, size=exit_price.shape))
+    if fee_range is not None:
+        fee = rng.uniform(fee_range[0], fee_range[1], size=(n_replicas, 1))
+    else:
+        fee = trades["fee_percentage"][idx] if n else np.zeros((n_replicas, 0))
+    return {
+        "entry_price": entry,
+        "sell_price": exit_price,
+        "lowest_price": np.minimum(trades["lowest_price"][idx], entry),
+        "highest_price": np.maximum(trades["highest_price"][idx], entry),
+        "fee": np.broadcast_to(fee, entry.shape),
+        "end_reason": trades["end_reason"][idx],
+        "trade_duration": trades["trade_duration"][idx],
+    }
+
+
+def _masked_max(values, mask):
+    """ Max of every row over the masked values, NaN for a row without any. """
+    maxima = np.where(mask, values, -np.inf).max(axis=1, initial=-np.inf)
+    return np.where(np.isneginf(maxima), np.nan, maxima)
+
+
+def replay(batch: dict, initial_capital, max_position_capital=MAX_POSITION_CAPITAL):
+    """
+    The result_json trade statistics of every replica. The capital is carried from trade to trade for all the
+    replicas at once, with the arithmetic of Strategy.buy/sell and Trade.end_trade.
+    """
+    entry, exit_price, fee = batch["entry_price"], batch["sell_price"], batch["fee"]
+    n_replicas, n = entry.shape
+    capital = np.full(n_replicas, float(initial_capital))
+    before = np.empty((n_replicas, n))
+    position_capital = np.empty((n_replicas, n))
+    for k in range(n):
+        before[:, k] = capital
+        position_capital[:, k] = np.minimum(capital, max_position_capital)
+        size = position_capital[:, k] * (1 - fee[:, k]) / entry[:, k]
+        capital = capital + (exit_price[:, k] * size * (1 - fee[:, k]) - position_capital[:, k])
+    size = position_capital * (1 - fee) / entry
+    profit = exit_price * size * (1 - fee) - position_capital
+    total_fee = fee * position_capital + fee * size * exit_price
+    profit_percentage = profit / position_capital
+    win = profit_percentage > 0
+    wins = win.sum(axis=1)
+    losses = n - wins
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_profit = np.where(win, profit_percentage, 0).sum(axis=1) / wins
+        mean_loss = np.where(~win, profit_percentage, 0).sum(axis=1) / losses
+        after = before + profit
+        trough = before - position_capital + size * batch["lowest_price"] * (1 - fee)
+        peak = np.maximum.accumulate(np.concatenate([np.full((n_replicas, 1), float(initial_capital)),
+                                                     after[:, :-1]], axis=1), axis=1)
+        drawdown = (batch["entry_price"] - batch["lowest_price"]) / batch["entry_price"]
+        highest_possible_win = (batch["highest_price"] - batch["entry_price"]) / batch["entry_price"]
+        result = {
+            "end_capital": capital,
+            "winning_trades": wins,
+            "losing_trades": losses,
+            "win_%": wins / n if n else np.zeros(n_replicas),
+            "profit_loss_mean_ratio": np.abs(mean_profit / mean_loss),
+            "mean_loss": mean_loss,
+            "mean_profit": mean_profit,
+            "avg_trade_len": np.trunc(batch["trade_duration"].mean(axis=1)) if n else np.zeros(n_replicas),
+            "total_fees_usd": total_fee.sum(axis=1),
+            "total_win_usd": np.where(win, profit, 0).sum(axis=1),
+            "total_loss_and_fees_usd": np.where(~win, profit, 0).sum(axis=1),
+            "max_drawdown": drawdown.max(axis=1) if n else np.full(n_replicas, np.nan),
+            "max_drawdown_winning_trade": _masked_max(drawdown, win),
+            "highest_possible_win": highest_possible_win.max(axis=1) if n else np.full(n_replicas, np.nan),
+            "highest_possible_win_losing_trade": _masked_max(highest_possible_win, ~win),
+            "portfolio_max_drawdown": np.maximum(((peak - np.minimum(trough, after)) / peak).max(axis=1), 0)
+            if n else np.zeros(n_replicas),
+        }
+    for reason_name, column in REASON_COLUMNS:
+        reason_count = (batch["end_reason"] == END_REASONS.index(reason_name)).sum(axis=1)
+        result[column] = reason_count / n * 100 if n else np.zeros(n_replicas)
+    return result
+
+
+def _run_chunk(chunk_input):
+    trades, n_replicas, seed_sequence, initial_capital, options = chunk_input
+    rng = np.random.default_rng(seed_sequence)
+    return pd.DataFrame(replay(replica_batch(trades, n_replicas, rng, **options), initial_capital))
+
+
+def monte_carlo(trade_df: pd.DataFrame, initial_capital, replicas=REPLICAS, chunk_size=CHUNK_SIZE, workers=WORKERS,
+                seed=SEED, bootstrap=BOOTSTRAP, fee_range=FEE_RANGE, slippage=SLIPPAGE):
+    """
+    Statistics of replicas of the trades of a run, one row per replica. Chunk i of the replicas draws from
+    the i-th child of SeedSequence(seed), so the replicas are the same for any number of workers.
+    """
+    trades = trade_arrays(trade_df)
+    sizes = [min(chunk_size, replicas - start) for start in range(0, replicas, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    options = {"bootstrap": bootstrap, "fee_range": fee_range, "slippage": slippage}
+    chunk_inputs = [(trades, size, chunk_seed, initial_capital, options) for size, chunk_seed in zip(sizes, seeds)]
+    if workers <= 1:
+        chunks = list(map(_run_chunk, chunk_inputs))
+    else:
+        with Pool(workers) as pool:
+            chunks = pool.map(_run_chunk, chunk_inputs)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def percentile_table(replica_df: pd.DataFrame, percentiles=PERCENTILES):
+    """ Mean and percentiles of every statistic over the replicas, NaN replicas are left out. """
+    values = replica_df.to_numpy(dtype=np.float64)
+    with np.errstate(invalid="ignore"):
+        table = pd.DataFrame(np.nanpercentile(values, percentiles, axis=0).T, index=replica_df.columns,
+                             columns=["p{}".format(p) for p in percentiles])
+    table.insert(0, "mean", np.nanmean(values, axis=0))
+    return table.round(4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monte Carlo replicas of the trades of a stored run")
+    parser.add_argument("run_name")
+    parser.add_argument("--replicas", type=int, default=REPLICAS)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--no-bootstrap", action="store_true")
+    parser.add_argument("--slippage", type=float, default=SLIPPAGE)
+    parser.add_argument("--fee-range", type=float, nargs=2, default=FEE_RANGE, metavar=("LOW", "HIGH"),
+                        help="trade_fee of every replica drawn uniformly from it")
+    parser.add_argument("--no-fee-range", action="store_true", help="keep the recorded fee of every trade")
+    args = parser.parse_args()
+
+    t = time.time()
+    trade_df = load_trades(args.run_name, config_dict.get("artifacts", {}).get("directory", "runs/store"))
+    replica_df = monte_carlo(trade_df, config_dict["params"]["initial_capital"], args.replicas, workers=args.workers,
+                             seed=args.seed, bootstrap=not args.no_bootstrap, slippage=args.slippage,
+                             fee_range=None if args.no_fee_range else tuple(args.fee_range))
+    table = percentile_table(replica_df)
+    output_file = "monte_carlo_{}_{}_replicas.csv".format(args.run_name, args.replicas)
+    table.to_csv(output_file)
+    print(table)
+    print("Saved to {}. time: {}".format(output_file, time.time() - t))
+
+
+if __name__ == "__main__":
+    main()
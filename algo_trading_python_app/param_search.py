@@ -0,0 +1,229 @@
+from bisect import bisect_left, bisect_right
+import itertools
+import math
+
+import numpy as np
+import pandas as pd
+
+from metrics import _ratio
+from trade import END_REASONS
+from vectorized_engine import next_true_index, signal_masks
+
+TP_HIT, SL_HIT, TTL_HIT, ML_MODEL = [END_REASONS.index(reason) for reason in ["tp_hit", "sl_hit", "ttl_hit", "ml_model"]]
+
+
+class PathStats:
+    """
+    Outcome of any TP/SL/TTL without replaying the minutes. For every minute a position can be opened at (the
+    buy signal minutes), the path until the model sells is summarized once by its record highs and lows (the
+    checked minutes where the price goes above / below every earlier checked price). The first minute a TP or SL
+    level is crossed is then a binary search in these records. The TP, SL and TTL exits of all the entries are
+    computed once per value and cached, so a combination only combines three arrays and walks from trade to
+    trade. Trades are the same as the engines'.
+    max_ttl (minutes) bounds the summarized paths when every searched combination has a TTL.
+    """
+    def __init__(self, times, prices, signal_idx, predictions, classes, max_ttl=None):
+        self.times = np.asarray(times, dtype=np.int64)
+        self.prices = np.asarray(prices, dtype=np.float64)
+        self.n = len(self.prices)
+        buy, sell, _ = signal_masks(predictions, np.asarray(signal_idx, dtype=np.int64), classes)
+        # TP/SL/TTL are checked on every minute except the ones where the model says sell
+        self.check = ~sell
+        self.next_check = next_true_index(self.check)
+        next_buy = next_true_index(buy)
+        self.entries = np.flatnonzero(buy)
+        self.entry_prices = self.prices[self.entries]
+        self.ml_exits = next_true_index(sell)[self.entries + 1]
+        self.max_ttl_ns = pd.Timedelta(minutes=max_ttl).value if max_ttl else None
+        # index in entries of the next entry after each minute
+        self.next_entry = np.searchsorted(self.entries, next_buy)
+        self.records = [self.entry_records(i) for i in range(len(self.entries))]
+        self.__exits = {"tp": {}, "sl": {}, "ttl": {}}
+
+    def ttl_exits(self, entries, ttl_ns):
+        return self.next_check[np.searchsorted(self.times, self.times[entries] + ttl_ns)]
+
+    def entry_records(self, i):
+        """ (high minutes, high prices, low minutes, -low prices) of the checked minutes before the model sells. """
+        entry = self.entries[i]
+        hi = self.ml_exits[i]
+        if self.max_ttl_ns is not None:
+            hi = min(hi, self.ttl_exits(entry, self.max_ttl_ns) + 1)
+        minutes = entry + 1 + np.flatnonzero(self.check[entry + 1:hi])
+        values = self.prices[minutes]
+        if len(values):
+            high = np.concatenate([[True], values[1:] > np.maximum.accumulate(values)[:-1]])
+            low = np.concatenate([[True], values[1:] < np.minimum.accumulate(values)[:-1]])
+        else:
+            high = low = np.zeros(0, dtype=bool)
+        return minutes[high].tolist(), values[high].tolist(), minutes[low].tolist(), (-values[low]).tolist()
+
+    def tp_exits(self, tp):
+        """ First minute of every entry where the price is >= entry price * (1 + tp), n if never. """
+        if tp not in self.__exits["tp"]:
+            exits = np.full(len(self.entries), self.n, dtype=np.int64)
+            for i, (entry_price, (high_minutes, high_prices, _, _)) in enumerate(zip(self.entry_prices.tolist(),
+                                                                                     self.records)):
+                k = bisect_left(high_prices, entry_price + entry_price * tp)
+                if k < len(high_minutes):
+                    exits[i] = high_minutes[k]
+            self.__exits["tp"][tp] = exits
+        return self.__exits["tp"][tp]
+
+    def sl_exits(self, sl):
+        """ First minute of every entry where the price is < entry price * (1 - sl), n if never. """
+        if sl not in self.__exits["sl"]:
+            exits = np.full(len(self.entries), self.n, dtype=np.int64)
+            for i, (entry_price, (_, _, low_minutes, low_negative_prices)) in enumerate(zip(self.entry_prices.tolist(),
+                                                                                            self.records)):
+                k = bisect_right(low_negative_prices, -(entry_price - entry_price * sl))
+                if k < len(low_minutes):
+                    exits[i] = low_minutes[k]
+            self.__exits["sl"][sl] = exits
+        return self.__exits["sl"][sl]
+
+    def exits(self, tp=None, sl=None, ttl=None):
+        """ Exit minute and end reason of a position opened at every entry, n and -1 when it is never closed. """
+        n = self.n
+        if ttl:
+            if ttl not in self.__exits["ttl"]:
+                self.__exits["ttl"][ttl] = self.ttl_exits(self.entries, pd.Timedelta(minutes=ttl).value)
+            ttl_exits = self.__exits["ttl"][ttl]
+        else:
+            ttl_exits = np.full(len(self.entries), n, dtype=np.int64)
+        tp_exits = self.tp_exits(tp) if tp else np.full(len(self.entries), n, dtype=np.int64)
+        sl_exits = self.sl_exits(sl) if sl else np.full(len(self.entries), n, dtype=np.int64)
+        # tp is checked first when both are hit on the same minute, both before the ttl
+        tp_sl_exits = np.minimum(tp_exits, sl_exits)
+        tp_sl = (tp_sl_exits < n) & (tp_sl_exits <= ttl_exits)
+        ttl_hit = ~tp_sl & (ttl_exits < self.ml_exits) & (ttl_exits < n)
+        ml_model = ~tp_sl & ~ttl_hit & (self.ml_exits < n)
+        exits = np.select([tp_sl, ttl_hit, ml_model], [tp_sl_exits, ttl_exits, self.ml_exits], n)
+        reasons = np.select([tp_sl & (tp_exits <= sl_exits), tp_sl, ttl_hit, ml_model],
+                            [TP_HIT, SL_HIT, TTL_HIT, ML_MODEL], -1)
+        return exits, reasons
+
+    def trades(self, tp=None, sl=None, ttl=None, end=None):
+        """ Entry minutes, exit minutes and end reasons of the trades closed before the minute end. """
+        end = self.n if end is None else end
+        exits, reasons = self.exits(tp, sl, ttl)
+        after_exit = self.next_entry[np.minimum(exits + 1, self.n)].tolist()
+        exit_list = exits.tolist()
+        chain = []
+        i = 0
+        n_entries = len(self.entries)
+        while i < n_entries and exit_list[i] < end:
+            chain.append(i)
+            i = after_exit[i]
+        return self.entries[chain], exits[chain], reasons[chain]
+
+    def evaluate(self, tp=None, sl=None, ttl=None, fee=0.00075, initial_capital=100, max_position_capital=100,
+                 end=None):
+        """ The capital and trade counts of a run, with the same arithmetic as Strategy.buy/sell. """
+        entries, exits, reasons = self.trades(tp, sl, ttl, end)
+        capital = initial_capital
+        wins = 0
+        for entry_price, exit_price in zip(self.prices[entries].tolist(), self.prices[exits].tolist()):
+            position_capital = min(capital, max_position_capital)
+            size = position_capital * (1 - fee) / entry_price
+            profit = exit_price * size * (1 - fee) - position_capital
+            capital = capital + profit
+            wins += profit / position_capital > 0
+        n = len(entries)
+        reason_counts = np.bincount(reasons, minlength=len(END_REASONS)).tolist()
+        return {
+            "end_capital": round(capital, 2),
+            "number_of_trades": n,
+            "winning_trades": wins,
+            "win_%": _ratio(wins, n),
+            "model_end_trade_%": _ratio(reason_counts[ML_MODEL], n, 100),
+            "tp_hit_%": _ratio(reason_counts[TP_HIT], n, 100),
+            "sl_hit_%": _ratio(reason_counts[SL_HIT], n, 100),
+            "ttl_hit_%": _ratio(reason_counts[TTL_HIT], n, 100),
+        }
+
+
+def _score_rows(stats: PathStats, candidates, params: dict, end=None):
+    rows = []
+    for tp, sl, ttl in candidates:
+        row = {"tp": tp, "sl": sl, "ttl": ttl}
+        row.update(stats.evaluate(tp, sl, ttl, params["trade_fee"], params["initial_capital"], end=end))
+        rows.append(row)
+    return rows
+
+
+def grid_search(stats: PathStats, tps, sls, ttls, params: dict):
+    """ Every combination, scored from the path statistics. """
+    return pd.DataFrame(_score_rows(stats, itertools.product(tps, sls, ttls), params))
+
+
+def successive_halving(stats: PathStats, candidates, params: dict, eta=3, min_fraction=1 / 27,
+                       objective="end_capital"):
+    """
+    Scores all the candidates on the first min_fraction of the minutes, keeps the best 1 / eta of them, scores
+    those on eta times more minutes, and so on until the survivors are scored on all the minutes.
+    """
+    candidates = list(candidates)
+    fraction = min_fraction
+    rounds = []
+    while True:
+        end = stats.n if fraction >= 1 else int(stats.n * fraction)
+        df = pd.DataFrame(_score_rows(stats, candidates, params, end))
+        df["fraction"] = min(fraction, 1.0)
+        rounds.append(df)
+        if fraction >= 1 or len(candidates) <= 1:
+            break
+        keep = max(1, int(math.ceil(len(candidates) / eta)))
+        best = df.sort_values(objective, ascending=False, kind="stable").index[:keep]
+        candidates = [candidates[i] for i in sorted(best)]
+        fraction *= eta
+    return pd.concat(rounds, ignore_index=True)
+
+
+def bayesian_search(stats: PathStats, params: dict, tp_range=(0.001, 0.1), sl_range=(0.001, 0.1),
+                    ttl_range=(30, 1440), n_initial=20, n_iter=80, pool_size=2000, off_probability=0.2, seed=0,
+                    objective="end_capital"):
+    """
+    Gaussian process search with expected improvement. Each of TP, SL and TTL is off (None) with
+    off_probability, otherwise uniform in its range; the TTL is rounded to whole minutes.
+    """
+    from sklearn.gaussian_process import GaussianProcessRegressor
+    from sklearn.gaussian_process.kernels import Matern
+    from scipy.stats import norm
+
+    rng = np.random.default_rng(seed)
+    ranges = np.array([tp_range, sl_range, ttl_range], dtype=np.float64)
+
+    def sample(size):
+        u = rng.random((size, 3))
+        u[rng.random((size, 3)) < off_probability] = -1  # -1 is off
+        return u
+
+    def decode(u):
+        values = [None if x < 0 else lo + x * (hi - lo) for x, (lo, hi) in zip(u, ranges)]
+        return (None if values[0] is None else round(values[0], 5), None if values[1] is None else round(values[1], 5),
+                None if values[2] is None else int(round(values[2])))
+
+    evaluated = []
+    points = []
+    scores = []
+    for u in sample(n_initial):
+        row = _score_rows(stats, [decode(u)], params)[0]
+        evaluated.append(row)
+        points.append(u)
+        scores.append(row[objective])
+    gp = GaussianProcessRegressor(kernel=Matern(nu=2.5), normalize_y=True, random_state=seed)
+    for _ in range(n_iter):
+        gp.fit(np.array(points), np.array(scores))
+        pool = sample(pool_size)
+        mean, std = gp.predict(pool, return_std=True)
+        improvement = mean - max(scores)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = np.where(std > 0, improvement / std, 0.0)
+        expected_improvement = np.where(std > 0, improvement * norm.cdf(z) + std * norm.pdf(z), 0.0)
+        u = pool[int(np.argmax(expected_improvement))]
+        row = _score_rows(stats, [decode(u)], params)[0]
+        evaluated.append(row)
+        points.append(u)
+        scores.append(row[objective])
+    return pd.DataFrame(evaluated)
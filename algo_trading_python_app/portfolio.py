@@ -0,0 +1,291 @@
+import heapq
+import json
+import time
+from datetime import timedelta
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from backtest import align_minutes, save_run
+from columnar import read_table
+from config import config_dict, MODEL_FILE
+from inference import ChunkedPredictor
+from instrumentation import Instrumentation
+from metrics import REASON_COLUMNS, batch_results, daily_returns, sharpe_sortino
+from strategy import load_model_cached
+from trade import Trade, TradeLedger, END_REASONS
+from vectorized_engine import ExitSearch, signal_masks
+
+
+def predict_symbols(predictor: ChunkedPredictor, feature_sets: list, window_length, scaler):
+    """
+    Predictions of every symbol from one chunked inference call: the feature rows of all the symbols are
+    stacked and the windows overlapping two symbols are dropped.
+    """
+    stacked = np.concatenate([np.asarray(features, dtype=np.float64) for features in feature_sets])
+    predictions = predictor.predict(stacked, window_length, scaler)
+    out = []
+    start = 0
+    for features in feature_sets:
+        out.append(predictions[start:start + max(len(features) - window_length + 1, 0)])
+        start += len(features)
+    return out
+
+
+EXIT, BUY = 0, 1  # on a minute the exits are done before the entries
+
+
+class PortfolioEngine:
+    """
+    Runs the strategy on N symbols with a shared capital. Every symbol keeps its own aligned minute arrays and
+    the exit of a position is found by its ExitSearch, with the TP/SL/TTL checks of Strategy.notify. The run
+    goes from event to event (buy signals and exits of all the symbols) in time order, so the cost grows with
+    the minutes of every symbol and the number of trades, not with the union of the minutes times the symbols.
+    A position gets min(free capital, max_position_fraction * capital, max_position_capital). On a minute the
+    exits are done before the entries, both in symbol order. With one symbol, max_position_fraction=1 and
+    max_position_capital=100 the trades are the same as the single asset backtest.
+    """
+    def __init__(self, symbols: list, aligned: list, predictions: list, params: dict, classes,
+                 max_position_fraction=1.0, max_position_capital=None, run_name=""):
+        """ aligned has the (times, prices, signal_idx) of align_minutes for every symbol. """
+        self.symbols = symbols
+        self.tp = params.get("tp", None)
+        self.sl = params.get("sl", None)
+        self.ttl = params.get("ttl", None)
+        self.searches = []
+        # the union of the minutes, only for the exposure and the period of the results
+        self.times = np.empty(0, dtype=np.int64)
+        for (times, prices, signal_idx), symbol_predictions in zip(aligned, predictions):
+            times = np.asarray(times, dtype=np.int64)
+            buy, sell, _ = signal_masks(symbol_predictions, np.asarray(signal_idx, dtype=np.int64), classes)
+            self.searches.append(ExitSearch(times, np.asarray(prices, dtype=np.float64), buy, sell,
+                                            self.tp, self.sl, self.ttl))
+            self.times = np.union1d(self.times, times)
+        self.fee = params["trade_fee"]
+        self.initial_capital = params["initial_capital"]
+        self.capital = params["initial_capital"]
+        self.max_position_fraction = max_position_fraction
+        self.max_position_capital = max_position_capital
+        self.run_name = run_name
+
+        n = len(symbols)
+        self.in_position = np.zeros(n, dtype=bool)
+        self.position_capital = np.zeros(n)
+        self.position_size = np.zeros(n)
+        self.entry = np.zeros(n, dtype=np.int64)
+        self.exit_reason = [None] * n
+        self.trades = [None] * n
+        self.ledgers = [TradeLedger() for _ in symbols]
+        self.skipped_buys = 0
+        self.max_open_positions = 0
+        # (entry, exit] time of every position, for the minutes spent in a position
+        self.position_spans = []
+        # realized capital after every exit
+        self.equity_times = []
+        self.equity = []
+
+    def buy(self, s, minute):
+        """ Opens a position of symbol s at its minute, False when there is no free capital. """
+        search = self.searches[s]
+        price = float(search.prices[minute])
+        free_capital = self.capital - self.position_capital[self.in_position].sum()
+        position_capital = min(free_capital, self.capital * self.max_position_fraction)
+        if self.max_position_capital is not None:
+            position_capital = min(position_capital, self.max_position_capital)
+        if position_capital <= 0:
+            self.skipped_buys += 1
+            return False
+        buy_fee = self.fee * position_capital
+        size = position_capital * (1 - self.fee) / price
+        self.in_position[s] = True
+        self.position_capital[s] = position_capital
+        self.position_size[s] = size
+        self.entry[s] = minute
+        self.trades[s] = Trade(before_trade_capital=self.capital, position_capital=position_capital,
+                               entry_price=price, buy_fee=buy_fee, size=size,
+                               start_time=pd.Timestamp(search.times[minute]), fee_percentage=self.fee,
+                               sl=self.sl, tp=self.tp, ttl=self.ttl)
+        self.max_open_positions = max(self.max_open_positions, int(self.in_position.sum()))
+        return True
+
+    def sell(self, s, minute, end_reason):
+        search = self.searches[s]
+        price = float(search.prices[minute])
+        size = float(self.position_size[s])
+        sell_fee = self.fee * size * price
+        profit = price * size * (1 - self.fee) - float(self.position_capital[s])
+        self.capital = self.capital + profit
+        trade = self.trades[s]
+        path = search.prices[self.entry[s]:minute + 1]
+        trade.update_lowest_price(float(path.min()))
+        trade.update_lowest_price(float(path.max()))
+        trade.end_trade(sell_price=price, sell_fee=sell_fee, end_time=pd.Timestamp(search.times[minute]),
+                        end_reason=end_reason)
+        self.ledgers[s].append(trade)
+        self.trades[s] = None
+        self.in_position[s] = False
+        self.position_capital[s] = 0.0
+        self.position_spans.append((search.times[self.entry[s]], search.times[minute]))
+        self.equity_times.append(search.times[minute])
+        self.equity.append(self.capital)
+
+    def run(self):
+        events = []
+
+        def next_buy(s, minute):
+            search = self.searches[s]
+            minute = search.next_buy[minute]
+            if minute < len(search.times):
+                heapq.heappush(events, (search.times[minute], BUY, s, minute))
+
+        for s in range(len(self.symbols)):
+            next_buy(s, 0)
+        while events:
+            _, kind, s, minute = heapq.heappop(events)
+            if kind == EXIT:
+                self.sell(s, minute, self.exit_reason[s])
+                next_buy(s, minute + 1)
+            elif self.buy(s, minute):
+                exit_idx, self.exit_reason[s] = self.searches[s].find_exit(minute)
+                if self.exit_reason[s] is None:
+                    # still opened at the end: keeps its capital, not counted as a trade like Strategy.end
+                    self.position_spans.append((self.searches[s].times[minute], np.iinfo(np.int64).max))
+                    self.trades[s] = None
+                    continue
+                heapq.heappush(events, (self.searches[s].times[exit_idx], EXIT, s, exit_idx))
+            else:
+                next_buy(s, minute + 1)
+
+    def minutes_in_position(self):
+        """ Minutes of the union of the minutes with a position opened before the minute. """
+        count = 0
+        end = None
+        for lo, hi in sorted(self.position_spans):
+            if end is not None and lo < end:
+                lo = end
+            if hi > lo:
+                count += np.searchsorted(self.times, hi, side="right") - np.searchsorted(self.times, lo, side="right")
+                end = hi
+        return int(count)
+
+    def trade_df(self):
+        frames = []
+        for symbol, ledger in zip(self.symbols, self.ledgers):
+            df = ledger.to_frame(self.sl, self.tp, self.ttl, self.run_name)
+            df.insert(0, "symbol", symbol)
+            frames.append(df)
+        trade_df = pd.concat(frames, ignore_index=True)
+        trade_df["end_reason"] = pd.Categorical(trade_df["end_reason"], END_REASONS)
+        return trade_df.sort_values(["end_time", "symbol"], kind="stable").reset_index(drop=True)
+
+    def result_json(self, trade_df: pd.DataFrame, duration):
+        """ Portfolio results from the realized capital after every exit, with the per symbol statistics. """
+        equity = pd.Series([self.initial_capital] + self.equity,
+                           index=pd.DatetimeIndex(np.concatenate([self.times[:1], self.equity_times]).astype(
+                               "datetime64[ns]")), name="capital")
+        peak = np.maximum.accumulate(equity.to_numpy())
+        period = (self.times[0], self.times[-1]) if len(self.times) else None
+        win = trade_df["trade_verdict"].to_numpy() == "WIN"
+        n = len(trade_df)
+        overall = batch_results({"portfolio": trade_df}, self.initial_capital).iloc[0].to_dict()
+        result = {
+            "end_capital": round(self.capital, 2),
+            "number_of_trades": n,
+            "winning_trades": int(win.sum()),
+            "win_%": round(float(win.sum()) / n, 4) if n else 0.0,
+            "mean_loss": float(overall["mean_loss"]),
+            "mean_profit": float(overall["mean_profit"]),
+            "total_fees_usd": round(float(trade_df["total_fee"].to_numpy().sum()), 4),
+            "max_drawdown": round(float(((peak - equity.to_numpy()) / peak).max()), 4),
+            "skipped_buys": self.skipped_buys,
+            "max_open_positions": self.max_open_positions,
+            "exposure_%": round(self.minutes_in_position() / len(self.times) * 100, 4) if len(self.times) else 0.0,
+            "run_time": duration,
+        }
+        result.update({column: float(overall[column]) for _, column in REASON_COLUMNS})
+        result["sharpe"], result["sortino"] = sharpe_sortino(daily_returns(equity, period)) if n else (np.nan, np.nan)
+        by_symbol = batch_results({symbol: trade_df[trade_df["symbol"] == symbol] for symbol in self.symbols},
+                                  self.initial_capital)
+        by_symbol["profit_usd"] = trade_df.groupby("symbol")["profit"].sum().reindex(self.symbols).fillna(0).round(4)
+        result["symbols"] = json.loads(by_symbol.drop(columns=["end_capital"]).to_json(orient="index"))
+        return result
+
+
+class PortfolioBacktester:
+    """ Loads the symbols of config["portfolio"], predicts them with the configured model and runs the portfolio. """
+    def __init__(self, config: dict):
+        self.config = config
+        self.portfolio = config["portfolio"]
+        self.symbols = list(self.portfolio["symbols"])
+        self.instrumentation = Instrumentation.from_config(config)
+        self.datasets = []
+        self.minutes = []
+        self.engine = None
+        self.results_json = None
+        self.trade_df = None
+
+    def load(self):
+        window_length = self.config["window_length"]
+        with self.instrumentation.stage("load"):
+            for symbol in self.symbols:
+                files = self.portfolio["symbols"][symbol]
+                data = read_table(files["dataset"]).drop(columns=["close"])
+                self.datasets.append(data)
+                self.minutes.append(read_table(files["minutes"], data.index[window_length-1],
+                                               data.index[-1] + timedelta(minutes=1)))
+
+    def predict(self):
+        cfg = self.config
+        model_file = cfg.get("model_file", MODEL_FILE[cfg["model"]])
+        predictor = ChunkedPredictor(load_model_cached(cfg["model"], model_file), cfg["model"],
+                                     **cfg.get("inference", {}))
+        with self.instrumentation.stage("prediction"):
+            predictions = predict_symbols(predictor, [data.to_numpy()[:, :-1] for data in self.datasets],
+                                          cfg["window_length"], joblib.load(cfg["scaler"]))
+        if cfg["log_to_stdout"]:
+            print("Predicted {rows} rows of {symbols} symbols in {seconds}s".format(symbols=len(self.symbols),
+                                                                                   **predictor.stats()))
+        return predictions
+
+    def run(self, predictions=None):
+        cfg = self.config
+        start_time = time.time()
+        if not self.datasets:
+            self.load()
+        if predictions is None:
+            predictions = self.predict()
+        with self.instrumentation.stage("alignment"):
+            aligned = [align_minutes(minutes, data.index[cfg["window_length"]-1:], cfg["timeframe"])
+                       for data, minutes in zip(self.datasets, self.minutes)]
+        self.engine = engine = PortfolioEngine(self.symbols, aligned, predictions, cfg["params"], cfg["classes"],
+                                 self.portfolio.get("max_position_fraction", 1.0),
+                                 self.portfolio.get("max_position_capital", None), cfg["run_name"])
+        with self.instrumentation.stage("engine"):
+            engine.run()
+        with self.instrumentation.stage("results"):
+            self.trade_df = engine.trade_df()
+            self.results_json = engine.result_json(self.trade_df, time.time() - start_time)
+        self.save()
+        return self.results_json
+
+    def save(self):
+        """
+        Saved like a single asset run (save_run). The stored trades are the ones of every symbol in turn, in the
+        config symbols order, the number_of_trades of each symbol in the results splits them.
+        """
+        trades = np.concatenate([ledger.view() for ledger in self.engine.ledgers])
+        save_run(self.config, self.results_json, trades, self.instrumentation.report(), self.trade_df)
+
+
+def main():
+    t = time.time()
+    tester = PortfolioBacktester(config_dict)
+    results = tester.run()
+    print({name: value for name, value in results.items() if name != "symbols"})
+    print(pd.DataFrame(results["symbols"]).T)
+    print("time: {}".format(time.time() - t))
+
+
+if __name__ == "__main__":
+    main()
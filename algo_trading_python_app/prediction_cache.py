@@ -0,0 +1,93 @@
+import hashlib
+import os
+
+import numpy as np
+
+from columnar import columnar_path, use_columnar
+from config import MODEL_FILE
+
+CACHE_VERSION = 2  # 2: (n, 1) class predictions for every model type, and the threshold in the key
+
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, "rb") as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def table_hash(csv_path):
+    """ Hash of what read_table loads: the csv, or its columnar copy, which can be used without the csv. """
+    if not use_columnar(csv_path):
+        return file_hash(csv_path)
+    cols_path = columnar_path(csv_path)
+    digest = hashlib.sha1()
+    for name in sorted(os.listdir(cols_path)):
+        digest.update(name.encode())
+        digest.update(file_hash(os.path.join(cols_path, name)).encode())
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    """
+    Model predictions (and optionally the scaled X) stored as .npy files, keyed by the content of the model,
+    scaler and dataset files plus the window length and class threshold. Least recently used entries are removed
+    once the cache grows over max_size_mb.
+    """
+    def __init__(self, cache_dir="cache", max_size_mb=1024, enabled=True, store_X=False):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1024 * 1024
+        self.enabled = enabled
+        self.store_X = store_X
+
+    def key(self, config: dict):
+        digest = hashlib.sha1()
+        for part in [CACHE_VERSION, config["model"], config["classes"], config["window_length"],
+                     config.get("inference", {}).get("threshold", 0.5),
+                     file_hash(config.get("model_file", MODEL_FILE[config["model"]])), file_hash(config["scaler"]),
+                     table_hash(config["dataset"])]:
+            digest.update(str(part).encode())
+        return digest.hexdigest()
+
+    def __path(self, key, name):
+        return os.path.join(self.cache_dir, "{}_{}.npy".format(key, name))
+
+    def load(self, key, name):
+        if not self.enabled:
+            return None
+        path = self.__path(key, name)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)  # mark as recently used for the eviction
+        return np.load(path, mmap_mode="r")
+
+    def save(self, key, name, array):
+        if not self.enabled:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.__path(key, name)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as fout:
+            np.save(fout, np.asarray(array))
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def entries(self):
+        if not os.path.exists(self.cache_dir):
+            return []
+        paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith(".npy")]
+        return sorted(paths, key=os.path.getmtime)
+
+    def evict(self):
+        entries = self.entries()
+        total_size = sum(os.path.getsize(path) for path in entries)
+        for path in entries:
+            if total_size <= self.max_size:
+                break
+            total_size -= os.path.getsize(path)
+            os.remove(path)
+
+    def clear(self):
+        for path in self.entries():
+            os.remove(path)
@@ -0,0 +1,329 @@
+import argparse
+import atexit
+import fcntl
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from trade import LEDGER_DTYPE, TradeLedger
+
+STORE_DIR = "runs/store"
+INDEX_FILE = "runs.jsonl"
+LOOKUP_FILE = "lookup.json"
+LOCK_FILE = "store.lock"
+PART_FILE = "trades_{}_{}_{}.npy"
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+@contextmanager
+def _locked(directory, shared=False):
+    """ Lock of the runs.jsonl and lookup.json files of a store, shared by the processes writing to it. """
+    with open(os.path.join(directory, LOCK_FILE), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _write_atomic(path, data: bytes):
+    with open(path + ".tmp", "wb") as fout:
+        fout.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def _read_lookup(directory):
+    """
+    run_name -> part, offset and count of its trades and the byte offset of its runs.jsonl line, for the last
+    line of every run. Rebuilt from runs.jsonl when missing (stores written before the lookup file).
+    """
+    path = os.path.join(directory, LOOKUP_FILE)
+    if os.path.exists(path):
+        with open(path) as fin:
+            return json.load(fin)
+    lookup = {"runs": {}, "superseded": 0}
+    index_path = os.path.join(directory, INDEX_FILE)
+    if os.path.exists(index_path):
+        with open(index_path, "rb") as fin:
+            line_offset = 0
+            for line in fin:
+                entry = json.loads(line)
+                _set_run(lookup, entry, line_offset)
+                line_offset += len(line)
+    return lookup
+
+
+def _set_run(lookup, entry, line_offset):
+    if entry["run_name"] in lookup["runs"]:
+        lookup["superseded"] += 1
+    lookup["runs"][entry["run_name"]] = {"part": entry["part"], "offset": entry["offset"], "count": entry["count"],
+                                         "line": line_offset}
+
+
+class RunStore:
+    """
+    Run artifacts of many backtests in a few files. The trades of a batch of runs are appended to one .npy part
+    (LEDGER_DTYPE rows, run after run) and every run gets one line in runs.jsonl with its config, results,
+    monthly breakdown and the part, offset and count of its trades. lookup.json maps every run_name to its last
+    line and trades, so one run is loaded without reading the others. Batches of batch_runs runs are written by
+    a background thread, off the backtest loop. A process writes its own parts, runs.jsonl and lookup.json are
+    shared and updated under a file lock.
+    """
+    def __init__(self, directory=STORE_DIR, batch_runs=32, background=True):
+        self.directory = directory
+        self.batch_runs = batch_runs
+        self.background = background
+        os.makedirs(directory, exist_ok=True)
+        self.__part_prefix = (os.getpid(), time.time_ns())
+        self.__parts = 0
+        self.__pending = []
+        self.__queue = queue.Queue()
+        self.__error = None
+        self.__thread = None
+        if background:
+            self.__thread = threading.Thread(target=self.__write_loop, name="run-store", daemon=True)
+            self.__thread.start()
+
+    def add(self, config: dict, results_json: dict, trades, instrumentation: dict = None, monthly: list = None):
+        """ trades are the LEDGER_DTYPE rows of the run (TradeLedger.view()). """
+        self.__raise_error()
+        self.__pending.append((config, results_json, np.array(trades, dtype=LEDGER_DTYPE), instrumentation, monthly))
+        if len(self.__pending) >= self.batch_runs:
+            self.__submit()
+
+    def __raise_error(self):
+        """ A batch the writer thread failed to write is reported on the next add or flush. """
+        if self.__error is not None:
+            error, self.__error = self.__error, None
+            raise Exception("writing runs to {} failed".format(self.directory)) from error
+
+    def __submit(self):
+        if not self.__pending:
+            return
+        batch, self.__pending = self.__pending, []
+        if self.background:
+            self.__queue.put(batch)
+        else:
+            self.__write_batch(batch)
+
+    def __write_loop(self):
+        while True:
+            batch = self.__queue.get()
+            try:
+                if batch is not None:
+                    self.__write_batch(batch)
+            except Exception as error:
+                # the thread keeps writing the next batches, the caller gets the error on its next add or flush
+                traceback.print_exc()
+                self.__error = error
+            finally:
+                self.__queue.task_done()
+            if batch is None:
+                return
+
+    def __write_batch(self, batch):
+        part = PART_FILE.format(*self.__part_prefix, self.__parts)
+        self.__parts += 1
+        rows = np.concatenate([trades for _, _, trades, _, _ in batch])
+        tmp_file = os.path.join(self.directory, part + ".tmp")
+        with open(tmp_file, "wb") as fout:
+            np.save(fout, rows)
+        os.replace(tmp_file, os.path.join(self.directory, part))
+
+        entries = []
+        offset = 0
+        for config, results_json, trades, instrumentation, monthly in batch:
+            entry = {"run_name": config["run_name"], "part": part, "offset": offset, "count": len(trades),
+                     "config": config, "results": results_json}
+            if monthly is not None:
+                entry["monthly"] = monthly
+            if instrumentation is not None:
+                entry["instrumentation"] = instrumentation
+            entries.append(entry)
+            offset += len(trades)
+        lines = [(json.dumps(entry, default=_json_default) + "\n").encode() for entry in entries]
+        # the parts are in place before their index lines
+        with _locked(self.directory):
+            lookup = _read_lookup(self.directory)
+            with open(os.path.join(self.directory, INDEX_FILE), "ab") as fout:
+                line_offset = fout.tell()
+                fout.write(b"".join(lines))
+            for entry, line in zip(entries, lines):
+                _set_run(lookup, entry, line_offset)
+                line_offset += len(line)
+            _write_atomic(os.path.join(self.directory, LOOKUP_FILE), json.dumps(lookup).encode())
+
+    def flush(self):
+        """ Writes the pending runs and waits until every submitted batch is on disk. """
+        self.__submit()
+        if self.background:
+            self.__queue.join()
+        self.__raise_error()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.__thread is not None:
+                self.__queue.put(None)
+                self.__thread.join()
+                self.__thread = None
+                self.background = False
+        lookup = _read_lookup(self.directory)
+        if lookup["superseded"] > len(lookup["runs"]):
+            # more reruns than runs, e.g. the same sweep run many times
+            compact(self.directory)
+
+
+_stores = {}
+
+
+def default_store(config: dict):
+    """ The RunStore of this process for the config's artifacts directory, flushed at exit. """
+    artifacts = config.get("artifacts", {})
+    directory = artifacts.get("directory", STORE_DIR)
+    if directory not in _stores:
+        _stores[directory] = RunStore(directory, artifacts.get("batch_runs", 32))
+        atexit.register(_stores[directory].close)
+    return _stores[directory]
+
+
+def flush_stores():
+    for store in _stores.values():
+        store.flush()
+
+
+def _read_entries(directory, run_names):
+    lookup = _read_lookup(directory)["runs"]
+    entries = {}
+    with open(os.path.join(directory, INDEX_FILE), "rb") as fin:
+        for run_name in run_names:
+            if run_name in lookup:
+                fin.seek(lookup[run_name]["line"])
+                entries[run_name] = json.loads(fin.readline())
+    return entries
+
+
+def read_index(directory=STORE_DIR, run_name=None):
+    """
+    The runs.jsonl entries, the last one of every run_name. The lines are found with lookup.json, with run_name
+    only the line of that run is read.
+    """
+    with _locked(directory, shared=True):
+        run_names = list(_read_lookup(directory)["runs"]) if run_name is None else [run_name]
+        return _read_entries(directory, run_names)
+
+
+def load_trades(run_name, directory=STORE_DIR):
+    """ trade_df of one run. Its part is memory-mapped, only the rows of the run are read. """
+    entries = read_index(directory, run_name)
+    if run_name not in entries:
+        raise Exception("run {} not found in {}".format(run_name, directory))
+    entry = entries[run_name]
+    part = np.load(os.path.join(directory, entry["part"]), mmap_mode="r")
+    rows = np.array(part[entry["offset"]:entry["offset"] + entry["count"]])
+    params = entry["config"]["params"]
+    return TradeLedger.from_rows(rows).to_frame(params.get("sl", None), params.get("tp", None),
+                                                params.get("ttl", None), run_name)
+
+
+def compact(directory=STORE_DIR):
+    """
+    Drops the runs.jsonl lines and the trades of the runs that were rerun since (same run_name). The parts with
+    superseded trades are rewritten with the trades still in use, parts no run uses anymore are deleted.
+    Returns the number of lines dropped.
+    """
+    if not os.path.exists(os.path.join(directory, INDEX_FILE)):
+        return 0
+    with _locked(directory):
+        lookup = _read_lookup(directory)
+        entries = _read_entries(directory, list(lookup["runs"]))
+        used = {}
+        for entry in entries.values():
+            used.setdefault(entry["part"], []).append(entry)
+        parts = set()
+        with open(os.path.join(directory, INDEX_FILE), "rb") as fin:
+            for line in fin:
+                parts.add(json.loads(line)["part"])
+
+        prefix = (os.getpid(), time.time_ns())
+        for i, part in enumerate(sorted(parts)):
+            if part not in used:
+                continue
+            rows = np.load(os.path.join(directory, part), mmap_mode="r")
+            if sum(entry["count"] for entry in used[part]) == len(rows):
+                parts.discard(part)  # no superseded trades, kept as it is
+                continue
+            new_part = PART_FILE.format(*prefix, i)
+            offset = 0
+            kept = []
+            for entry in sorted(used[part], key=lambda entry: entry["offset"]):
+                kept.append(np.array(rows[entry["offset"]:entry["offset"] + entry["count"]]))
+                entry["part"], entry["offset"] = new_part, offset
+                offset += entry["count"]
+            with open(os.path.join(directory, new_part + ".tmp"), "wb") as fout:
+                np.save(fout, np.concatenate(kept) if kept else np.empty(0, dtype=LEDGER_DTYPE))
+            os.replace(os.path.join(directory, new_part + ".tmp"), os.path.join(directory, new_part))
+            del rows
+
+        compacted = {"runs": {}, "superseded": 0}
+        lines = []
+        line_offset = 0
+        for entry in entries.values():
+            lines.append((json.dumps(entry, default=_json_default) + "\n").encode())
+            _set_run(compacted, entry, line_offset)
+            line_offset += len(lines[-1])
+        _write_atomic(os.path.join(directory, INDEX_FILE), b"".join(lines))
+        _write_atomic(os.path.join(directory, LOOKUP_FILE), json.dumps(compacted).encode())
+        # only the parts listed in the old runs.jsonl, the parts of batches being written are not indexed yet
+        for part in parts:
+            os.remove(os.path.join(directory, part))
+    return lookup["superseded"]
+
+
+def results_table(directory=STORE_DIR, param_names=("tp", "sl", "ttl")):
+    """ One row per run: the strategy params and the results. """
+    rows = []
+    for run_name, entry in read_index(directory).items():
+        row = {"run_name": run_name}
+        row.update({name: entry["config"]["params"].get(name, None) for name in param_names})
+        row.update(entry["results"])
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the run artifact store")
+    parser.add_argument("--directory", default=STORE_DIR)
+    parser.add_argument("--run", default=None, help="export the trades of this run")
+    parser.add_argument("--output", default=None, help="csv file, default <run>_trades.csv or results.csv")
+    parser.add_argument("--compact", action="store_true", help="drop the superseded entries of rerun runs")
+    args = parser.parse_args()
+    if args.compact:
+        print("Dropped {} superseded runs".format(compact(args.directory)))
+        return
+    if args.run:
+        output = args.output or "{}_trades.csv".format(args.run)
+        load_trades(args.run, args.directory).to_csv(output)
+    else:
+        output = args.output or "results.csv"
+        results_table(args.directory).to_csv(output)
+    print("Saved to {}".format(output))
+
+
+if __name__ == "__main__":
+    main()
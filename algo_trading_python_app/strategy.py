@@ -1,28 +1,52 @@
-import copy
+import os
 import pickle
 from datetime import timedelta
-from tensorflow.keras.models import load_model
 
 import pandas as pd
 
 from config import MODEL_FILE
-from logger_sender import Logger
+from inference import ChunkedPredictor
+from instrumentation import Instrumentation
+from logger_sender import get_logger
 
-from trade import Trade
+from trade import Trade, TradeLedger
+
+_models = {}
+
+
+def load_model_cached(model_type, model_file_name):
+    """ Models are loaded once per process and kept while the model file is not modified (mtime). """
+    key = (model_type, os.path.abspath(model_file_name), os.path.getmtime(model_file_name))
+    if key not in _models:
+        if model_type == "NN" or model_type == "LSTM":
+            # imported here so runs with precomputed predictions never load tensorflow
+            from tensorflow.keras.models import load_model
+            _models[key] = load_model(model_file_name)
+        else:
+            with open(model_file_name, "rb") as fin:
+                _models[key] = pickle.load(fin)
+    return _models[key]
 
 
 class Strategy:
-    def __init__(self, cfg: dict, predictions=None):
+    def __init__(self, cfg: dict, predictions=None, instrumentation: Instrumentation = None):
         self.log_to_stdout = cfg["log_to_stdout"]
-        self.data_for_df = []
-        self.logger = Logger(index=cfg["logger"]["index_name"],
-                             url=cfg["logger"]["rabbit_url"],
-                             queue="logs",
-                             to_elk=cfg["log_to_elk"])
+        self.ledger = TradeLedger()
+        self.logger = get_logger(index=cfg["logger"]["index_name"],
+                                 url=cfg["logger"]["rabbit_url"],
+                                 queue="logs",
+                                 to_elk=cfg["log_to_elk"],
+                                 batch_size=cfg["logger"].get("batch_size", 100),
+                                 flush_interval=cfg["logger"].get("flush_interval", 1.0),
+                                 max_queue_size=cfg["logger"].get("max_queue_size", 10000),
+                                 block_when_full=cfg["logger"].get("when_full", "drop") == "block")
         self.log_run_name = cfg["run_name"]
         self.tp = cfg["params"].get("tp", None)
         self.sl = cfg["params"].get("sl", None)
         self.ttl = cfg["params"].get("ttl", None)
+        self.ttl_delta = timedelta(minutes=self.ttl) if self.ttl else None
+        self.trailing_stop = cfg["params"].get("trailing_stop", None)  # x% under the highest price of the trade
+        self.break_even = cfg["params"].get("break_even", None)  # sell at the entry price once it went x% above
         self.fee = cfg["params"]["trade_fee"]
         self.capital = cfg["params"]["initial_capital"]
         self.position_capital = None
@@ -32,37 +56,46 @@ class Strategy:
         self.position_entry_time = None
         self.buy_fee = None
         self.model_type = cfg["model"]
-        self.model = self.__load_model(MODEL_FILE[cfg["model"]])
+        self.model_file = cfg.get("model_file", MODEL_FILE[cfg["model"]])
         self.classes = cfg["classes"]
-        self.trades = []
+        self.inference = cfg.get("inference", {})
+        self.__predictor = None
+        self.trade: Trade = None  # the opened trade, closed trades are kept in the ledger
         self.current_price = None
         self.current_timestamp = None
         self.trade_df: pd.DataFrame = None
         self.predictions = predictions
+        self.instrumentation = instrumentation or Instrumentation.from_config(cfg)
 
-    def __load_model(self, model_file_name):
-        if self.model_type == "NN" or self.model_type == "LSTM":
-                return load_model(model_file_name)
-        else:
-            return pickle.load(open(model_file_name, "rb"))
+    @property
+    def model(self):
+        return load_model_cached(self.model_type, self.model_file)
 
-    def __get_model_prediction(self, data):
-        if self.model_type == "NN" or self.model_type == "LSTM":
-            return self.model.predict_classes(data)
-        else:
-            return self.model.predict(data)
+    def predictor(self):
+        """ Kept for the strategy lifetime, so the batch size is tuned once and the stats add up. """
+        if self.__predictor is None:
+            self.__predictor = ChunkedPredictor(self.model, self.model_type, **self.inference)
+        return self.__predictor
 
     def init_predictions(self, X):
-        self.predictions = self.__get_model_prediction(X)
+        with self.instrumentation.stage("prediction"):
+            self.predictions = self.predictor().predict_windows(X)
+
+    def init_predictions_from_features(self, features, window_length, scaler):
+        """ Windows, scales and predicts the feature rows in chunks, returns the predictor stats. """
+        predictor = self.predictor()
+        with self.instrumentation.stage("prediction"):
+            self.predictions = predictor.predict(features, window_length, scaler)
+        return predictor.stats()
 
     def notify(self, timestamp, timestamp_idx, current_price):
         self.current_price = current_price
         self.current_timestamp = timestamp
 
-        if len(self.trades) and not self.trades[-1].ended():
-            self.trades[-1].update_lowest_price(current_price)
+        if self.trade is not None:
+            self.trade.update_lowest_price(current_price)
 
-        if pd.isna(timestamp_idx):
+        if not timestamp_idx >= 0:  # -1 or NaN
             # we are in a minute between timeframes
             if self.position_entry_price:  # already in a position
                 self.end_order_checks()
@@ -115,8 +148,10 @@ class Strategy:
                 raise Exception("unknown prediction {}".format(prediction[0]))
 
         self.logger.log(log_context, stdout=False)
+        if self.logger.to_elk:
+            self.instrumentation.count("log_messages")
 
-    def sell(self, tp_hit=False, sl_hit=False, ttl_hit=False):
+    def sell(self, tp_hit=False, sl_hit=False, ttl_hit=False, trailing_stop_hit=False, break_even_hit=False):
         sell_fee = self.fee * self.position_size * self.current_price  # fee in usd
         profit = self.current_price * self.position_size * (1 - self.fee) - self.position_capital
         self.capital = self.capital + profit
@@ -140,18 +175,19 @@ class Strategy:
             end_reason = "sl_hit"
         elif ttl_hit:
             end_reason = "ttl_hit"
+        elif trailing_stop_hit:
+            end_reason = "trailing_stop_hit"
+        elif break_even_hit:
+            end_reason = "break_even_hit"
 
-        self.trades[-1].end_trade(sell_price=self.current_price, sell_fee=sell_fee, end_time=self.current_timestamp, end_reason=end_reason)
-        trade_dict = copy.deepcopy(self.trades[-1].__dict__)
-        trade_dict.update({
-            "@time": trade_dict["end_time"].isoformat(),
-            "run_name": self.log_run_name,
-            "log_type": "trade",
-            "start_time": trade_dict["start_time"].isoformat(),
-            "end_time": trade_dict["end_time"].isoformat()
-        })
-        self.data_for_df.append(trade_dict)
-        self.logger.log(trade_dict, stdout=False)
+        self.trade.end_trade(sell_price=self.current_price, sell_fee=sell_fee, end_time=self.current_timestamp, end_reason=end_reason)
+        self.instrumentation.count("sells")
+        self.instrumentation.count(end_reason)
+        trade_idx = self.ledger.append(self.trade)
+        self.trade = None
+        if self.logger.to_elk:
+            self.logger.log(self.ledger.log_dict(trade_idx, self.sl, self.tp, self.ttl, self.log_run_name), stdout=False)
+            self.instrumentation.count("log_messages")
         # if self.log_to_stdout:
         #     print("Capital {}. Current timestamp: {}".format(self.capital, self.current_timestamp))
 
@@ -162,20 +198,25 @@ class Strategy:
         self.buy_fee = self.fee * self.position_capital
         self.position_size = self.position_capital * (1 - self.fee) / self.current_price
         self.position_entry_time = self.current_timestamp
+        self.instrumentation.count("buys")
         if self.log_to_stdout:
             print("Buy {:.6f} btc, price {}, fee {:.6f} usd".format(self.position_size, self.position_entry_price, self.buy_fee))
-        self.trades.append(Trade(before_trade_capital=self.capital,
-                                 position_capital=self.position_capital,
-                                 entry_price=self.position_entry_price,
-                                 buy_fee=self.buy_fee, size=self.position_size,
-                                 start_time=self.position_entry_time, fee_percentage=self.fee,
-                                 sl=self.sl, tp=self.tp, ttl=self.ttl))
+        self.trade = Trade(before_trade_capital=self.capital,
+                           position_capital=self.position_capital,
+                           entry_price=self.position_entry_price,
+                           buy_fee=self.buy_fee, size=self.position_size,
+                           start_time=self.position_entry_time, fee_percentage=self.fee,
+                           sl=self.sl, tp=self.tp, ttl=self.ttl)
 
     def end_order_checks(self):
         if self.tp:
             self.check_tp()
         if self.position_entry_price and self.sl:
                 self.check_sl()
+        if self.position_entry_price and self.trailing_stop:
+            self.check_trailing_stop()
+        if self.position_entry_price and self.break_even:
+            self.check_break_even()
         if self.position_entry_price and self.ttl:
                 self.check_ttl()
 
@@ -191,13 +232,30 @@ class Strategy:
                 print("@@@@@@@ SL HIT!")
             self.sell(sl_hit=True)
 
+    def check_trailing_stop(self):
+        highest_price = self.trade.highest_price
+        if self.current_price < highest_price - highest_price * self.trailing_stop:
+            if self.log_to_stdout:
+                print("@@@@@@ TRAILING STOP HIT!")
+            self.sell(trailing_stop_hit=True)
+
+    def check_break_even(self):
+        # the highest price includes this minute, so it can't sell on the minute the price goes break_even above
+        if self.trade.highest_price >= self.position_entry_price + self.position_entry_price * self.break_even \
+                and self.current_price <= self.position_entry_price:
+            if self.log_to_stdout:
+                print("@@@@@@ BREAK EVEN HIT!")
+            self.sell(break_even_hit=True)
+
     def check_ttl(self):
-        if self.current_timestamp - self.position_entry_time >= timedelta(minutes=self.ttl):
+        if self.current_timestamp - self.position_entry_time >= self.ttl_delta:
             if self.log_to_stdout:
                 print("@@@@@@ TTL HIT!")
             self.sell(ttl_hit=True)
 
     def end(self):
-        if not self.trades[-1].ended():
-            self.trades.pop()
-        self.trade_df = pd.DataFrame(self.data_for_df)
+        # a position still opened at the end is not counted
+        self.trade = None
+        self.logger.flush()
+        with self.instrumentation.stage("trade_df"):
+            self.trade_df = self.ledger.to_frame(self.sl, self.tp, self.ttl, self.log_run_name)
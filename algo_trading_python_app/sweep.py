@@ -0,0 +1,138 @@
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import pandas as pd
+
+from backtest import run_backtest, save_run
+from run_store import flush_stores
+from strategy import Strategy
+
+
+class SharedArrays:
+    """ Numpy arrays copied once into named shared memory blocks, so workers attach to them instead of unpickling. """
+    def __init__(self, arrays: dict):
+        self.blocks = {}
+        self.spec = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self.blocks[name] = block
+            self.spec[name] = (block.name, array.shape, array.dtype.str)
+
+    @staticmethod
+    def attach(spec: dict):
+        blocks = {}
+        arrays = {}
+        for name, (block_name, shape, dtype) in spec.items():
+            blocks[name] = SharedMemory(name=block_name)
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=blocks[name].buf)
+        return blocks, arrays
+
+    def close(self):
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+
+class ResultsCsvWriter:
+    """
+    Appends one results row at a time, formatted the same way as pd.DataFrame(all_rows).to_csv(output_file).
+    column_dtypes forces the dtype a column gets when all rows are put together (e.g. ttl [None, 180] -> float).
+    """
+    def __init__(self, output_file, column_dtypes: dict):
+        self.output_file = output_file
+        self.column_dtypes = column_dtypes
+        self.rows_written = 0
+
+    def write(self, row: dict):
+        df = pd.DataFrame([row], index=[self.rows_written])
+        for column, dtype in self.column_dtypes.items():
+            df[column] = df[column].astype(dtype)
+        df.to_csv(self.output_file, mode="w" if self.rows_written == 0 else "a", header=self.rows_written == 0)
+        self.rows_written += 1
+
+
+_worker_state = {}
+
+BACKTEST_ARRAYS = ["predictions", "times", "prices", "signal_idx"]
+PROGRESS_STEPS = 10  # progress lines printed per sweep
+
+
+def _init_worker(spec):
+    _worker_state["blocks"], _worker_state["arrays"] = SharedArrays.attach(spec)
+
+
+def _run_job(job_input):
+    cfg, array_names, minute_slice = job_input
+    arrays = {role: _worker_state["arrays"][name] for role, name in array_names.items()}
+    times, prices, signal_idx = arrays["times"], arrays["prices"], arrays["signal_idx"]
+    if minute_slice is not None:
+        # a time slice of the shared minutes, its results only go to the results table
+        lo, hi = minute_slice
+        times, prices, signal_idx = times[lo:hi], prices[lo:hi], signal_idx[lo:hi]
+    strategy = Strategy(cfg, arrays["predictions"])
+    results_json, _ = run_backtest(strategy, cfg, times, prices, signal_idx, save=False)
+    if minute_slice is not None:
+        return results_json, None, None
+    # the run is saved by the parent process, the only writer of the artifacts store
+    return results_json, strategy.ledger.view(), strategy.instrumentation.report()
+
+
+class SweepExecutor:
+    """
+    Runs backtest jobs in a process pool. Predictions and the aligned minute arrays are computed once by the
+    caller and shared with the workers through shared memory. Results come back in job order.
+    """
+    def __init__(self, workers: int, chunksize: int = 1):
+        self.arrays = {}
+        self.workers = workers
+        self.chunksize = chunksize
+
+    def share(self, predictions, times, prices, signal_idx, predictions_key="", alignment_key=""):
+        """
+        Adds the arrays of a backtest and returns their names, to pass with the jobs using them. The predictions
+        and the minute alignment are shared once per key, jobs with the same key use the same memory.
+        """
+        array_names = {}
+        for role, array in zip(BACKTEST_ARRAYS, [predictions, times, prices, signal_idx]):
+            key = predictions_key if role == "predictions" else alignment_key
+            name = "{}/{}".format(role, key) if key else role
+            if name not in self.arrays:
+                self.arrays[name] = np.asarray(array)
+            array_names[role] = name
+        return array_names
+
+    def run(self, jobs: list, configs: list, writer: ResultsCsvWriter = None, job_arrays: list = None,
+            job_slices: list = None):
+        """
+        job_arrays has the names returned by share() for each job, default the arrays shared without prefix.
+        job_slices has the [lo, hi) minute range of each job, default all the minutes.
+        """
+        job_arrays = job_arrays or [{role: role for role in BACKTEST_ARRAYS}] * len(jobs)
+        job_inputs = list(zip(configs, job_arrays, job_slices or [None] * len(jobs)))
+        if self.workers <= 1:
+            _worker_state["arrays"] = self.arrays
+            self.__collect(jobs, configs, map(_run_job, job_inputs), writer)
+            return jobs
+        shared = SharedArrays(self.arrays)
+        try:
+            with Pool(self.workers, initializer=_init_worker, initargs=(shared.spec,)) as pool:
+                self.__collect(jobs, configs, pool.imap(_run_job, job_inputs, chunksize=self.chunksize), writer)
+        finally:
+            shared.close()
+        return jobs
+
+    def __collect(self, jobs, configs, results, writer):
+        progress_every = max(1, len(jobs) // PROGRESS_STEPS)
+        for idx_run, (job, cfg, (results_json, trades, instrumentation)) in enumerate(zip(jobs, configs, results)):
+            job.update(results_json)
+            if trades is not None:
+                save_run(cfg, results_json, trades, instrumentation)
+            if (idx_run + 1) % progress_every == 0 or idx_run + 1 == len(jobs):
+                print("Finished {}/{} ".format(idx_run + 1, len(jobs)), job["run_name"])
+            if writer:
+                writer.write(job)
+        flush_stores()
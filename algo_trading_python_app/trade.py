@@ -1,4 +1,16 @@
+import numpy as np
+import pandas as pd
+
+END_REASONS = ["ml_model", "tp_hit", "sl_hit", "ttl_hit", "trailing_stop_hit", "break_even_hit"]
+VERDICTS = ["LOSS", "WIN"]
+
+
 class Trade:
+    __slots__ = ["before_trade_capital", "position_capital", "entry_price", "buy_fee", "size", "start_time",
+                 "fee_percentage", "sell_price", "sell_fee", "end_time", "end_reason", "trade_duration", "total_fee",
+                 "profit", "profit_percentage", "price_change", "trade_verdict", "lowest_price", "highest_price",
+                 "sl", "tp", "ttl", "max_drawdown", "highest_possible_win"]
+
     def __init__(self, before_trade_capital, position_capital, entry_price, buy_fee, size, start_time, fee_percentage, sl, tp, ttl):
         self.before_trade_capital = before_trade_capital
         self.position_capital = position_capital
@@ -26,6 +38,9 @@ class Trade:
         self.tp = tp
         self.ttl = ttl
 
+        self.max_drawdown = None
+        self.highest_possible_win = None
+
     def update_lowest_price(self, current_price):
         self.lowest_price = min(self.lowest_price, current_price)
         self.highest_price = max(self.highest_price, current_price)
@@ -54,3 +69,110 @@ class Trade:
 
     def ended(self):
         return self.end_time is not None
+
+
+LEDGER_DTYPE = np.dtype([
+    ("before_trade_capital", np.float64),
+    ("position_capital", np.float64),
+    ("entry_price", np.float64),
+    ("buy_fee", np.float64),
+    ("size", np.float64),
+    ("start_time", np.int64),  # epoch ns
+    ("fee_percentage", np.float64),
+    ("sell_price", np.float64),
+    ("sell_fee", np.float64),
+    ("end_time", np.int64),  # epoch ns
+    ("end_reason", np.int8),  # index in END_REASONS
+    ("trade_duration", np.int64),
+    ("total_fee", np.float64),
+    ("profit", np.float64),
+    ("profit_percentage", np.float64),
+    ("price_change", np.float64),
+    ("trade_verdict", np.int8),  # index in VERDICTS
+    ("lowest_price", np.float64),
+    ("highest_price", np.float64),
+    ("max_drawdown", np.float64),
+    ("highest_possible_win", np.float64),
+])
+
+# trade_df column order, same as the Trade attributes followed by the log fields
+TRADE_COLUMNS = ["before_trade_capital", "position_capital", "entry_price", "buy_fee", "size", "start_time",
+                 "fee_percentage", "sell_price", "sell_fee", "end_time", "end_reason", "trade_duration", "total_fee",
+                 "profit", "profit_percentage", "price_change", "trade_verdict", "lowest_price", "highest_price",
+                 "sl", "tp", "ttl", "max_drawdown", "highest_possible_win", "@time", "run_name", "log_type"]
+
+
+def iso_times(epoch_ns):
+    return np.datetime_as_string(np.asarray(epoch_ns).astype("datetime64[ns]"), unit="s")
+
+
+class TradeLedger:
+    """ Closed trades as rows of a growable numpy structured array. """
+    def __init__(self, capacity=1024):
+        self.rows = np.empty(capacity, dtype=LEDGER_DTYPE)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def from_rows(cls, rows):
+        ledger = cls(capacity=0)
+        ledger.rows = np.asarray(rows, dtype=LEDGER_DTYPE)
+        ledger.count = len(ledger.rows)
+        return ledger
+
+    def append(self, trade: Trade):
+        if self.count == len(self.rows):
+            rows = np.empty(2 * len(self.rows), dtype=LEDGER_DTYPE)
+            rows[:self.count] = self.rows
+            self.rows = rows
+        encoded = {
+            "start_time": pd.Timestamp(trade.start_time).value,
+            "end_time": pd.Timestamp(trade.end_time).value,
+            "end_reason": END_REASONS.index(trade.end_reason),
+            "trade_verdict": VERDICTS.index(trade.trade_verdict),
+        }
+        self.rows[self.count] = tuple(encoded[name] if name in encoded else getattr(trade, name)
+                                      for name in LEDGER_DTYPE.names)
+        self.count += 1
+        return self.count - 1
+
+    def view(self):
+        return self.rows[:self.count]
+
+    def truncate(self, keep):
+        """ Drops all but the last keep trades, for long running strategies. """
+        if self.count > keep:
+            self.rows[:keep] = self.rows[self.count - keep:self.count]
+            self.count = keep
+
+    def log_dict(self, idx, sl, tp, ttl, run_name):
+        """ The trade log message, same fields as the trade_df row. """
+        row = dict(zip(LEDGER_DTYPE.names, self.rows[idx].tolist()))
+        row["start_time"], row["end_time"] = iso_times([row["start_time"], row["end_time"]]).tolist()
+        row["end_reason"] = END_REASONS[row["end_reason"]]
+        row["trade_verdict"] = VERDICTS[row["trade_verdict"]]
+        row.update({"sl": sl, "tp": tp, "ttl": ttl, "@time": row["end_time"], "run_name": run_name, "log_type": "trade"})
+        return {column: row[column] for column in TRADE_COLUMNS}
+
+    def to_frame(self, sl, tp, ttl, run_name):
+        rows = self.view()
+        end_time = iso_times(rows["end_time"])
+        constants = {"sl": sl, "tp": tp, "ttl": ttl, "run_name": run_name, "log_type": "trade"}
+        data = {}
+        for column in TRADE_COLUMNS:
+            if column in constants:
+                value = constants[column]
+                data[column] = np.full(len(rows), value, dtype=object if value is None or isinstance(value, str) else None)
+            elif column == "start_time":
+                data[column] = iso_times(rows["start_time"])
+            elif column in ("end_time", "@time"):
+                data[column] = end_time
+            elif column == "end_reason":
+                data[column] = pd.Categorical.from_codes(rows["end_reason"], END_REASONS)
+            elif column == "trade_verdict":
+                data[column] = pd.Categorical.from_codes(rows["trade_verdict"], VERDICTS)
+            else:
+                data[column] = rows[column]
+        return pd.DataFrame(data, copy=False)
@@ -1,11 +1,45 @@
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+def window_view(X, window_length, copy=False):
+    """
+    Flattened sliding windows over the rows of X: row i holds X[i], X[i+1], ..., X[i+window_length-1].
+    Since X is C-contiguous every window is a contiguous slice of the underlying buffer, so the result is a
+    read-only strided view by default. Use copy=True to materialize it.
+    """
+    X = np.ascontiguousarray(X)
+    if X.ndim == 1:
+        X = X.reshape(-1, 1)
+    rows, features = X.shape
+    n_windows = max(rows - window_length + 1, 0)
+    windows = as_strided(X, shape=(n_windows, window_length * features),
+                         strides=(features * X.itemsize, X.itemsize), writeable=False)
+    if copy:
+        return np.array(windows)
+    return windows
+
+
+def scaled_window_matrix(X, window_length, scaler):
+    """
+    Windowed and scaled feature matrix, same layout as scaler.transform(extend_dataset_with_window_length(X)).
+    A scaler fitted on raw rows is applied per feature before windowing. A scaler fitted on the windowed
+    matrix is applied on the strided view, so the unscaled duplicated matrix is never allocated.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    n_scaled = len(scaler.scale_)
+    if n_scaled == X.shape[1]:
+        return window_view(scaler.transform(X), window_length, copy=True)
+    if n_scaled != X.shape[1] * window_length:
+        raise Exception("scaler expects {} features, got {} x {} window".format(n_scaled, X.shape[1], window_length))
+
+    windows = window_view(X, window_length)
+    out = np.multiply(windows, scaler.scale_)
+    out += scaler.min_
+    if getattr(scaler, "clip", False):
+        np.clip(out, scaler.feature_range[0], scaler.feature_range[1], out=out)
+    return out
 
 
 def extend_dataset_with_window_length(X, Y, window_length=5):
-    new_x = []
-    for i in range(len(X) - window_length+1):
-        lst = []
-        for j in range(i, i+window_length):
-            lst.extend(X[j])
-        new_x.append(lst)
-    return np.array(new_x), Y[window_length-1:]
+    return window_view(X, window_length, copy=True), Y[window_length-1:]
@@ -0,0 +1,150 @@
+import numpy as np
+import pandas as pd
+
+SEARCH_CHUNK = 256
+PREDICTION_LABELS = {
+    2: ["buy", "sell"],
+    3: ["buy", "hold", "sell"],
+}
+
+
+def next_true_index(mask):
+    """ nxt[i] is the first j >= i with mask[j], or len(mask). Has one extra sentinel entry at the end. """
+    n = len(mask)
+    idx = np.where(mask, np.arange(n), n)
+    nxt = np.minimum.accumulate(idx[::-1])[::-1]
+    return np.append(nxt, n)
+
+
+def signal_masks(predictions, signal_idx, classes):
+    """ Per minute buy/sell masks from the model predictions. signal_idx is -1 for minutes between timeframes. """
+    if classes not in PREDICTION_LABELS:
+        raise Exception("unknown number of classes {}".format(classes))
+    predictions = np.asarray(predictions).reshape(len(predictions), -1)[:, 0]
+    has_signal = signal_idx >= 0
+    minute_prediction = np.full(len(signal_idx), -1, dtype=np.int64)
+    minute_prediction[has_signal] = predictions[signal_idx[has_signal]]
+    if ((minute_prediction[has_signal] < 0) | (minute_prediction[has_signal] >= classes)).any():
+        raise Exception("unknown prediction in {}".format(np.unique(minute_prediction[has_signal])))
+    buy = minute_prediction == 0
+    sell = minute_prediction == classes - 1
+    return buy, sell, minute_prediction
+
+
+def first_crossing(prices, check, lo, hi, tp_level, sl_level):
+    """
+    First minute in [lo, hi) where the exit checks run and the price reaches tp_level or drops under sl_level.
+    Scans in growing chunks, so short trades only look at a few hundred minutes.
+    """
+    step = SEARCH_CHUNK
+    while lo < hi:
+        end = min(lo + step, hi)
+        window = prices[lo:end]
+        tp_hit = check[lo:end] & (window >= tp_level)
+        sl_hit = check[lo:end] & (window < sl_level)
+        hits = np.flatnonzero(tp_hit | sl_hit)
+        if len(hits):
+            i = hits[0]
+            return lo + i, "tp_hit" if tp_hit[i] else "sl_hit"
+        lo = end
+        step *= 2
+    return hi, None
+
+
+class ExitSearch:
+    """
+    Finds the exit of a position opened at any minute of one symbol, with the same TP/SL/TTL and model sell
+    checks as Strategy.notify. The checks run on every minute except the ones where the model says sell.
+    """
+    def __init__(self, times, prices, buy, sell, tp=None, sl=None, ttl=None):
+        self.times = times
+        self.prices = prices
+        self.tp = tp
+        self.sl = sl
+        self.ttl_ns = pd.Timedelta(minutes=ttl).value if ttl else None
+        self.check = ~sell
+        self.next_buy = next_true_index(buy)
+        self.next_sell = next_true_index(sell)
+        self.next_check = next_true_index(self.check)
+
+    def find_exit(self, entry):
+        """ (exit minute, end reason), (len(prices), None) when the position is still opened at the end. """
+        n = len(self.prices)
+        entry_price = float(self.prices[entry])
+        ml_exit = self.next_sell[entry + 1]
+        ttl_exit = n
+        if self.ttl_ns is not None:
+            ttl_exit = self.next_check[np.searchsorted(self.times, self.times[entry] + self.ttl_ns)]
+
+        if self.tp or self.sl:
+            tp_level = entry_price + entry_price * self.tp if self.tp else np.inf
+            sl_level = entry_price - entry_price * self.sl if self.sl else -np.inf
+            # tp and sl are checked before ttl on the same minute
+            hi = min(ml_exit, ttl_exit + 1, n)
+            exit_idx, reason = first_crossing(self.prices, self.check, entry + 1, hi, tp_level, sl_level)
+            if reason:
+                return exit_idx, reason
+
+        if ttl_exit < ml_exit and ttl_exit < n:
+            return ttl_exit, "ttl_hit"
+        if ml_exit < n:
+            return ml_exit, "ml_model"
+        return n, None
+
+
+class VectorizedEngine:
+    """
+    Same trades as calling Strategy.notify for every minute, but the exit of each position is found with
+    vectorized searches over the minute arrays (ExitSearch). Strategy.buy/sell are only called once per trade.
+    """
+    def __init__(self, strategy, times, prices, signal_idx):
+        if strategy.trailing_stop or strategy.break_even:
+            raise Exception("trailing_stop and break_even need the loop or kernel engine")
+        self.strategy = strategy
+        self.times = np.asarray(times, dtype=np.int64)
+        self.prices = np.asarray(prices, dtype=np.float64)
+        self.signal_idx = np.asarray(signal_idx, dtype=np.int64)
+        self.buy, self.sell, self.minute_prediction = signal_masks(strategy.predictions, self.signal_idx,
+                                                                   strategy.classes)
+        self.search = ExitSearch(self.times, self.prices, self.buy, self.sell, strategy.tp, strategy.sl, strategy.ttl)
+        self.next_buy = self.search.next_buy
+
+    def find_exit(self, entry):
+        return self.search.find_exit(entry)
+
+    def log_predictions(self):
+        labels = PREDICTION_LABELS[self.strategy.classes]
+        signal_minutes = np.flatnonzero(self.signal_idx >= 0)
+        self.strategy.instrumentation.count("log_messages", len(signal_minutes))
+        for minute in signal_minutes:
+            self.strategy.logger.log({
+                "@time": pd.Timestamp(self.times[minute]).isoformat(),
+                "price": float(self.prices[minute]),
+                "log_type": "model_prediction",
+                "run_name": self.strategy.log_run_name,
+                "prediction": labels[self.minute_prediction[minute]],
+            }, stdout=False)
+
+    def move_to(self, minute):
+        self.strategy.current_price = float(self.prices[minute])
+        self.strategy.current_timestamp = pd.Timestamp(self.times[minute])
+
+    def run(self):
+        if self.strategy.logger.to_elk:
+            self.log_predictions()
+
+        n = len(self.prices)
+        entry = self.next_buy[0]
+        while entry < n:
+            exit_idx, reason = self.find_exit(entry)
+            if reason is None:
+                # position still opened at the end of the data, Strategy.end drops it anyway
+                break
+            self.move_to(entry)
+            self.strategy.buy()
+            path = self.prices[entry + 1:exit_idx + 1]
+            self.strategy.trade.update_lowest_price(float(path.min()))
+            self.strategy.trade.update_lowest_price(float(path.max()))
+            self.move_to(exit_idx)
+            self.strategy.sell(tp_hit=reason == "tp_hit", sl_hit=reason == "sl_hit", ttl_hit=reason == "ttl_hit")
+            entry = self.next_buy[exit_idx + 1]
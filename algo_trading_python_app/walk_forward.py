@@ -0,0 +1,170 @@
+from copy import deepcopy
+import itertools
+import math
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from backtest import Backtester
+from config import config_dict
+from metrics import MINUTE_NS
+from sweep import SweepExecutor, ResultsCsvWriter
+
+WINDOW_DAYS = 30  # length of every slice
+STEP_DAYS = 7  # a slice starts every STEP_DAYS, slices overlap when it is smaller than WINDOW_DAYS
+WF_TP = [None, 0.01, 0.05]
+WF_SL = [None, 0.01, 0.05]
+WF_TTL = [None, 420]
+SUMMARY_METRICS = ["end_capital", "win_%", "number_of_trades", "max_drawdown", "portfolio_max_drawdown", "sharpe",
+                   "sortino", "exposure_%"]
+
+RUN_NAME_PREFIX = "walk_forward_{}_{}"
+WORKERS = os.cpu_count() or 1
+CHUNKSIZE = 4  # slices are short, hand a few to a worker at once
+
+
+def time_slices(times, window_days, step_days):
+    """
+    [lo, hi) minute index ranges of the windows of window_days starting every step_days from the first minute,
+    with their (start, end) epoch ns. Only the windows that fit in the minutes are kept.
+    """
+    if not len(times):
+        return []
+    window = pd.Timedelta(days=window_days).value
+    step = pd.Timedelta(days=step_days).value
+    starts = np.arange(times[0], times[-1] + MINUTE_NS - window + 1, step, dtype=np.int64)
+    los = np.searchsorted(times, starts)
+    his = np.searchsorted(times, starts + window)
+    return [(int(lo), int(hi), int(start), int(start + window)) for lo, hi, start in zip(los, his, starts) if hi > lo]
+
+
+class RunningStats:
+    """ Count, mean, std, min and max updated one value at a time (Welford), NaN values are skipped. """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, value):
+        if value is None or value != value:
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def std(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else np.nan
+
+
+class WalkForwardAggregator:
+    """ Per configuration statistics of the slice results, updated as every slice comes back. """
+    def __init__(self, param_names: list, initial_capital, metrics=SUMMARY_METRICS):
+        self.param_names = param_names
+        self.initial_capital = initial_capital
+        self.metrics = metrics
+        self.stats = {}
+        self.profitable = {}
+
+    def update(self, row: dict):
+        key = tuple(row[name] for name in self.param_names)
+        if key not in self.stats:
+            self.stats[key] = {metric: RunningStats() for metric in self.metrics}
+            self.profitable[key] = 0
+        for metric in self.metrics:
+            self.stats[key][metric].update(row[metric])
+        self.profitable[key] += row["end_capital"] > self.initial_capital
+
+    def summary(self):
+        rows = []
+        for key, stats in self.stats.items():
+            row = dict(zip(self.param_names, key))
+            row["slices"] = stats["end_capital"].count
+            row["profitable_slices_%"] = round(self.profitable[key] / row["slices"] * 100, 2) if row["slices"] else 0.0
+            for metric, running in stats.items():
+                row["{}_mean".format(metric)] = round(running.mean, 4) if running.count else np.nan
+                row["{}_std".format(metric)] = round(running.std(), 4)
+                row["{}_min".format(metric)] = running.min if running.count else np.nan
+                row["{}_max".format(metric)] = running.max if running.count else np.nan
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+
+class WalkForwardWriter(ResultsCsvWriter):
+    """ Writes every slice row to the results csv and adds it to the aggregator. """
+    def __init__(self, output_file, column_dtypes: dict, aggregator: WalkForwardAggregator):
+        super().__init__(output_file, column_dtypes)
+        self.aggregator = aggregator
+
+    def write(self, row: dict):
+        super().write(row)
+        self.aggregator.update(row)
+
+
+def job_config(params: dict, run_name):
+    cfg = deepcopy(config_dict)
+    cfg["params"].update(params)
+    cfg["log_to_elk"] = False
+    cfg["run_name"] = run_name
+    return cfg
+
+
+def run_walk_forward(param_grid: dict, output_file, window_days=WINDOW_DAYS, step_days=STEP_DAYS, workers=WORKERS,
+                     chunksize=CHUNKSIZE):
+    """
+    Backtests every configuration of param_grid on every time slice. The predictions and the minute alignment
+    are computed once; the slices are index ranges into the arrays shared with the SweepExecutor workers.
+    Returns the per configuration summary, the per slice rows are in output_file.
+    """
+    param_names = list(param_grid)
+    combinations = list(itertools.product(*[param_grid[name] for name in param_names]))
+    cfg = job_config(dict(zip(param_names, combinations[0])), RUN_NAME_PREFIX.format(0, 0))
+    tester = Backtester(cfg)
+    tester.init_strategy(cfg)
+    times, prices, signal_idx = tester.get_minute_arrays()
+    slices = time_slices(times, window_days, step_days)
+    print("{} configurations x {} slices of {} days every {} days".format(len(combinations), len(slices),
+                                                                          window_days, step_days))
+
+    jobs = []
+    configs = []
+    job_slices = []
+    for idx_params, values in enumerate(combinations):
+        params = dict(zip(param_names, values))
+        for idx_slice, (lo, hi, start, end) in enumerate(slices):
+            run_name = RUN_NAME_PREFIX.format(idx_params, idx_slice)
+            job = dict(params)
+            job.update({"slice": idx_slice, "slice_start": pd.Timestamp(start).isoformat(),
+                        "slice_end": pd.Timestamp(end).isoformat(), "run_name": run_name})
+            jobs.append(job)
+            configs.append(job_config(params, run_name))
+            job_slices.append((lo, hi))
+
+    aggregator = WalkForwardAggregator(param_names, cfg["params"]["initial_capital"])
+    writer = WalkForwardWriter(output_file, {name: pd.Series(param_grid[name]).dtype for name in param_names},
+                               aggregator)
+    executor = SweepExecutor(workers=workers, chunksize=chunksize)
+    executor.share(tester.strategy.predictions, times, prices, signal_idx)
+    executor.run(jobs, configs, writer, job_slices=job_slices)
+    return aggregator.summary()
+
+
+def main():
+    t = time.time()
+    param_grid = {"tp": WF_TP, "sl": WF_SL, "ttl": WF_TTL}
+    output_file = "walk_forward_{}_{}_days_every_{}_days.csv".format(config_dict["model"], WINDOW_DAYS, STEP_DAYS)
+    summary = run_walk_forward(param_grid, output_file)
+    summary.to_csv("summary_{}".format(output_file))
+    print(summary[["tp", "sl", "ttl", "slices", "profitable_slices_%", "end_capital_mean", "end_capital_std",
+                   "sharpe_mean"]])
+    print("time: {}".format(time.time() - t))
+
+
+if __name__ == "__main__":
+    main()
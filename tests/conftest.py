@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the app modules import each other as top level modules (from strategy import Strategy)
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(os.path.dirname(TESTS_DIR), "algo_trading_python_app"), TESTS_DIR]
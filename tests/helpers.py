@@ -0,0 +1,68 @@
+import hashlib
+import json
+from copy import deepcopy
+
+import numpy as np
+import pandas as pd
+
+from config import config_dict
+
+TP_GRID = [None, 0.005, 0.03]
+SL_GRID = [None, 0.01]
+TTL_GRID = [None, 180]
+
+
+def synthetic_minutes(days, seed=0, start="2021-03-01"):
+    """ Minute close prices with single missing minutes and a 5 hour hole. """
+    rng = np.random.default_rng(seed)
+    n = days * 24 * 60
+    times = pd.date_range(start, periods=n, freq="min")
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.002, n)))
+    keep = rng.random(n) > 0.02
+    keep[n // 3:n // 3 + 300] = False
+    return pd.DataFrame({"close": close[keep]}, index=pd.DatetimeIndex(times[keep], name="open_time"))
+
+
+def synthetic_bars(minutes: pd.DataFrame, timeframe, classes, seed=0):
+    """ Bar open times every timeframe minutes with a few bars missing, and a random prediction per bar. """
+    rng = np.random.default_rng(seed + 1)
+    bar_times = pd.date_range(minutes.index[0], minutes.index[-1], freq="{}min".format(timeframe), name="open_time")
+    bar_times = bar_times[rng.random(len(bar_times)) > 0.03]
+    predictions = rng.integers(0, classes, (len(bar_times), 1))
+    return bar_times, predictions
+
+
+def run_config(classes, timeframe, tp=None, sl=None, ttl=None, engine="loop", **params):
+    cfg = deepcopy(config_dict)
+    cfg.update({"classes": classes, "timeframe": timeframe, "window_length": 1, "engine": engine,
+                "log_to_elk": False, "log_to_stdout": False, "run_name": "test"})
+    cfg["params"].update(tp=tp, sl=sl, ttl=ttl, **params)
+    cfg["instrumentation"]["enabled"] = False
+    return cfg
+
+
+def grid():
+    return [(tp, sl, ttl) for tp in TP_GRID for sl in SL_GRID for ttl in TTL_GRID]
+
+
+def trade_rows(trade_df: pd.DataFrame):
+    """ Engine independent view of the trades: start and end epoch ns, end reason, sell price and profit. """
+    return [[pd.Timestamp(start).value, pd.Timestamp(end).value, str(reason), round(float(sell_price), 8),
+             round(float(profit), 8)]
+            for start, end, reason, sell_price, profit in zip(trade_df["start_time"], trade_df["end_time"],
+                                                              trade_df["end_reason"], trade_df["sell_price"],
+                                                              trade_df["profit"])]
+
+
+def trades_sha1(trade_df: pd.DataFrame):
+    return hashlib.sha1(json.dumps(trade_rows(trade_df)).encode()).hexdigest()
+
+
+class HashModel:
+    """ Pickleable stand-in for a sklearn classifier, the class of a row looks random but only depends on the row. """
+    def __init__(self, classes=2):
+        self.classes_ = np.arange(classes)
+
+    def predict_proba(self, X):
+        scores = np.modf(np.abs(np.asarray(X).sum(axis=1)) * 1000)[0]
+        return np.eye(len(self.classes_))[(scores * len(self.classes_)).astype(np.intp)]
@@ -0,0 +1,92 @@
+import json
+import math
+import os
+
+import pytest
+
+from backtest import align_minutes, compute_result_json, run_engine
+import exit_kernel
+from helpers import synthetic_minutes, synthetic_bars, run_config, grid, trades_sha1
+from strategy import Strategy
+
+SNAPSHOT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "engine_snapshot.json")
+SNAPSHOT_DAYS = 6  # minutes the snapshot was recorded on, with the loop of the first commit
+PARITY_DAYS = 3
+
+
+def run(classes, timeframe, minutes, bar_times, predictions, engine, **params):
+    cfg = run_config(classes, timeframe, engine=engine, **params)
+    times, prices, signal_idx = align_minutes(minutes, bar_times, timeframe)
+    strategy = Strategy(cfg, predictions)
+    run_engine(strategy, engine, times, prices, signal_idx)
+    strategy.end()
+    results = compute_result_json(strategy, cfg["params"], 0, (times[0], times[-1]))
+    return strategy.trade_df, results
+
+
+def assert_same_results(expected: dict, actual: dict):
+    for key, value in expected.items():
+        if key == "run_time":
+            continue
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            assert actual[key] is None or math.isnan(actual[key]), key
+        else:
+            assert actual[key] == value, key
+
+
+@pytest.fixture(scope="module")
+def minutes():
+    return synthetic_minutes(PARITY_DAYS)
+
+
+@pytest.mark.parametrize("timeframe", [1, 5, 60])
+@pytest.mark.parametrize("classes", [2, 3])
+def test_engines_match_loop(minutes, timeframe, classes):
+    bar_times, predictions = synthetic_bars(minutes, timeframe, classes)
+    for tp, sl, ttl in grid():
+        loop_df, loop_results = run(classes, timeframe, minutes, bar_times, predictions, "loop", tp=tp, sl=sl, ttl=ttl)
+        assert len(loop_df)
+        for engine in ["vectorized", "kernel"]:
+            trade_df, results = run(classes, timeframe, minutes, bar_times, predictions, engine, tp=tp, sl=sl, ttl=ttl)
+            assert trade_df.equals(loop_df), (engine, tp, sl, ttl)
+            assert_same_results(loop_results, results)
+
+
+@pytest.mark.parametrize("backend", ["python", exit_kernel.BACKEND])
+@pytest.mark.parametrize("classes", [2, 3])
+def test_kernel_trailing_stop_and_break_even_match_loop(minutes, classes, backend, monkeypatch):
+    monkeypatch.setattr(exit_kernel, "BACKEND", backend)
+    timeframe = 5
+    bar_times, predictions = synthetic_bars(minutes, timeframe, classes)
+    hits = 0
+    for trailing_stop, break_even, tp in [(0.004, None, None), (None, 0.003, None), (0.004, 0.003, 0.03)]:
+        params = {"tp": tp, "sl": 0.01, "ttl": 180, "trailing_stop": trailing_stop, "break_even": break_even}
+        loop_df, loop_results = run(classes, timeframe, minutes, bar_times, predictions, "loop", **params)
+        trade_df, results = run(classes, timeframe, minutes, bar_times, predictions, "kernel", **params)
+        assert trade_df.equals(loop_df)
+        assert_same_results(loop_results, results)
+        hits += results["trailing_stop_hit_%"] > 0 or results["break_even_hit_%"] > 0
+    assert hits == 3
+
+
+def test_vectorized_engine_rejects_trailing_stop(minutes):
+    bar_times, predictions = synthetic_bars(minutes, 5, 2)
+    with pytest.raises(Exception):
+        run(2, 5, minutes, bar_times, predictions, "vectorized", trailing_stop=0.01)
+
+
+@pytest.mark.parametrize("engine", ["loop", "vectorized", "kernel"])
+def test_engines_match_first_commit_snapshot(engine):
+    """ Results and trades of 48 runs recorded with the per-minute loop of the first commit. """
+    with open(SNAPSHOT_FILE) as fin:
+        snapshot = json.load(fin)
+    minutes = synthetic_minutes(SNAPSHOT_DAYS)
+    bars = {}
+    for run_snapshot in snapshot:
+        timeframe, classes = run_snapshot["timeframe"], run_snapshot["classes"]
+        if (timeframe, classes) not in bars:
+            bars[(timeframe, classes)] = synthetic_bars(minutes, timeframe, classes)
+        trade_df, results = run(classes, timeframe, minutes, *bars[(timeframe, classes)], engine,
+                                tp=run_snapshot["tp"], sl=run_snapshot["sl"], ttl=run_snapshot["ttl"])
+        assert_same_results(run_snapshot["results"], results)
+        assert trades_sha1(trade_df) == run_snapshot["trades_sha1"], run_snapshot
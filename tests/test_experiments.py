@@ -0,0 +1,58 @@
+import pickle
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import MinMaxScaler
+
+from config import MODEL_FILE
+from experiments import ExperimentPlan, ExperimentRunner, stage_keys, experiment_config
+from helpers import HashModel
+from strategy import Strategy
+
+SETUP = {"model": "NN", "timeframe": 60, "window_length": 30, "dataset": "test_df_60minutes_1_candles_2_class.csv",
+         "scaler": "nn_scaler_60minutes_30window.save"}
+
+
+def test_setup_without_model_file_uses_the_default_model_file():
+    default = stage_keys(experiment_config(SETUP, {}, "a"))
+    explicit = stage_keys(experiment_config(dict(SETUP, model_file=MODEL_FILE["NN"]), {}, "b"))
+    assert default == explicit
+
+
+def test_plan_shares_the_stages_between_params():
+    plan = ExperimentPlan([SETUP, dict(SETUP, timeframe=30)], {"tp": [None, 0.01], "sl": [None, 0.05]})
+    assert len(plan.jobs) == 8
+    assert len(plan.unique("windows")) == 1
+    assert len(plan.unique("predictions")) == 1
+    assert len(plan.unique("alignment")) == 2
+
+
+def test_models_share_the_scaled_windows(tmp_path):
+    rng = np.random.default_rng(0)
+    dataset = pd.DataFrame(rng.normal(size=(500, 3)), columns=["f0", "f1", "f2"],
+                           index=pd.date_range("2021-03-01", periods=500, freq="60min", name="open_time"))
+    dataset.insert(0, "close", 100.0)
+    dataset["output_class"] = 0
+    joblib.dump(MinMaxScaler().fit(dataset[["f0", "f1", "f2"]].to_numpy()), tmp_path / "scaler.save")
+    setups = []
+    for classes in [2, 3]:
+        with open(tmp_path / "model_{}.pickle".format(classes), "wb") as fout:
+            pickle.dump(HashModel(classes), fout)
+        setup = dict(SETUP, model="logistic_regression", classes=classes, scaler=str(tmp_path / "scaler.save"),
+                     model_file=str(tmp_path / "model_{}.pickle".format(classes)), cache={"enabled": False})
+        setups += [setup, dict(setup, window_length=5)]
+    plan = ExperimentPlan(setups, {"tp": [None, 0.01]})
+    assert [len(plan.unique(stage)) for stage in ["windows", "predictions"]] == [2, 4]
+    assert "2 window sets, 4 prediction sets" in plan.summary()
+
+    runner = ExperimentRunner(plan)
+    runner.datasets[SETUP["dataset"]] = dataset
+    runner.compute_predictions()
+    assert list(runner.predictions) == list(plan.unique("predictions"))
+    for key, cfg in plan.unique("predictions").items():
+        strategy = Strategy(cfg)
+        strategy.init_predictions_from_features(dataset.drop(columns=["close"]).to_numpy()[:, :-1],
+                                                cfg["window_length"], joblib.load(cfg["scaler"]))
+        assert np.array_equal(runner.predictions[key], strategy.predictions)
+    assert len(np.unique(runner.predictions[stage_keys(setups[2])["predictions"]])) == 3
@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from indicators import FEATURE_COLUMNS, WARMUP_CANDLES, FeatureEngine, build_dataset, output_classes
+
+DATASET_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "algo_trading_python_app",
+                            "test_df_60minutes_1_candles_2_class.csv")
+# features of the closes only, the dataset csv has no high / low
+CLOSE_COLUMNS = ["sma5_diff", "sma8_diff", "sma13_diff", "sma21_diff", "ema5_diff", "ema8_diff", "ema13_diff",
+                 "ema21_diff", "MACD_12_26_9", "MACDh_12_26_9", "MACDs_12_26_9", "RSI_14", "ROC_1", "dema10_diff",
+                 "BBB_5_2.0", "BBU_5_2.0_diff", "BBL_5_2.0_diff", "BBM_5_2.0_diff", "RVI_14"]
+# the csv starts after the notebook's warmup, the exponential averages need some rows to forget their seed
+CONVERGED_ROWS = 300
+
+
+def synthetic_candles(n, seed=0):
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, n)))
+    open_price = np.concatenate([[100.0], close[:-1]])
+    high = np.maximum(open_price, close) * (1 + np.abs(rng.normal(0, 0.003, n)))
+    low = np.minimum(open_price, close) * (1 - np.abs(rng.normal(0, 0.003, n)))
+    index = pd.date_range("2020-01-01", periods=n, freq="60min", name="open_time")
+    return pd.DataFrame({"open": open_price, "high": high, "low": low, "close": close}, index=index)
+
+
+def reference_ohlc_features(candles: pd.DataFrame):
+    """ STOCH, CCI, ATR, WILLR and AROON with pandas rolling / ewm, as pandas_ta 0.2.45b defines them. """
+    high, low, close = candles["high"], candles["low"], candles["close"]
+    lowest_low = low.rolling(14).min()
+    highest_high = high.rolling(14).max()
+    stoch = 100 * (close - lowest_low) / (highest_high - lowest_low)
+    stoch_k = stoch.rolling(3).mean()
+    typical_price = (high + low + close) / 3
+    mean = typical_price.rolling(14).mean()
+    mad = typical_price.rolling(14).apply(lambda values: np.abs(values - values.mean()).mean(), raw=True)
+    prev_close = close.shift(1)
+    true_range = pd.concat([high - low, (high - prev_close).abs(), (prev_close - low).abs()], axis=1).max(axis=1)
+    true_range.iloc[0] = np.nan
+    since_high = high.rolling(15).apply(lambda values: np.argmax(values[::-1]), raw=True)
+    since_low = low.rolling(15).apply(lambda values: np.argmin(values[::-1]), raw=True)
+    aroon_up = 100 * (1 - since_high / 14)
+    aroon_down = 100 * (1 - since_low / 14)
+    return pd.DataFrame({
+        "STOCHk_14_3_3": stoch_k,
+        "STOCHd_14_3_3": stoch_k.rolling(3).mean(),
+        "CCI_14_0.015": (typical_price - mean) / (0.015 * mad),
+        "ATRr_14": true_range.ewm(alpha=1 / 14, min_periods=14).mean(),
+        "WILLR_14": 100 * ((close - lowest_low) / (highest_high - lowest_low) - 1),
+        "AROOND_14": aroon_down,
+        "AROONU_14": aroon_up,
+        "AROONOSC_14": aroon_up - aroon_down,
+    })
+
+
+def test_close_features_match_dataset():
+    dataset = pd.read_csv(DATASET_FILE, index_col=0)
+    close = dataset["close"].to_numpy()
+    features = pd.DataFrame(FeatureEngine().update_many(close, close, close), columns=FEATURE_COLUMNS)
+    for column in CLOSE_COLUMNS:
+        np.testing.assert_allclose(features[column].to_numpy()[CONVERGED_ROWS:],
+                                   dataset[column].to_numpy()[CONVERGED_ROWS:], rtol=1e-7, atol=1e-10,
+                                   err_msg=column)
+    np.testing.assert_array_equal(output_classes(close)[:-1], dataset["output_class"].to_numpy()[:-1])
+
+
+def test_ohlc_features_match_pandas_reference():
+    candles = synthetic_candles(500)
+    features = pd.DataFrame(FeatureEngine().update_many(candles["high"].to_numpy(), candles["low"].to_numpy(),
+                                                        candles["close"].to_numpy()), columns=FEATURE_COLUMNS)
+    reference = reference_ohlc_features(candles)
+    for column in reference.columns:
+        np.testing.assert_allclose(features[column].to_numpy()[WARMUP_CANDLES:],
+                                   reference[column].to_numpy()[WARMUP_CANDLES:], rtol=1e-9, atol=1e-9,
+                                   err_msg=column)
+
+
+@pytest.mark.parametrize("splits", [[300], [1, 2, 50, 51, 400], [10, 20, 30, 33, 34, 35, 685]])
+def test_chained_build_dataset_matches_one_call(splits):
+    candles = synthetic_candles(686)
+    expected, _ = build_dataset(candles)
+    engine = None
+    parts = []
+    for lo, hi in zip([0] + splits, splits + [len(candles)]):
+        part, engine = build_dataset(candles.iloc[lo:hi], engine=engine)
+        parts.append(part)
+    pd.testing.assert_frame_equal(pd.concat(parts), expected)
+    assert len(expected) == len(candles) - WARMUP_CANDLES - 1
+
+
+def test_chained_build_dataset_carries_ffill():
+    candles = synthetic_candles(120)
+    candles.iloc[60:70, candles.columns.get_loc("high")] = np.nan  # features of these candles are NaN
+    expected, _ = build_dataset(candles)
+    first, engine = build_dataset(candles.iloc[:62])
+    second, _ = build_dataset(candles.iloc[62:], engine=engine)
+    pd.testing.assert_frame_equal(pd.concat([first, second]), expected)
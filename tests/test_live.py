@@ -0,0 +1,99 @@
+import pickle
+
+import joblib
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.preprocessing import MinMaxScaler
+
+from backtest import align_minutes, run_engine
+from columnar import read_table
+from helpers import synthetic_minutes, synthetic_bars, run_config, HashModel
+from live import LiveRunner, ReplaySource
+from metrics import RunningResults, result_json
+from strategy import Strategy
+
+TIMEFRAME = 5
+WINDOW_LENGTH = 3
+
+
+@pytest.fixture(scope="module")
+def files(tmp_path_factory):
+    """ Minute and dataset csv files, a scaler and a model for a 2 day replay. """
+    path = tmp_path_factory.mktemp("live")
+    minutes = synthetic_minutes(2, seed=3)
+    bar_times, _ = synthetic_bars(minutes, TIMEFRAME, 2, seed=3)
+    rng = np.random.default_rng(3)
+    dataset = pd.DataFrame(rng.normal(size=(len(bar_times), 3)), index=bar_times, columns=["f0", "f1", "f2"])
+    dataset.insert(0, "close", 100.0)
+    dataset["output_class"] = 0
+    minutes.to_csv(path / "minutes.csv")
+    dataset.to_csv(path / "dataset.csv")
+    joblib.dump(MinMaxScaler().fit(dataset[["f0", "f1", "f2"]].to_numpy()), path / "scaler.save")
+    with open(path / "model.pickle", "wb") as fout:
+        pickle.dump(HashModel(), fout)
+    # the same values the replay reads back
+    return path, read_table(str(path / "minutes.csv")), read_table(str(path / "dataset.csv"))
+
+
+def live_config(path, tp, sl, ttl):
+    cfg = run_config(2, TIMEFRAME, tp=tp, sl=sl, ttl=ttl)
+    cfg.update({"window_length": WINDOW_LENGTH, "model": "logistic_regression", "model_file": str(path / "model.pickle"),
+                "scaler": str(path / "scaler.save")})
+    return cfg
+
+
+def loop_run(cfg, minutes, dataset):
+    features = dataset.drop(columns=["close"]).to_numpy()[:, :-1]
+    strategy = Strategy(cfg)
+    strategy.init_predictions_from_features(features, WINDOW_LENGTH, joblib.load(cfg["scaler"]))
+    times, prices, signal_idx = align_minutes(minutes, dataset.index[WINDOW_LENGTH - 1:], TIMEFRAME)
+    run_engine(strategy, "loop", times, prices, signal_idx)
+    strategy.end()
+    return strategy
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 500])
+@pytest.mark.parametrize("tp,sl,ttl", [(None, None, None), (0.005, 0.01, 60)])
+def test_replay_matches_loop_engine(files, batch_size, tp, sl, ttl):
+    path, minutes, dataset = files
+    cfg = live_config(path, tp, sl, ttl)
+    expected = loop_run(cfg, minutes, dataset)
+    assert len(expected.trade_df) > 20
+
+    runner = LiveRunner(cfg, ReplaySource(str(path / "minutes.csv"), str(path / "dataset.csv"), TIMEFRAME, batch_size),
+                        max_trades=10 ** 6)
+    runner.run()
+    assert runner.strategy.trade_df.equals(expected.trade_df)
+    assert runner.strategy.capital == expected.capital
+
+
+def test_results_cover_the_truncated_trades(files):
+    path, minutes, dataset = files
+    cfg = live_config(path, 0.005, 0.01, 60)
+    expected = loop_run(cfg, minutes, dataset)
+    runner = LiveRunner(cfg, ReplaySource(str(path / "minutes.csv"), str(path / "dataset.csv"), TIMEFRAME, 50),
+                        max_trades=5)
+    runner.run()
+    assert len(runner.strategy.trade_df) < len(expected.trade_df)
+    expected_results = result_json(expected.trade_df, expected.capital, cfg["params"], None)
+    results = runner.result_json()
+    assert list(results) == list(expected_results)
+    for key, value in expected_results.items():
+        assert results[key] == pytest.approx(value, nan_ok=True, abs=1e-4), key
+
+
+def test_running_results_match_result_json_in_chunks(files):
+    path, minutes, dataset = files
+    cfg = live_config(path, 0.005, 0.01, 60)
+    strategy = loop_run(cfg, minutes, dataset)
+    period = (minutes.index[0].value, minutes.index[-1].value)
+    running = RunningResults(cfg["params"]["initial_capital"])
+    rows = strategy.ledger.view()
+    for start in range(0, len(rows), 13):
+        running.add(rows[start:start + 13])
+    expected = result_json(strategy.trade_df, strategy.capital, cfg["params"], 0, period)
+    results = running.result_json(strategy.capital, cfg["params"], 0, period)
+    assert results["exposure_%"] > 0
+    for key, value in expected.items():
+        assert results[key] == pytest.approx(value, nan_ok=True, abs=1e-4), key
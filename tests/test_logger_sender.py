@@ -0,0 +1,145 @@
+import threading
+import time
+
+from logger_sender import Logger
+
+
+class FakeChannel:
+    """ In-process stand-in for the pika channel. publishing can be held with the gate, fail_at raises once. """
+    def __init__(self, gate: threading.Event = None, fail_at=None):
+        self.bodies = []
+        self.gate = gate
+        self.fail_at = fail_at
+        self.waiting = threading.Event()
+
+    def basic_publish(self, exchange, routing_key, body):
+        if self.gate is not None:
+            self.waiting.set()
+            self.gate.wait()
+        if self.fail_at is not None and len(self.bodies) == self.fail_at:
+            self.fail_at = None
+            raise ConnectionError("connection lost")
+        self.bodies.append(body)
+
+
+def fake_logger(channels, **options):
+    """ A Logger publishing to the next of channels on every (re)connection. """
+    channels = list(channels)
+    connections = []
+
+    def channel_factory():
+        connections.append(channels.pop(0))
+        return connections[-1]
+    logger = Logger("test_index", "amqp://unused", "logs", channel_factory=channel_factory, **options)
+    return logger, connections
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.005)
+
+
+def test_messages_are_published_in_batches():
+    channel = FakeChannel()
+    logger, _ = fake_logger([channel], batch_size=10, flush_interval=0.5)
+    for i in range(5):
+        logger.log({"i": i})
+    time.sleep(0.1)
+    assert channel.bodies == []  # waits for a full batch or the flush interval
+    for i in range(5, 10):
+        logger.log({"i": i})
+    wait_until(lambda: len(channel.bodies) == 10)
+    logger.close()
+    assert logger.stats() == {"sent": 10, "dropped": 0, "failed": 0, "queued": 0}
+
+
+def test_flush_drains_the_queue():
+    channel = FakeChannel()
+    logger, _ = fake_logger([channel], batch_size=8, flush_interval=0.05)
+    for i in range(50):
+        logger.log({"i": i})
+    logger.flush()
+    assert logger.stats()["queued"] == 0
+    assert channel.bodies == ['{"i": %d, "index": "test_index"}' % i for i in range(50)]
+    logger.close()
+
+
+def fill_queue(logger, channel, max_queue_size):
+    """ The sender is held inside the publish of the first message, the next ones fill the queue. """
+    logger.log({"i": 0})
+    assert channel.waiting.wait(5)
+    for i in range(1, max_queue_size + 1):
+        logger.log({"i": i})
+
+
+def test_messages_are_dropped_when_the_queue_is_full():
+    gate = threading.Event()
+    channel = FakeChannel(gate)
+    logger, _ = fake_logger([channel], batch_size=1, flush_interval=0.01, max_queue_size=5)
+    fill_queue(logger, channel, 5)
+    for i in range(3):
+        logger.log({"late": i})
+    assert logger.stats()["dropped"] == 3
+    gate.set()
+    logger.close()
+    assert logger.stats() == {"sent": 6, "dropped": 3, "failed": 0, "queued": 0}
+
+
+def test_caller_blocks_when_the_queue_is_full():
+    gate = threading.Event()
+    channel = FakeChannel(gate)
+    logger, _ = fake_logger([channel], batch_size=1, flush_interval=0.01, max_queue_size=5, block_when_full=True)
+    fill_queue(logger, channel, 5)
+    caller = threading.Thread(target=logger.log, args=({"late": 0},))
+    caller.start()
+    caller.join(0.2)
+    assert caller.is_alive()
+    gate.set()
+    caller.join(5)
+    assert not caller.is_alive()
+    logger.close()
+    assert logger.stats() == {"sent": 7, "dropped": 0, "failed": 0, "queued": 0}
+
+
+def test_reconnects_after_a_failed_publish(capsys):
+    logger, connections = fake_logger([FakeChannel(fail_at=2), FakeChannel()], batch_size=5, flush_interval=0.05)
+    for i in range(5):
+        logger.log({"i": i})
+    logger.flush()
+    # the rest of the failed batch is lost, the next batch goes to a new connection
+    assert logger.stats()["failed"] == 3
+    for i in range(5, 7):
+        logger.log({"i": i})
+    logger.close()
+    assert len(connections) == 2
+    assert [len(channel.bodies) for channel in connections] == [2, 2]
+    assert logger.stats() == {"sent": 4, "dropped": 0, "failed": 3, "queued": 0}
+    assert "connection lost" in capsys.readouterr().out
+
+
+def test_flush_returns_when_the_connection_fails(capsys):
+    channels = [FakeChannel()]
+
+    def channel_factory():
+        if len(channels) == 1:
+            channels.append(None)
+            raise ConnectionError("broker down")
+        return channels[0]
+    logger = Logger("test_index", "amqp://unused", "logs", batch_size=5, flush_interval=0.05,
+                    channel_factory=channel_factory)
+    for i in range(3):
+        logger.log({"i": i})
+    flush = threading.Thread(target=logger.flush, daemon=True)
+    flush.start()
+    flush.join(5)
+    assert not flush.is_alive()
+    assert logger.stats()["failed"] == 3
+    # the sender is still running and connects again for the next batch
+    logger.log({"i": 3})
+    logger.close()
+    assert channels[0].bodies == ['{"i": 3, "index": "test_index"}']
+    assert logger.stats() == {"sent": 1, "dropped": 0, "failed": 3, "queued": 0}
+    assert "broker down" in capsys.readouterr().out
@@ -0,0 +1,41 @@
+import numpy as np
+
+from backtest import align_minutes, compute_result_json, run_engine
+from helpers import synthetic_minutes, synthetic_bars, run_config
+from metrics import REASON_COLUMNS
+from monte_carlo import monte_carlo, percentile_table
+from strategy import Strategy
+
+
+def backtest(**params):
+    minutes = synthetic_minutes(3)
+    bar_times, predictions = synthetic_bars(minutes, 5, 2)
+    cfg = run_config(2, 5, engine="vectorized", **params)
+    times, prices, signal_idx = align_minutes(minutes, bar_times, 5)
+    strategy = Strategy(cfg, predictions)
+    run_engine(strategy, "vectorized", times, prices, signal_idx)
+    strategy.end()
+    return strategy, compute_result_json(strategy, cfg["params"], 0, (times[0], times[-1]))
+
+
+def test_identity_replica_reproduces_the_run():
+    strategy, results = backtest(tp=0.005, sl=0.01, ttl=20)
+    replicas = monte_carlo(strategy.trade_df, 100, replicas=3, bootstrap=False, fee_range=None, slippage=0)
+    assert replicas.iloc[0]["end_capital"] == strategy.capital
+    for column in replicas.columns.drop("end_capital"):
+        assert column in results
+        np.testing.assert_allclose(replicas[column].to_numpy(), results[column], atol=1e-4, err_msg=column)
+    assert {column for _, column in REASON_COLUMNS} | {"avg_trade_len", "max_drawdown_winning_trade",
+                                                        "highest_possible_win_losing_trade"} <= set(replicas.columns)
+
+
+def test_bootstrap_resamples_reasons_and_durations():
+    strategy, _ = backtest(tp=0.005, sl=0.01, ttl=20)
+    replicas = monte_carlo(strategy.trade_df, 100, replicas=200, chunk_size=64, seed=1)
+    for column in ["tp_hit_%", "sl_hit_%", "ttl_hit_%", "avg_trade_len", "end_capital"]:
+        assert replicas[column].std() > 0, column
+    reasons = replicas[[column for _, column in REASON_COLUMNS]].sum(axis=1)
+    np.testing.assert_allclose(reasons, 100)
+    # chunks draw from their own seed, the replicas don't depend on the number of workers
+    assert replicas.equals(monte_carlo(strategy.trade_df, 100, replicas=200, chunk_size=64, seed=1, workers=2))
+    assert list(percentile_table(replicas).index) == list(replicas.columns)
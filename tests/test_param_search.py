@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from backtest import align_minutes, compute_result_json, run_engine
+from helpers import synthetic_minutes, synthetic_bars, run_config, grid, TP_GRID, SL_GRID, TTL_GRID
+from param_search import PathStats, bayesian_search, grid_search, successive_halving
+from strategy import Strategy
+
+DAYS = 3
+EVALUATED = ["end_capital", "number_of_trades", "winning_trades", "win_%", "model_end_trade_%", "tp_hit_%",
+             "sl_hit_%", "ttl_hit_%"]
+
+
+def combination(tp, sl, ttl):
+    """ The (tp, sl, ttl) of a scores row, the score columns hold None as NaN. """
+    return (None if pd.isna(tp) else float(tp), None if pd.isna(sl) else float(sl),
+            None if pd.isna(ttl) else int(ttl))
+
+
+def scores_by_combination(scores):
+    return {combination(tp, sl, ttl): end_capital
+            for tp, sl, ttl, end_capital in zip(scores["tp"], scores["sl"], scores["ttl"], scores["end_capital"])}
+
+
+@pytest.fixture(scope="module")
+def minutes():
+    return synthetic_minutes(DAYS)
+
+
+def loop_results(classes, timeframe, times, prices, signal_idx, predictions, tp, sl, ttl):
+    cfg = run_config(classes, timeframe, tp=tp, sl=sl, ttl=ttl)
+    strategy = Strategy(cfg, predictions)
+    run_engine(strategy, "loop", times, prices, signal_idx)
+    strategy.end()
+    return compute_result_json(strategy, cfg["params"], 0)
+
+
+@pytest.mark.parametrize("timeframe", [1, 5, 60])
+@pytest.mark.parametrize("classes", [2, 3])
+def test_path_stats_match_loop_engine(minutes, timeframe, classes):
+    bar_times, predictions = synthetic_bars(minutes, timeframe, classes)
+    times, prices, signal_idx = align_minutes(minutes, bar_times, timeframe)
+    stats = PathStats(times, prices, signal_idx, predictions, classes)
+    params = run_config(classes, timeframe)["params"]
+    for tp, sl, ttl in grid():
+        expected = loop_results(classes, timeframe, times, prices, signal_idx, predictions, tp, sl, ttl)
+        results = stats.evaluate(tp, sl, ttl, params["trade_fee"], params["initial_capital"])
+        assert {key: results[key] for key in EVALUATED} == {key: expected[key] for key in EVALUATED}, (tp, sl, ttl)
+
+
+def test_path_stats_with_max_ttl_and_end_match_loop_engine(minutes):
+    """ The halving rounds score the first minutes only (end), like a backtest on these minutes. """
+    timeframe, classes = 5, 2
+    bar_times, predictions = synthetic_bars(minutes, timeframe, classes)
+    times, prices, signal_idx = align_minutes(minutes, bar_times, timeframe)
+    stats = PathStats(times, prices, signal_idx, predictions, classes, max_ttl=180)
+    end = len(times) // 3
+    for tp, sl, ttl in grid():
+        if ttl is None:
+            continue
+        expected = loop_results(classes, timeframe, times[:end], prices[:end], signal_idx[:end], predictions, tp, sl,
+                                ttl)
+        results = stats.evaluate(tp, sl, ttl, end=end)
+        assert {key: results[key] for key in EVALUATED} == {key: expected[key] for key in EVALUATED}, (tp, sl, ttl)
+
+
+@pytest.fixture(scope="module")
+def search():
+    """
+    27 times the same day of minutes and predictions. Successive halving scores the combinations on the first
+    minutes before the others, it can only keep the grid's best when the market does not change over time (on
+    a random walk the first minutes say nothing about the rest).
+    """
+    timeframe, classes, days = 5, 2, 27
+    rng = np.random.default_rng(0)
+    steps = rng.normal(0, 0.002, 24 * 60)
+    day = 100 * np.exp(np.cumsum(steps - steps.mean()))
+    times = pd.date_range("2021-03-01", periods=days * 24 * 60, freq="min", name="open_time")
+    minutes = pd.DataFrame({"close": np.tile(day, days)}, index=times)
+    bar_times = times[::timeframe]
+    predictions = np.tile(rng.integers(0, classes, (len(bar_times) // days, 1)), (days, 1))
+    stats = PathStats(*align_minutes(minutes, bar_times, timeframe), predictions, classes)
+    return stats, run_config(classes, timeframe)["params"]
+
+
+def test_successive_halving_keeps_the_best_grid_combinations(search):
+    stats, params = search
+    tps = TP_GRID + [0.01, 0.02]
+    sls = SL_GRID + [0.005, 0.02]
+    ttls = TTL_GRID + [60, 360]
+    scores = grid_search(stats, tps, sls, ttls, params)
+    assert len(scores) == len(tps) * len(sls) * len(ttls)
+    best = scores.sort_values("end_capital", ascending=False, kind="stable")
+
+    halving = successive_halving(stats, [(tp, sl, ttl) for tp in tps for sl in sls for ttl in ttls], params)
+    final = halving[halving["fraction"] == 1.0].sort_values("end_capital", ascending=False, kind="stable")
+    # the survivors are scored on all the minutes, the same scores as the grid
+    grid_scores = scores_by_combination(scores)
+    assert all(grid_scores[key] == value for key, value in scores_by_combination(final).items())
+    assert final["end_capital"].iloc[0] == best["end_capital"].iloc[0]
+
+
+def test_bayesian_search_finds_the_best_grid_score(search):
+    stats, params = search
+    tp_range, sl_range, ttl_range = (0.002, 0.03), (0.002, 0.03), (30, 600)
+    scores = grid_search(stats, [None] + list(np.linspace(*tp_range, 8)), [None] + list(np.linspace(*sl_range, 8)),
+                         [None] + list(np.linspace(*ttl_range, 6).round()), params)
+    evaluated = bayesian_search(stats, params, tp_range, sl_range, ttl_range, pool_size=1000)
+    assert len(evaluated) == 100
+    # every evaluated combination is scored like the grid
+    for (tp, sl, ttl), end_capital in scores_by_combination(evaluated).items():
+        assert end_capital == stats.evaluate(tp, sl, ttl, params["trade_fee"], params["initial_capital"])["end_capital"]
+    # 100 combinations scored, as good as the best of the 729 of the grid over the same ranges
+    assert evaluated["end_capital"].max() >= scores["end_capital"].max()
@@ -0,0 +1,91 @@
+import pandas as pd
+import pytest
+
+from backtest import align_minutes, run_engine
+from helpers import synthetic_minutes, synthetic_bars, run_config, grid
+from portfolio import PortfolioBacktester, PortfolioEngine
+from run_store import default_store, load_trades, read_index
+from strategy import Strategy
+
+TIMEFRAME = 5
+
+
+@pytest.fixture(scope="module")
+def symbols():
+    """ Aligned minutes and predictions of three symbols with different gaps. """
+    out = []
+    for i in range(3):
+        minutes = synthetic_minutes(3, seed=10 + i)
+        bar_times, predictions = synthetic_bars(minutes, TIMEFRAME, 2, seed=20 + i)
+        out.append((align_minutes(minutes, bar_times, TIMEFRAME), predictions))
+    return out
+
+
+def test_single_symbol_matches_strategy(symbols):
+    aligned, predictions = symbols[0]
+    for tp, sl, ttl in grid():
+        cfg = run_config(2, TIMEFRAME, tp=tp, sl=sl, ttl=ttl)
+        strategy = Strategy(cfg, predictions)
+        run_engine(strategy, "loop", *aligned)
+        strategy.end()
+
+        engine = PortfolioEngine(["A"], [aligned], [predictions], cfg["params"], 2, max_position_fraction=1.0,
+                                 max_position_capital=100, run_name=cfg["run_name"])
+        engine.run()
+        trade_df = engine.trade_df().drop(columns=["symbol"])
+        assert trade_df.equals(strategy.trade_df), (tp, sl, ttl)
+        assert engine.capital == strategy.capital
+        assert engine.skipped_buys == 0
+
+
+def test_shared_capital_limits_concurrent_positions(symbols):
+    aligned = [symbol_aligned for symbol_aligned, _ in symbols]
+    predictions = [symbol_predictions for _, symbol_predictions in symbols]
+    params = run_config(2, TIMEFRAME, tp=0.005, sl=0.01)["params"]
+
+    unlimited = PortfolioEngine(["A", "B", "C"], aligned, predictions, params, 2, max_position_fraction=1 / 3)
+    unlimited.run()
+    assert unlimited.max_open_positions == 3
+    assert unlimited.skipped_buys == 0
+
+    # a position takes half of the capital, a third symbol only gets what the two others left
+    limited = PortfolioEngine(["A", "B", "C"], aligned, predictions, params, 2, max_position_fraction=0.5)
+    limited.run()
+    trade_df = limited.trade_df()
+    assert limited.skipped_buys > 0
+    assert len(trade_df) < len(unlimited.trade_df())
+    start = trade_df["start_time"].to_numpy()
+    end = trade_df["end_time"].to_numpy()
+    for i in range(len(trade_df)):
+        # the buy of trade i comes after the exits of its minute
+        opened = (start <= start[i]) & (end > start[i])
+        assert trade_df["position_capital"].to_numpy()[opened].sum() <= trade_df["before_trade_capital"][i] + 1e-9
+        assert trade_df["position_capital"][i] <= trade_df["before_trade_capital"][i] * 0.5 + 1e-9
+    results = limited.result_json(trade_df, 0)
+    assert results["skipped_buys"] == limited.skipped_buys
+    assert results["end_capital"] == round(limited.capital, 2)
+    assert sorted(results["symbols"]) == ["A", "B", "C"]
+    assert sum(symbol["number_of_trades"] for symbol in results["symbols"].values()) == len(trade_df)
+
+
+def test_backtester_saves_to_the_run_store(tmp_path):
+    cfg = run_config(2, TIMEFRAME, tp=0.005, sl=0.01)
+    cfg["portfolio"] = {"symbols": {"A": {}, "B": {}}, "max_position_fraction": 0.5, "max_position_capital": None}
+    cfg["artifacts"] = {"store": "batch", "directory": str(tmp_path), "batch_runs": 32}
+    tester = PortfolioBacktester(cfg)
+    predictions = []
+    for i in range(2):
+        minutes = synthetic_minutes(3, seed=10 + i)
+        bar_times, symbol_predictions = synthetic_bars(minutes, TIMEFRAME, 2, seed=20 + i)
+        tester.datasets.append(pd.DataFrame({"output_class": 0}, index=bar_times))
+        tester.minutes.append(minutes)
+        predictions.append(symbol_predictions)
+    results = tester.run(predictions)
+    default_store(cfg).flush()
+
+    entry = read_index(str(tmp_path), cfg["run_name"])[cfg["run_name"]]
+    assert entry["results"]["skipped_buys"] == results["skipped_buys"]
+    assert sum(month["number_of_trades"] for month in entry["monthly"]) == len(tester.trade_df)
+    stored = load_trades(cfg["run_name"], str(tmp_path))
+    assert len(stored) == len(tester.trade_df)
+    assert stored["profit"].sum() == pytest.approx(tester.trade_df["profit"].sum())
@@ -0,0 +1,41 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from columnar import convert_csv, read_table
+from prediction_cache import PredictionCache
+
+
+def write_inputs(directory):
+    index = pd.date_range("2021-01-01", periods=50, freq="60min", name="open_time")
+    dataset = os.path.join(directory, "dataset.csv")
+    pd.DataFrame({"close": np.arange(50.0), "output_class": np.arange(50) % 2}, index=index).to_csv(dataset)
+    for name in ["model.pickle", "scaler.save"]:
+        with open(os.path.join(directory, name), "wb") as fout:
+            fout.write(name.encode())
+    return {"model": "logistic_regression", "classes": 2, "window_length": 30, "dataset": dataset,
+            "model_file": os.path.join(directory, "model.pickle"), "scaler": os.path.join(directory, "scaler.save")}
+
+
+def test_key_of_a_columnar_dataset_without_its_csv(tmp_path):
+    config = write_inputs(str(tmp_path))
+    cache = PredictionCache(cache_dir=str(tmp_path / "cache"))
+    csv_key = cache.key(config)
+    convert_csv(config["dataset"])
+    columnar_key = cache.key(config)
+    os.remove(config["dataset"])
+    # read_table still loads the columnar copy, the key is computed from the same files
+    assert len(read_table(config["dataset"])) == 50
+    assert cache.key(config) == columnar_key
+    assert columnar_key != csv_key
+
+
+def test_key_depends_on_the_threshold(tmp_path):
+    config = write_inputs(str(tmp_path))
+    cache = PredictionCache(cache_dir=str(tmp_path / "cache"))
+    default_key = cache.key(config)
+    config["inference"] = {"threshold": 0.5}
+    assert cache.key(config) == default_key
+    config["inference"]["threshold"] = 0.6
+    assert cache.key(config) != default_key
@@ -0,0 +1,102 @@
+import threading
+
+import numpy as np
+import pytest
+
+import run_store
+from backtest import align_minutes, run_engine, save_run
+from helpers import synthetic_minutes, synthetic_bars, run_config
+from metrics import monthly_breakdown
+from run_store import RunStore, compact, default_store, load_trades, read_index, results_table
+from strategy import Strategy
+from trade import TradeLedger
+
+
+@pytest.fixture(scope="module")
+def ledgers():
+    """ The trades of a few loop runs over 40 days, so they span two months. """
+    minutes = synthetic_minutes(40)
+    bar_times, predictions = synthetic_bars(minutes, 60, 2)
+    times, prices, signal_idx = align_minutes(minutes, bar_times, 60)
+    rows = []
+    for tp in [None, 0.005, 0.01]:
+        strategy = Strategy(run_config(2, 60, tp=tp), predictions)
+        run_engine(strategy, "loop", times, prices, signal_idx)
+        strategy.end()
+        rows.append(strategy.ledger.view().copy())
+    return rows
+
+
+def run_cfg(run_name, directory):
+    cfg = run_config(2, 60)
+    cfg.update(run_name=run_name, artifacts={"store": "batch", "directory": str(directory), "batch_runs": 2})
+    return cfg
+
+
+def trade_df(rows, run_name):
+    return TradeLedger.from_rows(rows).to_frame(None, None, None, run_name)
+
+
+def test_reruns_replace_the_runs_and_compact_drops_them(ledgers, tmp_path):
+    store = RunStore(str(tmp_path), batch_runs=2)
+    for i, rows in enumerate(ledgers):
+        store.add(run_cfg("run_{}".format(i), tmp_path), {"number_of_trades": len(rows)}, rows)
+    store.add(run_cfg("run_0", tmp_path), {"number_of_trades": len(ledgers[2])}, ledgers[2])
+    store.flush()
+
+    assert load_trades("run_0", str(tmp_path)).equals(trade_df(ledgers[2], "run_0"))
+    assert load_trades("run_1", str(tmp_path)).equals(trade_df(ledgers[1], "run_1"))
+    assert list(read_index(str(tmp_path))) == ["run_0", "run_1", "run_2"]
+    assert read_index(str(tmp_path), "run_2")["run_2"]["results"] == {"number_of_trades": len(ledgers[2])}
+
+    parts = sorted(path.name for path in tmp_path.glob("*.npy"))
+    assert compact(str(tmp_path)) == 1
+    with open(tmp_path / run_store.INDEX_FILE) as fin:
+        assert len(fin.readlines()) == 3
+    assert sorted(path.name for path in tmp_path.glob("*.npy")) != parts
+    for i in range(3):
+        assert load_trades("run_{}".format(i), str(tmp_path)).equals(
+            trade_df(ledgers[2 if i == 0 else i], "run_{}".format(i)))
+    assert results_table(str(tmp_path))["number_of_trades"].tolist() == [len(ledgers[2]), len(ledgers[1]),
+                                                                         len(ledgers[2])]
+    assert compact(str(tmp_path)) == 0
+    store.close()
+
+
+def test_lookup_is_rebuilt_for_stores_without_it(ledgers, tmp_path):
+    store = RunStore(str(tmp_path), background=False)
+    store.add(run_cfg("run_0", tmp_path), {}, ledgers[0])
+    store.add(run_cfg("run_0", tmp_path), {}, ledgers[1])
+    store.flush()
+    (tmp_path / run_store.LOOKUP_FILE).unlink()
+    assert load_trades("run_0", str(tmp_path)).equals(trade_df(ledgers[1], "run_0"))
+
+
+def test_batch_store_keeps_the_monthly_breakdown(ledgers, tmp_path):
+    cfg = run_cfg("monthly", tmp_path)
+    save_run(cfg, {}, ledgers[1])
+    default_store(cfg).flush()
+    monthly = read_index(str(tmp_path), "monthly")["monthly"]["monthly"]
+    assert len(monthly) == 2
+    assert monthly == monthly_breakdown(trade_df(ledgers[1], "monthly"), cfg["params"]["initial_capital"])
+
+
+def test_write_errors_are_raised_on_the_next_flush(ledgers, tmp_path, monkeypatch):
+    store = RunStore(str(tmp_path), batch_runs=1)
+
+    def disk_full(path, data):
+        raise OSError("No space left on device")
+    monkeypatch.setattr(run_store, "_write_atomic", disk_full)
+    store.add(run_cfg("run_0", tmp_path), {}, ledgers[0])
+    with pytest.raises(Exception, match="writing runs"):
+        store.flush()
+
+    # the writer thread is still running, the next batches are written and flush returns
+    monkeypatch.undo()
+    store.add(run_cfg("run_1", tmp_path), {}, ledgers[1])
+    flushed = threading.Thread(target=store.flush)
+    flushed.start()
+    flushed.join(5)
+    assert not flushed.is_alive()
+    assert load_trades("run_1", str(tmp_path)).equals(trade_df(ledgers[1], "run_1"))
+    store.close()
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from backtest import align_minutes, compute_result_json, run_engine
+from helpers import synthetic_minutes, synthetic_bars, run_config
+from strategy import Strategy
+from walk_forward import RunningStats, WalkForwardAggregator, SUMMARY_METRICS, time_slices
+
+DAY_NS = pd.Timedelta(days=1).value
+
+
+@pytest.fixture(scope="module")
+def minutes():
+    return synthetic_minutes(12)
+
+
+@pytest.mark.parametrize("window_days,step_days", [(2, 2), (3, 1), (0.25, 0.25)])
+def test_slices_cover_the_minutes_without_gaps(minutes, window_days, step_days):
+    times = minutes.index.values.astype("datetime64[ns]").view(np.int64)
+    slices = time_slices(times, window_days, step_days)
+    window = int(window_days * DAY_NS)
+    step = int(step_days * DAY_NS)
+    covered = np.zeros(len(times), dtype=bool)
+    for lo, hi, start, end in slices:
+        assert end - start == window
+        assert (start - times[0]) % step == 0
+        # the minutes of the slice are the ones in [start, end)
+        assert lo == np.searchsorted(times, start) and hi == np.searchsorted(times, end)
+        assert hi > lo
+        assert times[lo] >= start and times[hi - 1] < end
+        covered[lo:hi] = True
+    assert slices[0][0] == 0
+    last_hi = slices[-1][1]
+    assert covered[:last_hi].all()
+    # only the last minutes that don't fill a window are left out
+    assert times[-1] + 60 * 10 ** 9 - slices[-1][2] < window + step
+    if step_days == window_days:
+        # back to back slices share their boundary minute index
+        for before, after in zip(slices, slices[1:]):
+            assert before[3] == after[2] and before[1] == after[0]
+
+
+def test_slices_in_a_hole_of_the_minutes_are_dropped(minutes):
+    times = minutes.index.values.astype("datetime64[ns]").view(np.int64)
+    hour = DAY_NS // 24
+    slices = time_slices(times, 1 / 24, 1 / 24)
+    kept = {start for _, _, start, _ in slices}
+    dropped = [start for start in range(times[0], times[-1] + 60 * 10 ** 9 - hour + 1, hour) if start not in kept]
+    # the 5 hour hole of synthetic_minutes, the slices around it are kept
+    assert len(dropped) == 5
+    assert dropped == list(range(dropped[0], dropped[0] + 5 * hour, hour))
+    assert not ((times >= dropped[0]) & (times < dropped[-1] + hour)).any()
+
+
+def test_running_stats_match_numpy():
+    values = np.random.default_rng(0).normal(5, 3, 1000)
+    running = RunningStats()
+    for value in values.tolist() + [np.nan, None]:
+        running.update(value)
+    assert running.count == len(values)
+    assert running.mean == pytest.approx(values.mean(), rel=1e-12)
+    assert running.std() == pytest.approx(values.std(ddof=1), rel=1e-12)
+    assert (running.min, running.max) == (values.min(), values.max())
+    one = RunningStats()
+    one.update(1.0)
+    assert np.isnan(one.std())
+
+
+def test_aggregator_summary_matches_numpy_on_slice_results(minutes):
+    times, prices, signal_idx = align_minutes(minutes, *synthetic_bars(minutes, 5, 2)[:1], 5)
+    predictions = synthetic_bars(minutes, 5, 2)[1]
+    slices = time_slices(times, 2, 1)
+    aggregator = WalkForwardAggregator(["tp", "sl", "ttl"], 100)
+    rows = []
+    for tp, sl, ttl in [(None, None, None), (0.005, 0.01, 180)]:
+        for lo, hi, _, _ in slices:
+            cfg = run_config(2, 5, tp=tp, sl=sl, ttl=ttl)
+            strategy = Strategy(cfg, predictions)
+            run_engine(strategy, "loop", times[lo:hi], prices[lo:hi], signal_idx[lo:hi])
+            strategy.end()
+            row = {"tp": tp, "sl": sl, "ttl": ttl}
+            row.update(compute_result_json(strategy, cfg["params"], 0, (times[lo], times[hi - 1])))
+            rows.append(row)
+            aggregator.update(row)
+
+    summary = aggregator.summary()
+    df = pd.DataFrame(rows).fillna({"tp": -1, "sl": -1, "ttl": -1})
+    assert len(summary) == 2
+    for i, (_, group) in enumerate(df.groupby(["tp", "sl", "ttl"], sort=False)):
+        assert summary["slices"][i] == len(slices)
+        assert summary["profitable_slices_%"][i] == round((group["end_capital"] > 100).mean() * 100, 2)
+        for metric in SUMMARY_METRICS:
+            values = group[metric].astype(float).dropna().to_numpy()
+            # the summary rounds to 4 decimals
+            assert summary["{}_mean".format(metric)][i] == pytest.approx(values.mean(), abs=5.1e-5), metric
+            assert summary["{}_std".format(metric)][i] == pytest.approx(values.std(ddof=1), abs=5.1e-5), metric
+            assert summary["{}_min".format(metric)][i] == values.min()
+            assert summary["{}_max".format(metric)][i] == values.max()